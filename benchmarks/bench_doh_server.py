@@ -0,0 +1,125 @@
+"""Load test for the DoH endpoint against a local stand-in upstream
+
+Runs DOHServer on loopback and drives it with keep-alive clients, a mix
+of cache hits and misses, then reports requests/sec and p50/p99 latency.
+
+    python benchmarks/bench_doh_server.py --clients 32 --requests 500
+"""
+import argparse
+import base64
+import http.client
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dnslib import A, QTYPE, RR, DNSRecord  # noqa: E402
+from server.doh_server import DOHServer  # noqa: E402
+
+
+class StandInUpstream(BaseHTTPRequestHandler):
+    """Answers every A query with 10.0.0.1 after an optional delay"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    delay = 0.0
+
+    def do_POST(self):
+        query = DNSRecord.parse(self.rfile.read(int(self.headers['content-length'])))
+        time.sleep(self.delay)
+        reply = query.reply()
+        reply.add_answer(RR(query.q.qname, QTYPE.A, rdata=A("10.0.0.1"), ttl=300))
+        body = reply.pack()
+        self.send_response(200)
+        self.send_header('content-type', 'application/dns-message')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run_client(port, method, names, count, seed, latencies, errors):
+    # Each client walks the names in its own order so misses are not all in lockstep
+    names = list(names)
+    random.Random(seed).shuffle(names)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    local = []
+    for i in range(count):
+        query = DNSRecord.question(names[i % len(names)])
+        query.header.id = 0
+        started = time.perf_counter()
+        try:
+            if method == 'GET':
+                encoded = base64.urlsafe_b64encode(query.pack()).rstrip(b'=').decode()
+                connection.request('GET', f'/dns-query?dns={encoded}',
+                                   headers={'Accept': 'application/dns-message'})
+            else:
+                connection.request('POST', '/dns-query', body=query.pack(),
+                                   headers={'Content-Type': 'application/dns-message'})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(repr(e))
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            continue
+        local.append(time.perf_counter() - started)
+    connection.close()
+    latencies.extend(local)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=16, help='concurrent keep-alive connections')
+    parser.add_argument('--requests', type=int, default=500, help='requests per client')
+    parser.add_argument('--names', type=int, default=200, help='distinct names (controls hit rate)')
+    parser.add_argument('--method', choices=('GET', 'POST'), default='GET')
+    parser.add_argument('--upstream-delay', type=float, default=0.005, help='stand-in latency (s)')
+    args = parser.parse_args()
+
+    StandInUpstream.delay = args.upstream_delay
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), StandInUpstream)
+    upstream.daemon_threads = True
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    upstream_url = f"http://127.0.0.1:{upstream.server_port}/dns-query"
+
+    names = [f"host{i}.example.com" for i in range(args.names)]
+    latencies, errors = [], []
+    with DOHServer(port=0, host='127.0.0.1', upstream=upstream_url, max_workers=args.clients) as doh:
+        threads = [threading.Thread(target=run_client,
+                                    args=(doh.port, args.method, names, args.requests, seed,
+                                          latencies, errors))
+                   for seed in range(args.clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        stats = doh.get_stats()
+    upstream.shutdown()
+
+    cache = stats['resolver']['cache']
+    print(f"{args.method} x {len(latencies)} over {args.clients} connections in {elapsed:.2f}s")
+    print(f"  throughput  {len(latencies) / elapsed:,.0f} req/s")
+    print(f"  latency     p50 {percentile(latencies, 0.50) * 1000:.2f} ms"
+          f"  p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"  cache       {cache['hits']} hits / {cache['misses']} misses, "
+          f"{stats['resolver']['inflight']['executed']} upstream lookups")
+    print(f"  connections {stats['connections']}  errors {len(errors)}")
+
+
+if __name__ == '__main__':
+    main()
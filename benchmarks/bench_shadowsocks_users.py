@@ -0,0 +1,65 @@
+"""Cost of finding a connection's user as the number of Shadowsocks users grows
+
+For each table size, builds a UserTable and times identify_stream on the
+first length header of fresh connections: once for clients whose IP
+already has a hint (the usual case for a returning client), and once for
+clients from a new IP. The table keeps no recently seen users here, so
+every new IP falls back to trying every key.
+
+    python benchmarks/bench_shadowsocks_users.py --users 1 100 1000 10000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import shadowsocks_crypto  # noqa: E402
+from server.shadowsocks_users import UserTable  # noqa: E402
+
+
+def first_headers(method, password, count):
+    """(salt, sealed first length header) of count fresh client connections"""
+    master = shadowsocks_crypto.master_key(password, method.key_size)
+    headers = []
+    for _ in range(count):
+        stream = shadowsocks_crypto.AEADStreamEncoder(method, master).encode(b'x')
+        headers.append((stream[:method.salt_size], stream[method.salt_size:method.salt_size + 18]))
+    return headers
+
+
+def run(method, users, connections):
+    table = UserTable(method, max_hinted_ips=connections + 1, recent_users=0)
+    for i in range(users):
+        table.add(f'user{i}', f'password{i}')
+    # The last user added is the worst case for a full scan
+    headers = first_headers(method, f'password{users - 1}', connections)
+
+    started = time.perf_counter()
+    for i, (salt, header) in enumerate(headers):
+        table.identify_stream(salt, header, f'10.0.{i // 256 % 256}.{i % 256}')
+    cold = (time.perf_counter() - started) / connections
+
+    started = time.perf_counter()
+    for i, (salt, header) in enumerate(headers):
+        table.identify_stream(salt, header, f'10.0.{i // 256 % 256}.{i % 256}')
+    warm = (time.perf_counter() - started) / connections
+
+    print(f"{users:>6} users: hinted IP {warm * 1e6:8.1f} us/connection   "
+          f"new IP {cold * 1e6:10.1f} us/connection")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--connections', type=int, default=200)
+    parser.add_argument('--method', default='aes-256-gcm', choices=sorted(shadowsocks_crypto.METHODS))
+    args = parser.parse_args()
+    method = shadowsocks_crypto.get_method(args.method)
+    for users in args.users:
+        run(method, users, args.connections)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""SOCKS5 handshakes per second, in the parser alone and through the servers
+
+First feeds a pipelined greeting + auth + request to SOCKS5Handshake
+in one piece and byte by byte. Then, for each TCP engine, C client
+threads repeatedly connect to SOCKS5Server, send the whole handshake in
+one segment, wait for the CONNECT reply from a local target and close.
+
+    python benchmarks/bench_socks5_handshake.py --seconds 3 --clients 1 8
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.socks5_handshake import SOCKS5Handshake  # noqa: E402
+from server.socks5_server import SOCKS5Server  # noqa: E402
+from server.tcp_engine import TCP_ENGINES  # noqa: E402
+from utils.socks_address import pack_address  # noqa: E402
+
+AUTH = ('user', 'secret')
+
+
+def handshake_bytes(port):
+    return (b'\x05\x01\x02' + bytes((1, len(AUTH[0]))) + AUTH[0].encode()
+            + bytes((len(AUTH[1]),)) + AUTH[1].encode()
+            + b'\x05\x01\x00' + pack_address('127.0.0.1', port))
+
+
+def bench_parser(request, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        SOCKS5Handshake(AUTH).feed(request)
+    whole = count / (time.perf_counter() - started)
+
+    pieces = [request[i:i + 1] for i in range(len(request))]
+    started = time.perf_counter()
+    for _ in range(count):
+        handshake = SOCKS5Handshake(AUTH)
+        for piece in pieces:
+            handshake.feed(piece)
+    split = count / (time.perf_counter() - started)
+    print(f"parser: {whole:10.0f} handshakes/s in one piece, {split:10.0f} byte by byte")
+
+
+def start_target():
+    """Accepts and closes connections"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(socket.SOMAXCONN)
+
+    def accept():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            conn.close()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener
+
+
+def client(port, request, deadline, counts):
+    done = 0
+    while time.perf_counter() < deadline:
+        with socket.create_connection(('127.0.0.1', port)) as conn:
+            conn.sendall(request)
+            received = b''
+            while len(received) < 14:  # method, auth status, 10-byte IPv4 reply
+                data = conn.recv(64)
+                if not data:
+                    break
+                received += data
+        if received[3:5] == b'\x00\x05' and received[5] == 0:
+            done += 1
+    counts.append(done)
+
+
+def bench_server(engine, clients, seconds, target_port):
+    request = handshake_bytes(target_port)
+    with SOCKS5Server(port=0, host='127.0.0.1', auth=AUTH, engine=engine) as server:
+        counts = []
+        deadline = time.perf_counter() + seconds
+        threads = [threading.Thread(target=client, args=(server.port, request, deadline, counts))
+                   for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    print(f"{engine:<8} {clients:>3} clients: {sum(counts) / seconds:8.0f} handshakes/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--parser-rounds', type=int, default=100000)
+    args = parser.parse_args()
+    target = start_target()
+    bench_parser(handshake_bytes(target.getsockname()[1]), args.parser_rounds)
+    for clients in args.clients:
+        for engine in TCP_ENGINES:
+            bench_server(engine, clients, args.seconds, target.getsockname()[1])
+    target.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Loopback throughput and server CPU of SOCKS5 CONNECT relaying
+
+Runs SOCKS5Server in a child process so its CPU time can be read from
+/proc apart from the load generator. Each of N concurrent clients
+CONNECTs through it to a local sink, streams the given amount of data,
+half-closes and waits for the sink's byte count to come back. Reports
+aggregate Gbps and server CPU seconds per connection and per GB for the
+copying relay and, where available, the splice relay.
+
+    python benchmarks/bench_socks5_relay.py --megabytes 512 --connections 1 4
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.socks5_server import SOCKS5Server  # noqa: E402
+from server.tcp_relay import SPLICE_AVAILABLE  # noqa: E402
+
+CHUNK = 1024 * 1024
+
+
+def cpu_seconds(pid):
+    """User + system CPU time of a process"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def serve(port_queue, options):
+    server = SOCKS5Server(port=0, host='127.0.0.1', **options)
+    server.start()
+    port_queue.put(server.port)
+    threading.Event().wait()
+
+
+def start_sink():
+    """Counts bytes until EOF, then sends the count back"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(64)
+
+    def handle(conn):
+        buffer, total = bytearray(CHUNK), 0
+        with conn:
+            while True:
+                count = conn.recv_into(buffer)
+                if not count:
+                    break
+                total += count
+            conn.sendall(struct.pack('>Q', total))
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def client(proxy_port, sink_port, size, results):
+    with socket.create_connection(('127.0.0.1', proxy_port)) as conn:
+        conn.sendall(b'\x05\x01\x00')
+        conn.recv(2)
+        conn.sendall(b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', sink_port))
+        conn.recv(10)
+        data = memoryview(bytes(CHUNK))
+        remaining = size
+        while remaining:
+            remaining -= conn.send(data[:min(remaining, CHUNK)])
+        conn.shutdown(socket.SHUT_WR)
+        results.append(struct.unpack('>Q', conn.recv(8))[0])
+
+
+def run(label, options, connections, megabytes, sink_port):
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(port_queue, options), daemon=True)
+    process.start()
+    proxy_port = port_queue.get(timeout=10)
+    size = megabytes * 1024 * 1024
+    results = []
+    threads = [threading.Thread(target=client, args=(proxy_port, sink_port, size, results))
+               for _ in range(connections)]
+    cpu_before, started = cpu_seconds(process.pid), time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed, cpu = time.perf_counter() - started, cpu_seconds(process.pid) - cpu_before
+    process.terminate()
+    process.join()
+
+    total = sum(results)
+    if total != size * connections:
+        print(f"{label}: sink saw {total} of {size * connections} bytes")
+    print(f"{label:<8} {connections:>3} conn: {total * 8 / elapsed / 1e9:6.2f} Gbps  "
+          f"server CPU {cpu / connections:6.2f} s/conn  {cpu / (total / 1e9):5.2f} s/GB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megabytes', type=int, default=256, help='Data sent per connection')
+    parser.add_argument('--connections', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--buffer-size', type=int, default=65536)
+    args = parser.parse_args()
+    sink_port = start_sink()
+    modes = [('copy', {'buffer_size': args.buffer_size})]
+    if SPLICE_AVAILABLE:
+        modes.append(('splice', {'buffer_size': args.buffer_size, 'splice': True}))
+    for connections in args.connections:
+        for label, options in modes:
+            run(label, options, connections, args.megabytes, sink_port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Datagram rate of the SOCKS5 UDP ASSOCIATE relay by drain batch size
+
+Opens one association on SOCKS5UDPRelay and a local UDP echo target,
+then a client keeps a window of datagrams in flight through the relay
+and counts the echoed replies. Run with batch 1 (one datagram per
+wakeup) against larger batches to see what draining per wakeup saves.
+
+    python benchmarks/bench_socks5_udp.py --seconds 3 --batch 1 16 64 --window 64
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.socks5_udp import UDP_HEADER, SOCKS5UDPRelay  # noqa: E402
+from utils.socks_address import pack_address  # noqa: E402
+
+
+def start_echo():
+    echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    echo.bind(('127.0.0.1', 0))
+
+    def serve():
+        while True:
+            try:
+                data, source = echo.recvfrom(65536)
+                echo.sendto(data, source)
+            except OSError:
+                return
+
+    threading.Thread(target=serve, daemon=True).start()
+    return echo
+
+
+def run(batch, seconds, window, size, echo_port):
+    relay = SOCKS5UDPRelay(batch=batch)
+    relay.start()
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(('127.0.0.1', 0))
+    client.settimeout(0.5)
+    association = relay.open('127.0.0.1', '127.0.0.1', client.getsockname()[1])
+    datagram = UDP_HEADER + pack_address('127.0.0.1', echo_port) + bytes(size)
+    target = association.address
+
+    replies = lost = 0
+    in_flight = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        while in_flight < window:
+            client.sendto(datagram, target)
+            in_flight += 1
+        try:
+            client.recv(65536)
+        except socket.timeout:
+            lost += in_flight  # dropped somewhere on the way; refill the window
+            in_flight = 0
+            continue
+        replies += 1
+        in_flight -= 1
+    relay.close(association)
+    relay.stop()
+    client.close()
+    print(f"batch {batch:>3}: {replies / seconds:9.0f} round trips/s  ({lost} lost)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--window', type=int, default=64, help='Datagrams kept in flight')
+    parser.add_argument('--size', type=int, default=512, help='Payload bytes per datagram')
+    args = parser.parse_args()
+    echo = start_echo()
+    for batch in args.batch:
+        run(batch, args.seconds, args.window, args.size, echo.getsockname()[1])
+    echo.close()
+
+
+if __name__ == '__main__':
+    main()
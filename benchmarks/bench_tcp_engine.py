@@ -0,0 +1,86 @@
+"""How far concurrent connections scale on each TCP connection engine
+
+Starts ShadowsocksServer on loopback with the threaded and the asyncio
+engine, opens N client connections that stay open, then sends one chunk
+on every connection and waits for all the replies. Reports connect time,
+round time, server threads and resident memory growth.
+
+    python benchmarks/bench_tcp_engine.py --connections 100 1000 5000
+"""
+import argparse
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import shadowsocks_crypto  # noqa: E402
+from server.shadowsocks_server import ShadowsocksServer  # noqa: E402
+from server.tcp_engine import TCP_ENGINES  # noqa: E402
+
+PASSWORD = 'bench'
+
+
+def rss_kib():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def run(engine, count, backlog):
+    method = shadowsocks_crypto.get_method('aes-256-gcm')
+    master = shadowsocks_crypto.master_key(PASSWORD, method.key_size)
+    base_threads, base_rss = threading.active_count(), rss_kib()
+    with ShadowsocksServer(password=PASSWORD, port=0, host='127.0.0.1', engine=engine,
+                           backlog=backlog) as server:
+        started = time.perf_counter()
+        clients = []
+        for _ in range(count):
+            conn = socket.create_connection(('127.0.0.1', server.port), timeout=30)
+            clients.append((conn, shadowsocks_crypto.AEADStreamEncoder(method, master),
+                            shadowsocks_crypto.AEADStreamDecoder(method, master)))
+        connect_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        selector = selectors.DefaultSelector()
+        for conn, encoder, decoder in clients:
+            conn.sendall(encoder.encode(b'ping'))
+            conn.setblocking(False)
+            selector.register(conn, selectors.EVENT_READ, decoder)
+        waiting = count
+        while waiting:
+            for key, _ in selector.select(timeout=30):
+                if key.data.feed(key.fileobj.recv(4096)):
+                    selector.unregister(key.fileobj)
+                    waiting -= 1
+        round_time = time.perf_counter() - started
+        threads, rss = threading.active_count() - base_threads, rss_kib() - base_rss
+
+        selector.close()
+        for conn, _, _ in clients:
+            conn.close()
+    return connect_time, round_time, threads, rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, nargs='+', default=[100, 1000, 4000])
+    parser.add_argument('--engines', nargs='+', default=list(TCP_ENGINES), choices=TCP_ENGINES)
+    parser.add_argument('--backlog', type=int, default=socket.SOMAXCONN)
+    args = parser.parse_args()
+
+    print(f"{'engine':>9} {'conns':>6} {'connect s':>10} {'round s':>8} {'threads':>8} {'RSS +MiB':>9}")
+    for count in args.connections:
+        for engine in args.engines:
+            connect_time, round_time, threads, rss = run(engine, count, args.backlog)
+            print(f"{engine:>9} {count:>6} {connect_time:>10.2f} {round_time:>8.2f} "
+                  f"{threads:>8} {rss / 1024:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Per-stage cost of the obfuscation transform chains
+
+Compiles each registered stage on its own, then a few full chains, for a
+sending and a receiving Obfuscator sharing a key. Reports encode
+and decode MB/s per payload size and checks every round trip.
+
+    python benchmarks/bench_transforms.py --sizes 64 1400 16384 --chains encrypt>xor>tls
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.obfuscation import Obfuscator  # noqa: E402
+from utils.transforms import TRANSFORMS  # noqa: E402
+
+
+def measure(spec, size, budget, key, encryption):
+    sender = Obfuscator(key, encryption=encryption)
+    receiver = Obfuscator(key, encryption=encryption)
+    encoder, decoder = sender.compile_chain(spec), receiver.compile_chain(spec)
+    data = os.urandom(size)
+    number = max(3, budget // size)
+
+    started = time.perf_counter()
+    messages = [encoder.encode(data) for _ in range(number)]
+    encode_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    decoded = [decoder.decode(message) for message in messages]
+    decode_time = time.perf_counter() - started
+
+    if decoded[-1] != data:
+        raise SystemExit(f"{spec} round trip failed at size {size}")
+    wire = len(messages[-1])
+    return size * number / encode_time / 1e6, size * number / decode_time / 1e6, wire
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 512, 1400, 16384, 60000])
+    parser.add_argument('--chains', nargs='+', default=['encrypt>xor>tls', 'encrypt>tls', 'xor>tls'],
+                        help="full chains to time after the single stages")
+    parser.add_argument('--encryption', default='aes-256-gcm', help="'fernet' or an AEAD algorithm")
+    parser.add_argument('--budget', type=int, default=16 << 20, help='bytes processed per measurement')
+    args = parser.parse_args()
+
+    key = Obfuscator().get_key()
+    specs = ['none'] + sorted(TRANSFORMS) + args.chains
+    print(f"{'size':>7} {'chain':>18} {'on wire':>8} {'encode':>9} {'decode':>9}   (MB/s)")
+    for size in args.sizes:
+        for spec in specs:
+            encode, decode, wire = measure(spec, size, args.budget, key, args.encryption)
+            print(f"{size:>7} {spec:>18} {wire:>8} {encode:>9.1f} {decode:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Memory per association and expiry cost of the Shadowsocks UDP relay
+
+Starts ShadowsocksUDPRelay on loopback and opens N associations by
+sending one packet each to N different (client, target port) pairs, then
+reports the relay's Python heap and resident memory per association and
+how long after the last packet the idle sweep has cleared them all. Each
+association holds a file descriptor, so the soft RLIMIT_NOFILE is raised
+to the hard limit first.
+
+    python benchmarks/bench_udp_relay.py --flows 10000 100000
+"""
+import argparse
+import os
+import resource
+import socket
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import shadowsocks_crypto  # noqa: E402
+from server.shadowsocks_server import ShadowsocksUDPRelay  # noqa: E402
+from server.shadowsocks_users import UserTable  # noqa: E402
+from utils.socks_address import pack_address  # noqa: E402
+
+
+def rss_kib():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def wait_for(predicate, timeout):
+    deadline = time.perf_counter() + timeout
+    while not predicate() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+
+def run(flows, idle_timeout):
+    method = shadowsocks_crypto.get_method('aes-128-gcm')
+    master = shadowsocks_crypto.master_key('bench', method.key_size)
+    packets = [shadowsocks_crypto.seal_packet(method, master, pack_address('127.0.0.1', 20000 + i % 40000) + b'x')
+               for i in range(flows)]
+    # At most 40000 target ports per client socket keeps every (client, target) distinct
+    clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(-(-flows // 40000))]
+
+    tracemalloc.start()
+    base_heap, base_rss = tracemalloc.get_traced_memory()[0], rss_kib()
+    users = UserTable(method)
+    users.add('bench', 'bench')
+    relay = ShadowsocksUDPRelay(users, '127.0.0.1', idle_timeout=idle_timeout, tick=0.5,
+                                max_associations=flows)
+    port = relay.start()
+    started = time.perf_counter()
+    for i, packet in enumerate(packets):
+        clients[i // 40000].sendto(packet, ('127.0.0.1', port))
+        if i % 128 == 127:
+            # Keep within the listening socket's receive buffer
+            wait_for(lambda: relay.received > i, 5)
+    wait_for(lambda: relay.received >= flows, 5)
+    opened = time.perf_counter() - started
+    heap, rss = tracemalloc.get_traced_memory()[0] - base_heap, rss_kib() - base_rss
+    associations = relay.get_stats()['associations']
+
+    started = time.perf_counter()
+    wait_for(lambda: not relay.get_stats()['associations'], idle_timeout + 60)
+    cleared = time.perf_counter() - started
+    relay.stop()
+    tracemalloc.stop()
+    for client in clients:
+        client.close()
+
+    per_flow = max(associations, 1)
+    print(f"{flows:>7} flows: {associations:>7} associations in {opened:6.2f}s  "
+          f"heap {heap / per_flow:6.0f} B/flow  rss {rss * 1024 / per_flow:6.0f} B/flow  "
+          f"all expired {cleared:5.2f}s after the last packet")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--flows', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--idle-timeout', type=float, default=10.0)
+    args = parser.parse_args()
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    needed = max(args.flows) + 64
+    if hard < needed:
+        print(f"RLIMIT_NOFILE hard limit {hard} is below {needed}; larger runs will drop flows")
+    for flows in args.flows:
+        run(flows, args.idle_timeout)
+
+
+if __name__ == '__main__':
+    main()
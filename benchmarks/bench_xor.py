@@ -0,0 +1,59 @@
+"""Throughput of the XOR obfuscation path across payload sizes
+
+Compares the old per-byte generator with utils.xor_engine (big-integer
+backend, and the NumPy backend when installed), checking that every
+variant produces identical bytes.
+
+    python benchmarks/bench_xor.py --sizes 64 1500 16384 1048576
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import xor_engine  # noqa: E402
+
+KEY = b'\xAA\x55\xAA\x55' + (7).to_bytes(4, 'big')  # client key + sequence counter
+
+
+def legacy_xor(data, key):
+    return bytes(x ^ key[i % len(key)] for i, x in enumerate(data))
+
+
+def throughput(fn, size, budget):
+    number = max(3, budget // size)
+    return size * number / timeit.timeit(fn, number=number) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 512, 1500, 16384, 65536, 1 << 20])
+    parser.add_argument('--budget', type=int, default=8 << 20, help='bytes processed per measurement')
+    args = parser.parse_args()
+
+    backends = [('int', None)]
+    if xor_engine.numpy is not None:
+        backends.append(('numpy', xor_engine.numpy))
+
+    header = f"{'size':>9} {'legacy':>9}" + ''.join(
+        f" {name + ' bytes':>12} {name + ' into':>12}" for name, _ in backends)
+    print(header + "   (MB/s)")
+    for size in args.sizes:
+        data = os.urandom(size)
+        expected = legacy_xor(data, KEY)
+        row = f"{size:>9} {throughput(lambda: legacy_xor(data, KEY), size, args.budget // 16):>9.1f}"
+        for name, module in backends:
+            xor_engine.numpy = module
+            buffer = bytearray(data)
+            xor_engine.xor_into(buffer, KEY)
+            if xor_engine.xor_bytes(data, KEY) != expected or buffer != expected:
+                raise SystemExit(f"{name} backend output differs at size {size}")
+            row += f" {throughput(lambda: xor_engine.xor_bytes(data, KEY), size, args.budget):>12.1f}"
+            row += f" {throughput(lambda: xor_engine.xor_into(buffer, KEY), size, args.budget):>12.1f}"
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
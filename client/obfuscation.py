@@ -1,32 +1,56 @@
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet, InvalidToken
 import socket
 import struct
 import logging
-from typing import Optional, Union
-from utils.encryption import generate_strong_key
+from typing import Dict, List, Optional, Union
+from utils import transforms
+from utils.encryption import AEAD_ALGORITHMS, AEADCipher, derive_aead_key, generate_strong_key
+from utils.dns_framing import MAX_PACKET, DNSReassembler, fragment_capacity
+from utils.tls_framing import MAX_RECORD_PAYLOAD, TLSRecordDeframer
+from utils.transforms import DEFAULT_XOR_KEY
+from utils.xor_engine import xor_bytes, xor_into
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class ClientObfuscator:
-    def __init__(self, key: Optional[bytes] = None, obfuscation_mode: str = 'tls'):
+    def __init__(self, key: Optional[bytes] = None, obfuscation_mode: str = 'tls',
+                 tls_record_size: int = MAX_RECORD_PAYLOAD, encryption: str = 'fernet',
+                 dns_packet_size: int = MAX_PACKET):
         """
         Initialize client-side obfuscator
         
         Args:
             key: Pre-shared key for encryption (None generates new)
-            obfuscation_mode: Default obfuscation method ('xor', 'tls', 'dns', or 'none')
+            obfuscation_mode: Default obfuscation method ('xor', 'tls', 'dns', 'none'),
+                or a transform chain such as 'encrypt>xor>tls'
+            tls_record_size: Max payload per TLS record; larger data spans several
+            encryption: 'fernet', 'aes-256-gcm' or 'chacha20-poly1305' (raw binary AEAD)
+            dns_packet_size: Max size of each DNS-mimic packet; larger data is segmented
         """
-        self.key = key or Fernet.generate_key()
-        self.cipher = Fernet(self.key)
+        if not 0 < tls_record_size <= MAX_RECORD_PAYLOAD:
+            raise ValueError(f"TLS record size must be between 1 and {MAX_RECORD_PAYLOAD}")
+        if encryption != 'fernet' and encryption not in AEAD_ALGORITHMS:
+            raise ValueError(f"Unknown encryption: {encryption}")
+        fragment_capacity(dns_packet_size)  # rejects sizes with no room for data
+        self.tls_record_size = tls_record_size
+        self.dns_packet_size = dns_packet_size
+        self.encryption = encryption
+        self._set_key(key or Fernet.generate_key())
         self.obfuscation_mode = obfuscation_mode
         self.sequence_counter = 0  # For sequence-based obfuscation
+        # Compiled once per mode; stream stages keep their buffers between calls
+        self._chains: Dict[str, transforms.TransformChain] = {}
         
     def set_mode(self, mode: str):
-        """Set the obfuscation mode (xor/tls/dns/none)"""
+        """Set the obfuscation mode (xor/tls/dns/none, or a chain like 'encrypt>xor>tls')"""
         valid_modes = ['xor', 'tls', 'dns', 'none']
-        if mode not in valid_modes:
-            raise ValueError(f"Invalid mode. Must be one of {valid_modes}")
+        try:
+            self._chain(mode)
+        except ValueError:
+            raise ValueError(f"Invalid mode. Must be one of {valid_modes} or a chain of "
+                             f"{sorted(transforms.TRANSFORMS)} joined with '>'") from None
         self.obfuscation_mode = mode
         
     def obfuscate(self, data: bytes, mode: Optional[str] = None) -> bytes:
@@ -40,18 +64,7 @@ class ClientObfuscator:
         Returns:
             Obfuscated data ready for transmission
         """
-        mode = mode or self.obfuscation_mode
-        
-        if mode == 'none':
-            return data
-        elif mode == 'xor':
-            return self._xor_obfuscate(data)
-        elif mode == 'tls':
-            return self._tls_wrap(data)
-        elif mode == 'dns':
-            return self._dns_mimic(data)
-        else:
-            raise ValueError(f"Unknown obfuscation mode: {mode}")
+        return self._chain(mode or self.obfuscation_mode).encode(data)
 
     def deobfuscate(self, data: bytes, mode: Optional[str] = None) -> bytes:
         """
@@ -64,31 +77,66 @@ class ClientObfuscator:
         Returns:
             Original data after deobfuscation
         """
-        mode = mode or self.obfuscation_mode
-        
-        if mode == 'none':
-            return data
-        elif mode == 'xor':
-            return self._xor_deobfuscate(data)
-        elif mode == 'tls':
-            return self._tls_unwrap(data)
-        elif mode == 'dns':
-            return self._dns_demimic(data)
-        else:
-            raise ValueError(f"Unknown obfuscation mode: {mode}")
-
-    def _xor_obfuscate(self, data: bytes, key: bytes = b'\xAA\x55\xAA\x55') -> bytes:
+        return self._chain(mode or self.obfuscation_mode).decode(data)
+
+    def compile_chain(self, spec) -> transforms.TransformChain:
+        """Build a transform chain (e.g. 'encrypt>xor>tls') bound to this session"""
+        return transforms.compile_chain(spec, self)
+
+    def _chain(self, mode: str) -> transforms.TransformChain:
+        """The session's chain for mode, compiled on first use"""
+        chain = self._chains.get(mode)
+        if chain is None:
+            try:
+                chain = self._chains[mode] = self.compile_chain(mode)
+            except ValueError:
+                raise ValueError(f"Unknown obfuscation mode: {mode}") from None
+        return chain
+
+    def next_message(self):
+        """Advance the sequence counter after a message through an xor stage, or encoded through tls"""
+        self.sequence_counter = (self.sequence_counter + 1) % 65536
+
+    def xor_key(self) -> bytes:
+        """XOR key for the current message (the xor stage)"""
+        # Include sequence counter to make patterns less obvious
+        return DEFAULT_XOR_KEY + self.sequence_counter.to_bytes(4, 'big')
+
+    def tls_padding(self) -> bytes:
+        """Padding to append after the current message's records (the tls stage)"""
+        # Add some random padding to vary packet sizes (once, after the last record)
+        padding_len = self.sequence_counter % 32
+        return bytes([padding_len] * padding_len)
+
+    def tls_deframer(self) -> TLSRecordDeframer:
+        """Reassembles TLS records split or merged by TCP (the tls stage)"""
+        return TLSRecordDeframer(allow_padding=True)
+
+    def dns_reassembler(self) -> DNSReassembler:
+        """Puts segmented DNS-mimic messages back together (the dns stage)"""
+        return DNSReassembler()
+
+    def _xor_obfuscate(self, data: bytes, key: bytes = DEFAULT_XOR_KEY) -> bytes:
         """Lightweight XOR obfuscation (not for security, only obfuscation)"""
         if not data:
             raise ValueError("No data to obfuscate")
         
+        # XOR with rotating key + sequence
+        return xor_bytes(data, self._next_xor_key(key))
+
+    def _xor_obfuscate_into(self, buffer: Union[bytearray, memoryview],
+                            key: bytes = DEFAULT_XOR_KEY) -> None:
+        """In-place variant of _xor_obfuscate for a writable buffer"""
+        if not len(buffer):
+            raise ValueError("No data to obfuscate")
+        xor_into(buffer, self._next_xor_key(key))
+
+    def _next_xor_key(self, key: bytes) -> bytes:
+        """Extend the key with the sequence counter, then advance it"""
         # Include sequence counter to make patterns less obvious
         seq_bytes = self.sequence_counter.to_bytes(4, 'big')
         self.sequence_counter = (self.sequence_counter + 1) % 65536
-        
-        # XOR with rotating key + sequence
-        extended_key = key + seq_bytes
-        return bytes(x ^ extended_key[i % len(extended_key)] for i, x in enumerate(data))
+        return key + seq_bytes
 
     def _xor_deobfuscate(self, data: bytes) -> bytes:
         """Reverse XOR obfuscation"""
@@ -96,93 +144,65 @@ class ClientObfuscator:
 
     def _tls_wrap(self, data: bytes) -> bytes:
         """Wrap data with fake TLS header"""
-        if len(data) > 65535:
-            raise ValueError("Data too large for TLS wrapping")
-        
-        # Simulate TLS 1.3 application data
-        header = b'\x17\x03\x03' + struct.pack('>H', len(data))
-        
-        # Add some random padding to vary packet sizes
-        padding_len = self.sequence_counter % 32
-        padding = bytes([padding_len] * padding_len) if padding_len > 0 else b''
-        self.sequence_counter = (self.sequence_counter + 1) % 65536
-        
-        return header + data + padding
+        return self._chain('tls').encode(data)
+
+    def _tls_wrap_iov(self, data: Union[bytes, bytearray, memoryview]) -> List[Union[bytes, memoryview]]:
+        """TLS-wrapped data as a buffer list for socket.sendmsg (no copy)"""
+        # Simulate TLS 1.3 application data, one record per tls_record_size bytes
+        return self._chain('tls').encode_iov(data)
 
     def _tls_unwrap(self, data: bytes) -> bytes:
-        """Extract data from TLS-like wrapper"""
-        if len(data) < 5:
-            raise ValueError("Invalid TLS wrapper - too short")
-            
-        # Skip header (3 bytes) and length (2 bytes)
-        payload_length = struct.unpack('>H', data[3:5])[0]
-        
-        if len(data) < 5 + payload_length:
-            raise ValueError("Invalid TLS wrapper - payload truncated")
-            
-        return data[5:5+payload_length]
+        """Extract data from TLS-like records, buffering any partial record"""
+        return self._chain('tls').decode(data)
+
+    def _tls_unwrap_views(self, data: Union[bytes, bytearray, memoryview]) -> List[memoryview]:
+        """Payloads completed by this chunk, as views valid until the next chunk"""
+        return self._chain('tls').stages[0].decode(data)
 
     def _dns_mimic(self, data: bytes) -> bytes:
         """Make data look like DNS traffic"""
-        # DNS header (transaction ID + flags + 1 question)
-        header = b'\x00\x00'  # Transaction ID
-        header += b'\x01\x00'  # Flags (standard query)
-        header += b'\x00\x01'  # 1 question
-        header += b'\x00\x00'  # 0 answer RRs
-        header += b'\x00\x00'  # 0 authority RRs
-        header += b'\x00\x00'  # 0 additional RRs
-        
-        # Question section (for a fake A record query)
-        question = b'\x07example\x03com\x00'  # example.com
-        question += b'\x00\x01'  # Type A
-        question += b'\x00\x01'  # Class IN
-        
-        # Payload (our actual data)
-        max_payload = 512 - len(header) - len(question) - 2  # 2 bytes for length
-        payload = data[:max_payload]
-        
-        # Build final packet
-        return header + question + struct.pack('>H', len(payload)) + payload
+        return self._chain('dns').encode(data)
+
+    def _dns_packets(self, data: Union[bytes, bytearray, memoryview]) -> List[bytes]:
+        """Data split over as many DNS query packets as it needs, for datagram sends"""
+        # Every fragment of one message shares the DNS transaction ID
+        return self._chain('dns').encode_iov(data)
 
     def _dns_demimic(self, data: bytes) -> bytes:
-        """Extract data from DNS-like packet"""
-        # Skip DNS header (12 bytes) and question section (variable)
+        """Extract data from one or more DNS-like packets
+
+        Fragments are buffered until their message is complete, so this
+        returns b'' until the last missing fragment arrives.
+        """
         try:
-            # Find end of question name (null byte)
-            null_pos = data[12:].find(b'\x00')
-            if null_pos == -1:
-                raise ValueError("Invalid DNS mimic - no null terminator")
-                
-            # Question ends after null byte + 4 bytes (type and class)
-            question_end = 12 + null_pos + 5
-            
-            if len(data) < question_end + 2:
-                raise ValueError("Invalid DNS mimic - truncated")
-                
-            # Get payload length (2 bytes after question)
-            payload_len = struct.unpack('>H', data[question_end:question_end+2])[0]
-            
-            if len(data) < question_end + 2 + payload_len:
-                raise ValueError("Invalid DNS mimic - payload truncated")
-                
-            return data[question_end+2:question_end+2+payload_len]
+            return self._chain('dns').decode(data)
         except Exception as e:
             logger.error(f"DNS demimic failed: {e}")
             raise
 
+    def _set_key(self, key: bytes):
+        """Build the ciphers for key once; encrypt/decrypt reuse them"""
+        self.key = key
+        self.cipher = Fernet(key)
+        self.aead = AEADCipher(derive_aead_key(key), self.encryption) if self.encryption != 'fernet' else None
+
     def encrypt(self, data: bytes) -> bytes:
-        """Encrypt data with Fernet (AES-128-CBC)"""
+        """Encrypt data with Fernet (AES-128-CBC) or the configured AEAD"""
         try:
+            if self.aead is not None:
+                return self.aead.encrypt(data)
             return self.cipher.encrypt(data)
         except Exception as e:
             logger.error(f"Encryption failed: {e}")
             raise
 
     def decrypt(self, data: bytes) -> bytes:
-        """Decrypt Fernet-encrypted data"""
+        """Decrypt data produced by encrypt()"""
         try:
+            if self.aead is not None:
+                return self.aead.decrypt(data)
             return self.cipher.decrypt(data)
-        except InvalidToken as e:
+        except (InvalidToken, InvalidTag) as e:
             logger.error(f"Decryption failed - invalid token: {e}")
             raise
         except Exception as e:
@@ -195,6 +215,5 @@ class ClientObfuscator:
 
     def rotate_key(self):
         """Generate a new encryption key"""
-        self.key = Fernet.generate_key()
-        self.cipher = Fernet(self.key)
+        self._set_key(Fernet.generate_key())
         logger.info("Encryption key rotated")
\ No newline at end of file
@@ -4,7 +4,7 @@ import select
 from typing import Optional
 from client.protocol_switcher import ProtocolSwitcher
 from client.kill_switch import KillSwitch
-from client.obfuscation import Obfuscator
+from client.obfuscation import ClientObfuscator
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -16,7 +16,7 @@ class TunnelClient:
         self.protocol = protocol
         self.protocol_switcher = ProtocolSwitcher(server_ip, {})
         self.kill_switch = KillSwitch()
-        self.obfuscator = Obfuscator()
+        self.obfuscator = ClientObfuscator()
         self._running = False
         self._socket = None
         
@@ -70,7 +70,7 @@ class TunnelClient:
             data = client_socket.recv(4096)
             if data:
                 # Obfuscate and forward through tunnel
-                obfuscated = self.obfuscator.protocol_mimicry(data)
+                obfuscated = self.obfuscator.obfuscate(data)
                 self._socket.sendall(obfuscated)
                 
                 # Receive response and send back to client
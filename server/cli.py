@@ -1,5 +1,9 @@
 import click
 from server import WireGuardServer, OpenVPNServer, ShadowsocksServer, SOCKS5Server
+from server.dns_server import DNS_ENGINES, create_dns_server
+from server.dns_sharding import DNSShardSupervisor
+from server.doh_server import DOHServer
+from server.tcp_engine import DEFAULT_BACKLOG, OVERFLOW_POLICIES, TCP_ENGINES
 
 @click.group()
 def cli():
@@ -28,13 +32,54 @@ def openvpn(port, protocol):
 @cli.command()
 @click.option('--port', default=8388, help='Shadowsocks port')
 @click.option('--password', prompt=True, hide_input=True, help='Shadowsocks password')
-def shadowsocks(port, password):
+@click.option('--engine', default='threaded', type=click.Choice(TCP_ENGINES), help='Connection engine')
+@click.option('--backlog', default=DEFAULT_BACKLOG, help='Listen backlog')
+@click.option('--max-connections', default=1024, help='Connections handled at once')
+@click.option('--overflow', default='reject', type=click.Choice(OVERFLOW_POLICIES),
+              help='What to do with connections when all handlers are busy')
+@click.option('--udp/--no-udp', default=False, help='Also relay UDP on the same port')
+@click.option('--udp-timeout', default=60.0, help='Seconds before an idle UDP association is dropped')
+@click.option('--user', 'users', multiple=True, help='Additional user as name:password (repeatable)')
+def shadowsocks(port, password, engine, backlog, max_connections, overflow, udp, udp_timeout, users):
     """Start Shadowsocks server"""
-    with ShadowsocksServer(port=port, password=password) as ss:
+    extra_users = dict(user.split(':', 1) for user in users)
+    with ShadowsocksServer(port=port, password=password, engine=engine, backlog=backlog,
+                           max_connections=max_connections, overflow=overflow,
+                           udp=udp, udp_timeout=udp_timeout, users=extra_users) as ss:
         click.echo(f"Shadowsocks server started on port {port}")
         while True:
             pass
 
+@cli.command()
+@click.option('--port', default=53, help='DNS listen port')
+@click.option('--upstream', default='https://1.1.1.1/dns-query', help='DNS-over-HTTPS upstream URL')
+@click.option('--engine', default='threaded', type=click.Choice(DNS_ENGINES), help='Server engine')
+@click.option('--workers', default=1, help='Worker processes sharing the port (SO_REUSEPORT)')
+@click.option('--blocklist', multiple=True, help='Hosts or domain list file (repeatable)')
+def dns(port, upstream, engine, workers, blocklist):
+    """Start DNS-over-HTTPS forwarder"""
+    settings = dict(listen_port=port, upstream_dns=upstream, blocklist_paths=list(blocklist))
+    if workers > 1:
+        server = DNSShardSupervisor(workers=workers, engine=engine, hot_set_slots=4096, **settings)
+    else:
+        server = create_dns_server(engine=engine, **settings)
+    with server:
+        click.echo(f"DNS server started on port {port} ({engine} engine, {workers} workers)")
+        while True:
+            pass
+
+@cli.command()
+@click.option('--port', default=443, help='DoH listen port')
+@click.option('--upstream', default='https://1.1.1.1/dns-query', help='DNS-over-HTTPS upstream URL')
+@click.option('--cert', default=None, help='TLS certificate (PEM); plain HTTP if omitted')
+@click.option('--key', default=None, help='TLS private key (PEM)')
+def doh(port, upstream, cert, key):
+    """Start DNS-over-HTTPS endpoint"""
+    with DOHServer(port=port, upstream=upstream, certfile=cert, keyfile=key):
+        click.echo(f"DoH server started on port {port}")
+        while True:
+            pass
+
 if __name__ == '__main__':
     cli()
 
@@ -0,0 +1,299 @@
+import asyncio
+import struct
+import concurrent.futures
+import threading
+import logging
+from typing import Any, Dict, Optional, Set, Tuple
+
+from dnslib import DNSRecord
+from server.dns_server import DNSOverHTTPS
+from server.dns_singleflight import AsyncSingleFlight
+from server.dns_upstream import AsyncDoHClient, UpstreamError, UpstreamStats
+from server.dns_wire import QuestionKey, question_key, with_question_of
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class _DNSDatagramProtocol(asyncio.DatagramProtocol):
+    """Hands every received datagram to the owning server"""
+
+    def __init__(self, server: 'AsyncDNSOverHTTPS'):
+        self.server = server
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        self.server._dispatch(data, addr, self.transport)
+
+    def error_received(self, exc: Exception) -> None:
+        logger.error(f"Socket error in DNS protocol: {exc}")
+
+
+class AsyncDNSOverHTTPS(DNSOverHTTPS):
+    """DNS-over-HTTPS forwarder running on a single asyncio event loop
+
+    Drop-in alternative to the threaded DNSOverHTTPS: queries are handled
+    as tasks, so the number in flight is bounded by max_in_flight rather
+    than by the number of worker threads. Unlike the threaded resolver,
+    resolve() needs the server started, since it runs on the loop.
+    """
+
+    THREADED_UPSTREAM = False
+
+    def __init__(self, *args, max_in_flight: int = 4096, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_in_flight = max_in_flight
+        self.async_upstream = AsyncDoHClient(
+            pool_size=kwargs.get('pool_size') or max(self.max_workers, 100),
+            idle_timeout=kwargs.get('idle_timeout', 60.0)
+        )
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[threading.Thread] = None
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._tcp_server: Optional[asyncio.AbstractServer] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._tcp_tasks: Set[asyncio.Task] = set()
+        self._prefetch_tasks: Set[asyncio.Task] = set()
+        self.inflight = AsyncSingleFlight()
+        self.dropped = 0
+
+    def start(self) -> None:
+        """Start the DNS server on a background event loop"""
+        self._running = True
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        errors = []
+        self._loop_thread = threading.Thread(target=self._run_loop, args=(ready, errors))
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+        ready.wait()
+        if errors:
+            self._running = False
+            raise errors[0]
+
+        logger.info(f"DNS server started on port {self.listen_port} (asyncio engine)")
+
+    def _run_loop(self, ready: threading.Event, errors: list) -> None:
+        """Event loop thread: bind the endpoint and serve until stopped"""
+        loop = self._loop
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._open_endpoints())
+        except Exception as e:
+            errors.append(e)
+            ready.set()
+            loop.close()
+            return
+        ready.set()
+
+        try:
+            loop.run_forever()
+        finally:
+            self._transport.close()
+            if self._tcp_server is not None:
+                self._tcp_server.close()
+            tasks = self._tasks | self._prefetch_tasks | self._tcp_tasks
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.async_upstream.close()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+
+    async def _open_endpoints(self) -> None:
+        self._transport, _ = await self._loop.create_datagram_endpoint(
+            lambda: _DNSDatagramProtocol(self),
+            local_addr=('0.0.0.0', self.listen_port),
+            reuse_port=self.reuse_port or None
+        )
+        self.listen_port = self._transport.get_extra_info('sockname')[1]
+        if self.tcp:
+            self._tcp_server = await asyncio.start_server(
+                self._serve_tcp, '0.0.0.0', self.listen_port, backlog=128,
+                reuse_port=self.reuse_port or None)
+
+    def stop(self) -> None:
+        """Stop the event loop and release the socket"""
+        self._running = False
+        self._closed = True
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._loop_thread is not None:
+            self._loop_thread.join(timeout=5.0)
+            self._loop_thread = None
+        if self.blocklist is not None:
+            self.blocklist.close()
+        logger.info("DNS server stopped")
+
+    def resolve(self, data: bytes) -> Optional[bytes]:
+        """Answer a wire-format query from any thread via the running event loop"""
+        loop = self._loop
+        if loop is None or not loop.is_running():
+            raise RuntimeError("The asyncio engine resolves only while started")
+        future = asyncio.run_coroutine_threadsafe(self._handle_query_async(data), loop)
+        try:
+            # A hedged query may start its second request up to max_hedge_delay late
+            return future.result(self.timeout + self.upstreams.max_hedge_delay)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            logger.error("DNS query timed out")
+            return self._create_error_response()
+
+    def _dispatch(self, data: bytes, addr: Tuple[str, int],
+                  transport: asyncio.DatagramTransport) -> None:
+        """Answer from cache inline, otherwise schedule an upstream lookup"""
+        try:
+            cached = self._lookup_cache(question_key(data), data)
+        except Exception as e:
+            logger.debug(f"Cache lookup failed: {e}")
+            cached = None
+        if cached is not None:
+            transport.sendto(self._fit_udp(data, cached), addr)
+            return
+
+        if len(self._tasks) >= self.max_in_flight:
+            # Shed load instead of queueing without bound
+            self.dropped += 1
+            return
+        task = self._loop.create_task(self._serve(data, addr, transport))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _serve(self, data: bytes, addr: Tuple[str, int],
+                     transport: asyncio.DatagramTransport) -> None:
+        response = await self._handle_query_async(data)
+        if response and not transport.is_closing():
+            transport.sendto(self._fit_udp(data, response), addr)
+
+    async def _serve_tcp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Read length-prefixed queries; RFC 7766 pipelining answers them out of order"""
+        self._tcp_tasks.add(asyncio.current_task())
+        pending: Set[asyncio.Task] = set()
+        try:
+            if len(self._tcp_tasks) > self.max_tcp_connections:
+                return
+            while True:
+                # Only this coroutine drains, which keeps back-pressure single-waiter
+                await writer.drain()
+                header = await asyncio.wait_for(reader.readexactly(2), self.tcp_idle_timeout)
+                data = await reader.readexactly(struct.unpack('>H', header)[0])
+                task = self._loop.create_task(self._answer_tcp(data, writer))
+                pending.add(task)
+                self._tasks.add(task)
+                task.add_done_callback(pending.discard)
+                task.add_done_callback(self._tasks.discard)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            if pending:
+                await asyncio.wait(pending, timeout=self.timeout)
+            writer.close()
+            self._tcp_tasks.discard(asyncio.current_task())
+
+    async def _answer_tcp(self, data: bytes, writer: asyncio.StreamWriter) -> None:
+        response = await self._handle_query_async(data)
+        if response and not writer.is_closing():
+            writer.write(struct.pack('>H', len(response)) + response)
+
+    async def _handle_query_async(self, data: bytes) -> Optional[bytes]:
+        """Process a DNS query without blocking the event loop"""
+        try:
+            key = question_key(data)
+            cached = self._lookup_cache(key, data)
+            if cached is not None:
+                return cached
+
+            DNSRecord.parse(data)
+            if key is None:
+                return await self._resolve_upstream_async(key, data)
+            # Identical questions already in flight share one upstream request
+            response, shared = await self.inflight.do(
+                key, lambda: self._resolve_upstream_async(key, data))
+            if shared:
+                return with_question_of(response, data)
+            return response
+        except (UpstreamError, asyncio.TimeoutError) as e:
+            logger.error(f"DNS-over-HTTPS request failed: {e!r}")
+            return self._create_error_response()
+        except Exception as e:
+            logger.error(f"DNS query processing failed: {e}")
+            return self._create_error_response()
+
+    async def _resolve_upstream_async(self, key: Optional[QuestionKey], data: bytes) -> bytes:
+        """Forward a query to the best upstream, hedging to the next-best"""
+        ranked = self.upstreams.ranked()
+        if len(ranked) == 1:
+            content = await self._query_upstream_async(ranked[0], data)
+            return self._process_upstream_response(key, 200, content)
+
+        primary, backup = ranked[0], ranked[1]
+        first = asyncio.ensure_future(self._query_upstream_async(primary, data))
+        pending = {first}
+        winner, error = None, None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.upstreams.hedge_delay(primary))
+            winner, error = self._first_success(done)
+            if winner is None:
+                # Primary failed or is slower than usual: race the next-best
+                pending.add(asyncio.ensure_future(self._query_upstream_async(backup, data)))
+                deadline = self._loop.time() + self.timeout
+                while winner is None and pending:
+                    done, pending = await asyncio.wait(
+                        pending, timeout=max(deadline - self._loop.time(), 0),
+                        return_when=asyncio.FIRST_COMPLETED)
+                    if not done:
+                        break
+                    winner, error = self._first_success(done, error)
+                self.upstreams.record_hedge(won=winner is not None and winner is not first)
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if winner is None:
+            raise error or UpstreamError("No upstream answered in time")
+        return self._process_upstream_response(key, 200, winner.result())
+
+    async def _query_upstream_async(self, upstream: UpstreamStats, data: bytes) -> bytes:
+        """POST to one upstream, feeding its latency and error score"""
+        started = self._loop.time()
+        try:
+            status, content = await self.async_upstream.post(
+                upstream.url,
+                data=data,
+                timeout=self.timeout
+            )
+        except (UpstreamError, asyncio.TimeoutError):
+            self.upstreams.record_failure(upstream.url)
+            raise
+        if status != 200:
+            self.upstreams.record_failure(upstream.url)
+            raise UpstreamError(f"Upstream DNS error: {status}")
+        self.upstreams.record_success(upstream.url, self._loop.time() - started)
+        return content
+
+    def _launch_prefetch(self, key: QuestionKey, query: bytes) -> None:
+        # Cache hits happen on the loop thread, so a task can be created directly
+        task = self._loop.create_task(self._prefetch_async(key, query))
+        self._prefetch_tasks.add(task)
+        task.add_done_callback(self._prefetch_tasks.discard)
+
+    async def _prefetch_async(self, key: QuestionKey, query: bytes) -> None:
+        try:
+            await self.inflight.do(key, lambda: self._resolve_upstream_async(key, query))
+        except Exception as e:
+            logger.debug(f"Prefetch failed: {e!r}")
+            self._prefetch_done(failed=True)
+        else:
+            self._prefetch_done(failed=False)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Runtime counters for the resolver"""
+        stats = super().get_stats()
+        stats['upstream_pool'] = self.async_upstream.stats()
+        stats['in_flight'] = len(self._tasks)
+        stats['dropped'] = self.dropped
+        return stats
@@ -0,0 +1,263 @@
+import os
+import socket
+import threading
+import time
+import logging
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from server.dns_wire import (
+    QuestionKey,
+    RCODE_NOERROR,
+    RCODE_NXDOMAIN,
+    TYPE_A,
+    TYPE_AAAA,
+    build_response,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BLOCK_MODES = ('nxdomain', 'null')
+
+# Hosts-file addresses that mean "block this name"
+_SINK_ADDRESSES = {'0.0.0.0', '127.0.0.1', '::', '::1'}
+# Names every hosts file maps to loopback; never treat them as blocked
+_SYSTEM_NAMES = {'localhost', 'localhost.localdomain', 'local', 'broadcasthost',
+                 'ip6-localhost', 'ip6-loopback', 'ip6-localnet', 'ip6-mcastprefix',
+                 'ip6-allnodes', 'ip6-allrouters', 'ip6-allhosts', '0.0.0.0'}
+
+
+def wire_name(domain: str) -> bytes:
+    """Lowercased wire-format name, as found in a question key"""
+    domain = domain.strip().rstrip('.').lower()
+    if not domain.isascii():
+        # The IDNA codec is slow; only non-ASCII names need it
+        domain = domain.encode('idna').decode('ascii')
+    return (''.join([chr(len(label)) + label for label in domain.split('.') if label]) + '\0').encode()
+
+
+class _BloomFilter:
+    """Bit array with k probes derived from one 64-bit hash (double hashing)"""
+
+    def __init__(self, count: int, bits_per_entry: int):
+        size = 64
+        while size < count * bits_per_entry:
+            size <<= 1
+        self.mask = size - 1
+        self.probes = max(1, min(int(bits_per_entry * 0.69), 8))
+        self.bits = bytearray(size >> 3)
+
+    def add(self, digest: int) -> None:
+        step = (digest >> 32) | 1
+        for i in range(self.probes):
+            position = (digest + i * step) & self.mask
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest: int) -> bool:
+        bits, mask = self.bits, self.mask
+        step = (digest >> 32) | 1
+        for i in range(self.probes):
+            position = (digest + i * step) & mask
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class _Index:
+    """Immutable snapshot of the loaded lists; swapped whole on reload"""
+
+    __slots__ = ('buckets', 'bucket_mask', 'bloom', 'overrides', 'domains')
+
+    def __init__(self, hashes: List[array], bloom: Optional[_BloomFilter],
+                 overrides: Dict[bytes, Tuple[List[bytes], List[bytes]]], domains: int):
+        self.buckets = hashes
+        self.bucket_mask = len(hashes) - 1
+        self.bloom = bloom
+        self.overrides = overrides
+        self.domains = domains
+
+    def __contains__(self, digest: int) -> bool:
+        if self.bloom is not None and digest not in self.bloom:
+            return False
+        bucket = self.buckets[digest & self.bucket_mask]
+        position = bisect_left(bucket, digest)
+        return position < len(bucket) and bucket[position] == digest
+
+
+def _parse_line(line: str) -> Tuple[Optional[str], List[str]]:
+    """Split a hosts or blocklist line into (address or None, names)"""
+    line = line.split('#', 1)[0].strip()
+    if not line or line[0] in '![':
+        return None, []
+    fields = line.split()
+    if len(fields) == 1:
+        # Plain domain list, also accepting "||domain^" and "*.domain"
+        return None, [fields[0].strip('|^').lstrip('*.')]
+    return fields[0], fields[1:]
+
+
+class Blocklist:
+    """Local answers for blocked and overridden domains
+
+    Blocked domains (plain domain lists, or hosts entries pointing at
+    0.0.0.0/127.0.0.1) match the name and every subdomain; they are kept
+    only as 64-bit hashes of the wire-format name in sorted arrays split
+    into buckets, about 8 bytes per domain, with a Bloom filter in front
+    so most misses never touch the arrays. A lookup costs one probe per
+    label of the query name no matter how long the list is. Hosts
+    entries with any other address override that exact name.
+
+    Reloading builds a new index off to the side and swaps it in, so
+    queries are answered from the old lists until the new ones are ready.
+    """
+
+    def __init__(self,
+                 paths: Iterable[str] = (),
+                 block_mode: str = 'nxdomain',
+                 ttl: int = 300,
+                 bloom_bits_per_entry: int = 0,
+                 reload_interval: float = 0.0):
+        if block_mode not in BLOCK_MODES:
+            raise ValueError(f"Unknown block mode: {block_mode}")
+        self.paths = list(paths)
+        self.block_mode = block_mode
+        self.ttl = ttl
+        self.bloom_bits_per_entry = bloom_bits_per_entry
+        self.reload_interval = reload_interval
+        self.blocked = 0
+        self.overridden = 0
+        self.reloads = 0
+        self._mtimes: Dict[str, int] = {}
+        self._reload_lock = threading.Lock()
+        self._index = _Index([array('q')], None, {}, 0)
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+        self.reload()
+        if reload_interval > 0 and self.paths:
+            self._watcher = threading.Thread(target=self._watch_loop, name='blocklist-reload')
+            self._watcher.daemon = True
+            self._watcher.start()
+
+    def reload(self) -> None:
+        """Rebuild the index from the list files and swap it in"""
+        with self._reload_lock:
+            started = time.monotonic()
+            self._mtimes = {path: self._mtime(path) for path in self.paths}
+            self._index = self._build(self.paths)
+            self.reloads += 1
+        logger.info(f"Blocklist loaded {self._index.domains} domains and "
+                    f"{len(self._index.overrides)} overrides in {time.monotonic() - started:.2f}s")
+
+    @staticmethod
+    def _mtime(path: str) -> int:
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return 0
+
+    def _watch_loop(self) -> None:
+        """Reload whenever one of the files changes on disk"""
+        while not self._stop.wait(self.reload_interval):
+            if any(self._mtime(path) != mtime for path, mtime in self._mtimes.items()):
+                try:
+                    self.reload()
+                except Exception as e:
+                    logger.error(f"Blocklist reload failed, keeping previous lists: {e}")
+
+    def _build(self, paths: List[str]) -> _Index:
+        raw: List[array] = [array('q') for _ in range(256)]
+        overrides: Dict[bytes, Tuple[List[bytes], List[bytes]]] = {}
+        for path in paths:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    address, names = _parse_line(line)
+                    for name in names:
+                        if name in _SYSTEM_NAMES:
+                            continue
+                        try:
+                            wire = wire_name(name)
+                        except UnicodeError:
+                            continue
+                        if address is None or address in _SINK_ADDRESSES:
+                            digest = hash(wire)
+                            raw[digest & 0xFF].append(digest)
+                        else:
+                            self._add_override(overrides, wire, address)
+
+        # Sort bucket by bucket so the transient list of ints stays small
+        buckets = [array('q', sorted(set(bucket))) for bucket in raw]
+        del raw
+        domains = sum(len(bucket) for bucket in buckets)
+
+        bloom = None
+        if self.bloom_bits_per_entry > 0 and domains:
+            bloom = _BloomFilter(domains, self.bloom_bits_per_entry)
+            for bucket in buckets:
+                for digest in bucket:
+                    bloom.add(digest)
+        return _Index(buckets, bloom, overrides, domains)
+
+    @staticmethod
+    def _add_override(overrides, wire: bytes, address: str) -> None:
+        ipv4, ipv6 = overrides.setdefault(wire, ([], []))
+        try:
+            if ':' in address:
+                ipv6.append(socket.inet_pton(socket.AF_INET6, address))
+            else:
+                ipv4.append(socket.inet_pton(socket.AF_INET, address))
+        except OSError:
+            logger.warning(f"Ignoring invalid hosts address {address}")
+
+    def is_blocked(self, qname: bytes) -> bool:
+        """Whether a wire-format name or any of its parents is blocked"""
+        index = self._index
+        if not index.domains:
+            return False
+        offset = 0
+        while True:
+            length = qname[offset]
+            if length == 0 or length & 0xC0:
+                return False
+            if hash(qname[offset:]) in index:
+                return True
+            offset += length + 1
+
+    def answer(self, key: QuestionKey, query: bytes) -> Optional[bytes]:
+        """A local response for the query, or None to resolve it normally"""
+        qname, qtype, _ = key
+        index = self._index
+        override = index.overrides.get(qname) if index.overrides else None
+        if override is not None:
+            self.overridden += 1
+            rdatas = override[0] if qtype == TYPE_A else override[1] if qtype == TYPE_AAAA else []
+            return build_response(query, RCODE_NOERROR, qtype, rdatas, self.ttl)
+        if not self.is_blocked(qname):
+            return None
+
+        self.blocked += 1
+        if self.block_mode == 'nxdomain':
+            return build_response(query, RCODE_NXDOMAIN)
+        rdatas = [bytes(4)] if qtype == TYPE_A else [bytes(16)] if qtype == TYPE_AAAA else []
+        return build_response(query, RCODE_NOERROR, qtype, rdatas, self.ttl)
+
+    def stats(self):
+        """Sizes of the loaded lists and match counters"""
+        index = self._index
+        return {
+            'domains': index.domains,
+            'overrides': len(index.overrides),
+            'bytes': sum(bucket.itemsize * len(bucket) for bucket in index.buckets)
+                     + (len(index.bloom.bits) if index.bloom is not None else 0),
+            'blocked': self.blocked,
+            'overridden': self.overridden,
+            'reloads': self.reloads,
+        }
+
+    def close(self) -> None:
+        """Stop watching the list files"""
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join(timeout=1.0)
+            self._watcher = None
@@ -0,0 +1,316 @@
+import hashlib
+import struct
+import threading
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from server.dns_wire import (
+    HEADER,
+    QuestionKey,
+    RCODE_NOERROR,
+    RCODE_NXDOMAIN,
+    ResponseInfo,
+    scan_response,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def cacheable_ttl(info: ResponseInfo, max_ttl: int, max_negative_ttl: int) -> Optional[int]:
+    """How long a scanned response may be cached, or None if it must not be"""
+    if info.truncated:
+        return None
+    if info.rcode == RCODE_NXDOMAIN or (info.rcode == RCODE_NOERROR and info.answer_count == 0):
+        # Negative answers are only cacheable with an SOA in authority
+        if info.negative_ttl is None:
+            return None
+        ttl = min(info.negative_ttl, max_negative_ttl)
+    elif info.rcode == RCODE_NOERROR:
+        ttl = min(info.min_ttl, max_ttl)
+    else:
+        return None
+    return ttl if ttl > 0 else None
+
+
+def _rewrite(response: bytes, ttl_fields: List[Tuple[int, int]], elapsed: int, txid: int,
+             qname: Optional[bytes] = None) -> bytes:
+    """Copy a stored response with the given ID and TTLs aged by elapsed
+
+    qname, the question name exactly as the asker wrote it, replaces the
+    stored one: keys are lowercased, but resolvers randomising the case
+    of their queries (DNS 0x20) reject answers that do not echo it.
+    """
+    rewritten = bytearray(response)
+    struct.pack_into('>H', rewritten, 0, txid)
+    if qname is not None:
+        rewritten[HEADER.size:HEADER.size + len(qname)] = qname
+    for offset, ttl in ttl_fields:
+        struct.pack_into('>I', rewritten, offset, max(ttl - elapsed, 0))
+    return bytes(rewritten)
+
+
+class _CacheEntry:
+    __slots__ = ('response', 'ttl_fields', 'stored_at', 'expires_at', 'ttl', 'size',
+                 'hits', 'refreshing')
+
+    def __init__(self, response: bytes, ttl_fields: List[Tuple[int, int]],
+                 stored_at: float, ttl: int):
+        self.response = response
+        self.ttl_fields = ttl_fields
+        self.stored_at = stored_at
+        self.expires_at = stored_at + ttl
+        self.ttl = ttl
+        self.size = len(response)
+        self.hits = 0
+        self.refreshing = False
+
+
+class DNSCache:
+    """Thread-safe LRU cache of upstream DNS responses honouring record TTLs
+
+    When on_refresh is set, an entry that has been hit at least
+    prefetch_threshold times and is within the last prefetch_window
+    fraction of its TTL is handed to on_refresh once so it can be
+    re-resolved before it expires. on_refresh returns False to decline.
+    """
+
+    def __init__(self,
+                 max_entries: int = 10000,
+                 max_bytes: int = 16 * 1024 * 1024,
+                 max_ttl: int = 86400,
+                 max_negative_ttl: int = 3600,
+                 prefetch_threshold: int = 0,
+                 prefetch_window: float = 0.1,
+                 on_refresh: Optional[Callable[[QuestionKey], bool]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        if max_entries <= 0 or max_bytes <= 0:
+            raise ValueError("Cache limits must be positive")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self.max_negative_ttl = max_negative_ttl
+        self.prefetch_threshold = prefetch_threshold
+        self.prefetch_window = prefetch_window
+        self.on_refresh = on_refresh
+        self._clock = clock
+        self._entries: 'OrderedDict[QuestionKey, _CacheEntry]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: QuestionKey, txid: int, qname: Optional[bytes] = None) -> Optional[bytes]:
+        """Return a cached response with decremented TTLs, the given ID and qname's casing"""
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires_at <= now:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            entry.hits += 1
+            refresh = (self.on_refresh is not None
+                       and self.prefetch_threshold > 0
+                       and not entry.refreshing
+                       and entry.hits >= self.prefetch_threshold
+                       and entry.expires_at - now <= entry.ttl * self.prefetch_window)
+            if refresh:
+                entry.refreshing = True
+
+        if refresh and not self.on_refresh(key):
+            # Declined (e.g. over budget); a later hit may try again
+            entry.refreshing = False
+
+        return _rewrite(entry.response, entry.ttl_fields, int(now - entry.stored_at), txid, qname)
+
+    def put(self, key: QuestionKey, response: bytes) -> bool:
+        """Cache an upstream response; returns False if it is not cacheable"""
+        try:
+            info = scan_response(response)
+        except (ValueError, IndexError, struct.error) as e:
+            logger.debug(f"Not caching unparseable response: {e}")
+            return False
+
+        ttl = cacheable_ttl(info, self.max_ttl, self.max_negative_ttl)
+        if ttl is None or len(response) > self.max_bytes:
+            return False
+
+        entry = _CacheEntry(response, info.ttl_fields, self._clock(), ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def _remove(self, key: QuestionKey) -> None:
+        """Drop an entry; caller must hold the lock"""
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def clear(self) -> None:
+        """Remove every cached entry"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Counters for sizing the cache"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SharedHotSet:
+    """Fixed-size response cache in shared memory, shared by worker processes
+
+    Direct-mapped: each key hashes to one slot and a newer answer simply
+    replaces whatever was there. Writers serialise on a process-shared
+    lock; readers are lock-free and use the slot sequence number to detect
+    torn reads (a seqlock), treating them as misses.
+    """
+
+    SLOT_HEADER = struct.Struct('<IddQHH')  # seq, expires, stored, key hash, key len, response len
+    SLOT_FIELDS = struct.Struct('<ddQHH')  # the header after seq, written before seq is published
+
+    def __init__(self, slots: int = 4096, slot_size: int = 1024,
+                 max_ttl: int = 86400, max_negative_ttl: int = 3600, lock: Any = None):
+        from multiprocessing import Lock, shared_memory
+
+        if slots <= 0 or slot_size <= self.SLOT_HEADER.size:
+            raise ValueError("Invalid hot-set geometry")
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_ttl = max_ttl
+        self.max_negative_ttl = max_negative_ttl
+        self._lock = lock or Lock()
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        self._owner = True
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def __getstate__(self):
+        return {
+            'name': self._shm.name,
+            'slots': self.slots,
+            'slot_size': self.slot_size,
+            'max_ttl': self.max_ttl,
+            'max_negative_ttl': self.max_negative_ttl,
+            'lock': self._lock,
+        }
+
+    def __setstate__(self, state):
+        from multiprocessing import shared_memory
+
+        self.slots = state['slots']
+        self.slot_size = state['slot_size']
+        self.max_ttl = state['max_ttl']
+        self.max_negative_ttl = state['max_negative_ttl']
+        self._lock = state['lock']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @staticmethod
+    def _encode_key(key: QuestionKey) -> bytes:
+        qname, qtype, qclass = key
+        return qname + struct.pack('>HH', qtype, qclass)
+
+    def _locate(self, encoded_key: bytes) -> Tuple[int, int]:
+        # Python's hash() is salted per process, so use a stable digest
+        digest = int.from_bytes(hashlib.blake2b(encoded_key, digest_size=8).digest(), 'little')
+        return digest, (digest % self.slots) * self.slot_size
+
+    def get(self, key: QuestionKey, txid: int, qname: Optional[bytes] = None) -> Optional[bytes]:
+        """Return a shared response with aged TTLs, the given ID and qname's casing"""
+        encoded_key = self._encode_key(key)
+        digest, base = self._locate(encoded_key)
+        buf = self._shm.buf
+        header = self.SLOT_HEADER.unpack_from(buf, base)
+        seq, expires, stored, slot_digest, key_len, response_len = header
+        now = time.time()
+        if (seq & 1 or slot_digest != digest or expires <= now
+                or self.SLOT_HEADER.size + key_len + response_len > self.slot_size):
+            self.misses += 1
+            return None
+
+        start = base + self.SLOT_HEADER.size
+        payload = bytes(buf[start:start + key_len + response_len])
+        if (self.SLOT_HEADER.unpack_from(buf, base) != header
+                or len(payload) != key_len + response_len or payload[:key_len] != encoded_key):
+            # Torn read or a colliding key
+            self.misses += 1
+            return None
+
+        response = payload[key_len:]
+        try:
+            info = scan_response(response)
+        except (ValueError, IndexError, struct.error):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return _rewrite(response, info.ttl_fields, int(now - stored), txid, qname)
+
+    def put(self, key: QuestionKey, response: bytes) -> bool:
+        """Publish a response to every worker; returns False if not stored"""
+        encoded_key = self._encode_key(key)
+        if self.SLOT_HEADER.size + len(encoded_key) + len(response) > self.slot_size:
+            return False
+        try:
+            ttl = cacheable_ttl(scan_response(response), self.max_ttl, self.max_negative_ttl)
+        except (ValueError, IndexError, struct.error):
+            return False
+        if ttl is None:
+            return False
+
+        digest, base = self._locate(encoded_key)
+        buf = self._shm.buf
+        now = time.time()
+        with self._lock:
+            seq = struct.unpack_from('<I', buf, base)[0]
+            struct.pack_into('<I', buf, base, (seq + 1) & 0xFFFFFFFF)
+            start = base + self.SLOT_HEADER.size
+            buf[start:start + len(encoded_key)] = encoded_key
+            buf[start + len(encoded_key):start + len(encoded_key) + len(response)] = response
+            self.SLOT_FIELDS.pack_into(buf, base + 4, now + ttl, now, digest,
+                                       len(encoded_key), len(response))
+            # Publish last, so an even seq never goes with a half-written header
+            struct.pack_into('<I', buf, base, (seq + 2) & 0xFFFFFFFF)
+        self.stores += 1
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        """Per-process hot-set counters"""
+        return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores}
+
+    def close(self) -> None:
+        """Detach from the shared segment, removing it if this is the owner"""
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
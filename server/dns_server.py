@@ -1,40 +1,214 @@
 import socket
+import struct
 import requests
 import threading
+import time
 import logging 
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from dnslib import DNSRecord, DNSHeader, DNSQuestion, RR, A
-from typing import Tuple, Optional
-from urllib.parse import quote
+from typing import Tuple, Optional, Dict, Any, List, Union
+from urllib.parse import quote, urlsplit
 from cryptography.x509 import load_pem_x509_certificate
 from cryptography.hazmat.backends import default_backend
+from server.dns_blocklist import Blocklist
+from server.dns_cache import DNSCache, SharedHotSet
+from server.dns_singleflight import SingleFlight
+from server.dns_upstream import UpstreamError, UpstreamSelector, UpstreamSessionPool, UpstreamStats
+from server.dns_wire import (
+    HEADER,
+    QuestionKey,
+    build_query,
+    edns_payload_size,
+    question_key,
+    transaction_id,
+    truncate_response,
+    with_question_of,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+LOOPBACK_HOSTS = ('127.0.0.1', '::1', 'localhost')
+
+class _TokenBucket:
+    """Rate limiter refilled continuously at rate tokens per second"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def take(self) -> bool:
+        """Consume one token if available (caller serialises access)"""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+class _TCPConnection:
+    """A DNS-over-TCP client with outstanding pipelined queries"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._write_lock = threading.Lock()
+        self._pending = 0
+        self._idle = threading.Condition()
+
+    def recv_exact(self, size: int) -> Optional[bytes]:
+        """Read exactly size bytes, or None if the peer closed first"""
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            count = self.sock.recv_into(view[received:])
+            if not count:
+                return None
+            received += count
+        return bytes(buffer)
+
+    def send(self, message: bytes) -> None:
+        with self._write_lock:
+            self.sock.sendall(message)
+
+    def begin(self) -> None:
+        with self._idle:
+            self._pending += 1
+
+    def end(self) -> None:
+        with self._idle:
+            self._pending -= 1
+            self._idle.notify_all()
+
+    def drain(self, timeout: float) -> None:
+        """Wait until every outstanding query has been answered"""
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def abort(self) -> None:
+        """Wake a blocked reader so the connection can be torn down"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def close(self) -> None:
+        self.sock.close()
+
 class DNSOverHTTPS:
+    POLL_INTERVAL = 0.2
+    # Subclasses with their own upstream client skip the session pool and threads
+    THREADED_UPSTREAM = True
+
     def __init__(self, 
                  listen_port: int = 53,
-                 upstream_dns: str = "https://1.1.1.1/dns-query",
+                 upstream_dns: Union[str, List[str]] = "https://1.1.1.1/dns-query",
                  timeout: float = 5.0,
-                 max_workers: int = 10):
-        self.upstream_dns = upstream_dns
+                 max_workers: int = 10,
+                 cache_size: int = 10000,
+                 pool_size: Optional[int] = None,
+                 idle_timeout: float = 60.0,
+                 http2: bool = False,
+                 hedge_percentile: float = 0.95,
+                 max_hedge_delay: float = 1.0,
+                 prefetch_threshold: int = 10,
+                 prefetch_budget: int = 4,
+                 prefetch_rate: float = 50.0,
+                 tcp: bool = True,
+                 tcp_idle_timeout: float = 10.0,
+                 max_tcp_connections: int = 256,
+                 max_udp_payload: int = 1232,
+                 reuse_port: bool = False,
+                 shared_cache: Optional[SharedHotSet] = None,
+                 blocklist_paths: Optional[List[str]] = None,
+                 block_mode: str = 'nxdomain',
+                 blocklist_reload_interval: float = 30.0):
+        self.upstream_urls = [upstream_dns] if isinstance(upstream_dns, str) else list(upstream_dns)
+        self.upstream_dns = self.upstream_urls[0] if self.upstream_urls else None
         self.listen_port = listen_port
         self.timeout = timeout
         self.max_workers = max_workers
+        self.tcp = tcp
+        self.tcp_idle_timeout = tcp_idle_timeout
+        self.max_tcp_connections = max_tcp_connections
+        # Cap what clients may ask for (DNS Flag Day 2020 suggests 1232)
+        self.max_udp_payload = max_udp_payload
+        # Lets several processes bind the same port; the kernel load-balances
+        self.reuse_port = reuse_port
+        self.shared_cache = shared_cache
+        # Blocked and overridden names are answered without going upstream
+        self.blocklist = Blocklist(
+            blocklist_paths,
+            block_mode=block_mode,
+            reload_interval=blocklist_reload_interval
+        ) if blocklist_paths else None
+        self._tcp_connections = set()
+        self._tcp_lock = threading.Lock()
+        self._tcp_executor = None
+        self.prefetch_budget = prefetch_budget
+        self.cache = DNSCache(
+            max_entries=cache_size,
+            prefetch_threshold=prefetch_threshold,
+            on_refresh=self._schedule_prefetch
+        ) if cache_size > 0 else None
+        self._prefetch_tokens = _TokenBucket(rate=prefetch_rate, burst=max(prefetch_budget, 1))
+        self._prefetch_lock = threading.Lock()
+        self._prefetching = 0
+        self.prefetch_stats = {'issued': 0, 'skipped': 0, 'failed': 0}
+        self._prefetch_executor = ThreadPoolExecutor(
+            max_workers=prefetch_budget,
+            thread_name_prefix='dns-prefetch'
+        ) if (self.THREADED_UPSTREAM and cache_size > 0 and prefetch_threshold > 0
+              and prefetch_budget > 0) else None
+        self.inflight = SingleFlight()
         self._running = False
+        # Set by stop(); resolve() may be used without start()
+        self._closed = False
         self._thread_pool = []
         self._validate_upstream()
+        self.upstreams = UpstreamSelector(
+            self.upstream_urls,
+            hedge_percentile=hedge_percentile,
+            max_hedge_delay=max_hedge_delay
+        )
+        hedging = len(self.upstream_urls) > 1
+        self.upstream_pool = UpstreamSessionPool(
+            # A hedged query can hold two upstream connections at once
+            pool_size=pool_size or (max_workers * 2 if hedging else max_workers),
+            idle_timeout=idle_timeout,
+            http2=http2,
+            max_hosts=max(4, len(self.upstream_urls))
+        ) if self.THREADED_UPSTREAM else None
+        self._hedge_executor = ThreadPoolExecutor(
+            max_workers=max_workers * 2,
+            thread_name_prefix='doh-upstream'
+        ) if self.THREADED_UPSTREAM and hedging else None
 
     def _validate_upstream(self):
-        """Validate the upstream DNS server URL"""
-        if not (self.upstream_dns.startswith('https://') and '/dns-query' in self.upstream_dns):
-            raise ValueError("Invalid upstream DNS URL - must be HTTPS with /dns-query path")
+        """Validate the upstream DNS server URLs"""
+        if not self.upstream_urls:
+            raise ValueError("At least one upstream DNS URL is required")
+        for url in self.upstream_urls:
+            parsed = urlsplit(url)
+            # Plain HTTP is only accepted for a local stand-in upstream
+            secure = parsed.scheme == 'https' or (
+                parsed.scheme == 'http' and parsed.hostname in LOOPBACK_HOSTS)
+            if not (secure and '/dns-query' in parsed.path):
+                raise ValueError("Invalid upstream DNS URL - must be HTTPS with /dns-query path")
 
     def start(self) -> None:
         """Start the DNS server with threaded workers"""
         self._running = True
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.reuse_port:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._socket.bind(('0.0.0.0', self.listen_port))
+        self.listen_port = self._socket.getsockname()[1]
+        # Closing the socket does not wake recvfrom, so poll for shutdown
+        self._socket.settimeout(self.POLL_INTERVAL)
         
         logger.info(f"DNS server started on port {self.listen_port}")
         
@@ -45,57 +219,159 @@ class DNSOverHTTPS:
             thread.start()
             self._thread_pool.append(thread)
 
+        if self.tcp:
+            self._start_tcp()
+
+    def _start_tcp(self) -> None:
+        """Listen for DNS over TCP on the same port as UDP"""
+        self._tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self._tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._tcp_socket.bind(('0.0.0.0', self.listen_port))
+        self._tcp_socket.listen(128)
+        self._tcp_socket.settimeout(self.POLL_INTERVAL)
+        self._tcp_executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix='dns-tcp'
+        )
+
+        acceptor = threading.Thread(target=self._tcp_accept_loop)
+        acceptor.daemon = True
+        acceptor.start()
+        self._thread_pool.append(acceptor)
+
     def stop(self) -> None:
         """Stop the DNS server and clean up threads"""
         self._running = False
+        self._closed = True
         if hasattr(self, '_socket'):
             self._socket.close()
+        if hasattr(self, '_tcp_socket'):
+            self._tcp_socket.close()
+        with self._tcp_lock:
+            connections = list(self._tcp_connections)
+        for connection in connections:
+            connection.abort()
 
         for thread in self._thread_pool:
             thread.join(timeout=1.0)
 
+        if self._tcp_executor is not None:
+            self._tcp_executor.shutdown(wait=False)
+
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+        if self._prefetch_executor is not None:
+            self._prefetch_executor.shutdown(wait=False)
+        if self.blocklist is not None:
+            self.blocklist.close()
+        if self.upstream_pool is not None:
+            self.upstream_pool.close()
         logger.info("DNS server stopped")
 
     def _worker_loop(self) -> None:
         """Worker thread processing DNS queries"""
         while self._running:
             try:
-                data, addr = self._socket.recvfrom(1024)
+                data, addr = self._socket.recvfrom(65535)
                 if data:
                     response = self._handle_query(data)
                     if response:
-                        self._socket.sendto(response, addr)
+                        self._socket.sendto(self._fit_udp(data, response), addr)
+            except socket.timeout:
+                continue
             except socket.error as e:
                 if self._running:
                     logger.error(f"Socket error in worker: {e}")
             except Exception as e:
                 logger.error(f"Unexpected error in worker: {e}")
 
+    def _fit_udp(self, query: bytes, response: bytes) -> bytes:
+        """Truncate a response (setting TC) to the client's EDNS0 payload size"""
+        return truncate_response(response, min(edns_payload_size(query), self.max_udp_payload))
+
+    def _tcp_accept_loop(self) -> None:
+        """Accept DNS-over-TCP clients"""
+        while self._running:
+            try:
+                client_socket, address = self._tcp_socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                if self._running:
+                    logger.error(f"TCP accept error: {e}")
+                continue
+
+            with self._tcp_lock:
+                if len(self._tcp_connections) >= self.max_tcp_connections:
+                    client_socket.close()
+                    continue
+                connection = _TCPConnection(client_socket)
+                self._tcp_connections.add(connection)
+            client_socket.settimeout(self.tcp_idle_timeout)
+            reader = threading.Thread(target=self._tcp_connection_loop, args=(connection,))
+            reader.daemon = True
+            reader.start()
+
+    def _tcp_connection_loop(self, connection: '_TCPConnection') -> None:
+        """Read length-prefixed queries; RFC 7766 pipelining answers them out of order"""
+        try:
+            while self._running:
+                header = connection.recv_exact(2)
+                if header is None:
+                    break
+                data = connection.recv_exact(struct.unpack('>H', header)[0])
+                if data is None:
+                    break
+                connection.begin()
+                try:
+                    self._tcp_executor.submit(self._answer_tcp, connection, data)
+                except RuntimeError:
+                    # Executor already shut down by stop()
+                    connection.end()
+                    raise
+        except (socket.timeout, socket.error, RuntimeError):
+            pass
+        finally:
+            # Let answers to queries already read go out before closing
+            connection.drain(timeout=self.timeout)
+            connection.close()
+            with self._tcp_lock:
+                self._tcp_connections.discard(connection)
+
+    def _answer_tcp(self, connection: '_TCPConnection', data: bytes) -> None:
+        try:
+            response = self._handle_query(data)
+            if response:
+                connection.send(struct.pack('>H', len(response)) + response)
+        except socket.error:
+            pass
+        finally:
+            connection.end()
+
+    def resolve(self, data: bytes) -> Optional[bytes]:
+        """Answer a wire-format query from the cache or upstreams (no listener needed)"""
+        return self._handle_query(data)
+
     def _handle_query(self, data: bytes) -> Optional[bytes]:
         """Process a DNS query"""
         try:
+            key = question_key(data)
+            cached = self._lookup_cache(key, data)
+            if cached is not None:
+                return cached
+
             request = DNSRecord.parse(data)
             qname = str(request.q.qname)
-            
-            # Forward to DNS-over-HTTPS with proper headers
-            headers = {
-                'accept': 'application/dns-message',
-                'content-type': 'application/dns-message'
-            }
-            
-            # Use POST instead of GET for better compatibility
-            response = requests.post(
-                self.upstream_dns,
-                headers=headers,
-                data=data,
-                timeout=self.timeout
-            )
-            
-            if response.status_code == 200:
-                return response.content
-            else:
-                logger.warning(f"Upstream DNS error: {response.status_code}")
-                return self._create_error_response()
+
+            if key is None:
+                return self._resolve_upstream(key, data)
+            # Identical questions already in flight share one upstream request
+            response, shared = self.inflight.do(key, lambda: self._resolve_upstream(key, data))
+            if shared:
+                return with_question_of(response, data)
+            return response
         except requests.RequestException as e:
             logger.error(f"DNS-over-HTTPS request failed: {e}")
             return self._create_error_response()
@@ -103,11 +379,143 @@ class DNSOverHTTPS:
             logger.error(f"DNS query processing failed: {e}")
             return self._create_error_response()
 
+    def _resolve_upstream(self, key: Optional[QuestionKey], data: bytes) -> bytes:
+        """Forward a query to the best upstream, hedging to the next-best"""
+        ranked = self.upstreams.ranked()
+        if self._hedge_executor is None:
+            response = self._query_upstream(ranked[0], data)
+            return self._process_upstream_response(key, response.status_code, response.content)
+
+        primary, backup = ranked[0], ranked[1]
+        first = self._hedge_executor.submit(self._query_upstream, primary, data)
+        done, pending = wait([first], timeout=self.upstreams.hedge_delay(primary))
+        winner, error = self._first_success(done)
+        if winner is None:
+            # Primary failed or is slower than usual: race the next-best
+            pending.add(self._hedge_executor.submit(self._query_upstream, backup, data))
+            deadline = time.monotonic() + self.timeout
+            while winner is None and pending:
+                done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0),
+                                     return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                winner, error = self._first_success(done, error)
+            self.upstreams.record_hedge(won=winner is not None and winner is not first)
+
+        if winner is None:
+            raise error or UpstreamError("No upstream answered in time")
+        response = winner.result()
+        return self._process_upstream_response(key, response.status_code, response.content)
+
+    @staticmethod
+    def _first_success(done, error: Optional[Exception] = None):
+        """Pick the future of a successful upstream request, if any"""
+        for future in done:
+            if future.exception() is None:
+                return future, error
+            error = future.exception()
+        return None, error
+
+    def _query_upstream(self, upstream: UpstreamStats, data: bytes):
+        """POST to one upstream, feeding its latency and error score"""
+        started = time.monotonic()
+        try:
+            # Use POST instead of GET for better compatibility, over a
+            # pooled keep-alive session with DoH headers already set
+            response = self.upstream_pool.post(
+                upstream.url,
+                data=data,
+                timeout=self.timeout
+            )
+        except requests.RequestException:
+            self.upstreams.record_failure(upstream.url)
+            raise
+        if response.status_code != 200:
+            self.upstreams.record_failure(upstream.url)
+            raise UpstreamError(f"Upstream DNS error: {response.status_code}")
+        self.upstreams.record_success(upstream.url, time.monotonic() - started)
+        return response
+
+    def _schedule_prefetch(self, key: QuestionKey) -> bool:
+        """Cache callback: re-resolve a hot entry shortly before it expires"""
+        with self._prefetch_lock:
+            if (self._closed or self._prefetching >= self.prefetch_budget
+                    or not self._prefetch_tokens.take()):
+                self.prefetch_stats['skipped'] += 1
+                return False
+            self._prefetching += 1
+            self.prefetch_stats['issued'] += 1
+        self._launch_prefetch(key, build_query(key))
+        return True
+
+    def _launch_prefetch(self, key: QuestionKey, query: bytes) -> None:
+        self._prefetch_executor.submit(self._prefetch, key, query)
+
+    def _prefetch(self, key: QuestionKey, query: bytes) -> None:
+        try:
+            # Shares the upstream request with any client miss racing it
+            self.inflight.do(key, lambda: self._resolve_upstream(key, query))
+        except Exception as e:
+            logger.debug(f"Prefetch failed: {e}")
+            self._prefetch_done(failed=True)
+        else:
+            self._prefetch_done(failed=False)
+
+    def _prefetch_done(self, failed: bool) -> None:
+        with self._prefetch_lock:
+            self._prefetching -= 1
+            if failed:
+                self.prefetch_stats['failed'] += 1
+
+    def _lookup_cache(self, key: Optional[QuestionKey], data: bytes) -> Optional[bytes]:
+        """Return a local or cached answer for the query, if any"""
+        if key is None:
+            return None
+        if self.blocklist is not None:
+            local = self.blocklist.answer(key, data)
+            if local is not None:
+                return local
+        if self.cache is None:
+            return None
+        txid = transaction_id(data)
+        qname = data[HEADER.size:HEADER.size + len(key[0])]  # as the client cased it
+        cached = self.cache.get(key, txid, qname)
+        if cached is None and self.shared_cache is not None:
+            # Another worker process may have resolved it already
+            cached = self.shared_cache.get(key, txid, qname)
+            if cached is not None:
+                self.cache.put(key, cached)
+        return cached
+
+    def _process_upstream_response(self, key: Optional[QuestionKey],
+                                   status_code: int, content: bytes) -> bytes:
+        """Cache a successful upstream answer or turn a failure into SERVFAIL"""
+        if status_code == 200:
+            if key is not None and self.cache is not None:
+                self.cache.put(key, content)
+                if self.shared_cache is not None:
+                    self.shared_cache.put(key, content)
+            return content
+        logger.warning(f"Upstream DNS error: {status_code}")
+        return self._create_error_response()
+
     def _create_error_response(self) -> bytes:
         """Create a SERVFAIL DNS response"""
         response = DNSRecord(DNSHeader(id=0, qr=1, rcode=2), q=DNSQuestion("error."))
         return response.pack()
 
+    def get_stats(self) -> Dict[str, Any]:
+        """Runtime counters for the resolver"""
+        return {
+            'cache': self.cache.stats() if self.cache is not None else None,
+            'upstream_pool': self.upstream_pool.stats() if self.upstream_pool is not None else None,
+            'inflight': self.inflight.stats(),
+            'upstreams': self.upstreams.snapshot(),
+            'prefetch': dict(self.prefetch_stats, in_flight=self._prefetching),
+            'shared_cache': self.shared_cache.stats() if self.shared_cache is not None else None,
+            'blocklist': self.blocklist.stats() if self.blocklist is not None else None,
+        }
+
     def __enter__(self):
         """Context manager support"""
         self.start()
@@ -116,3 +524,34 @@ class DNSOverHTTPS:
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Ensure cleanup on exit"""
         self.stop()
+
+DNS_ENGINES = ('threaded', 'asyncio')
+
+def create_dns_server(engine: str = 'threaded', **kwargs) -> DNSOverHTTPS:
+    """Build a DNS server on the requested engine ('threaded' or 'asyncio')"""
+    if engine == 'threaded':
+        return DNSOverHTTPS(**kwargs)
+    if engine == 'asyncio':
+        from server.dns_async import AsyncDNSOverHTTPS
+        return AsyncDNSOverHTTPS(**kwargs)
+    raise ValueError(f"Invalid engine. Must be one of {list(DNS_ENGINES)}")
+
+if __name__ == "__main__":
+    import os
+    import time
+
+    settings = dict(
+        engine=os.environ.get('DNS_ENGINE', 'threaded'),
+        listen_port=int(os.environ.get('DNS_PORT', 53)),
+        upstream_dns=os.environ.get('DNS_UPSTREAM', "https://1.1.1.1/dns-query"),
+        blocklist_paths=[path for path in os.environ.get('DNS_BLOCKLIST', '').split(',') if path]
+    )
+    workers = int(os.environ.get('DNS_WORKERS', 1))
+    if workers > 1:
+        from server.dns_sharding import DNSShardSupervisor
+        server = DNSShardSupervisor(workers=workers, hot_set_slots=4096, **settings)
+    else:
+        server = create_dns_server(**settings)
+    with server:
+        while True:
+            time.sleep(60)
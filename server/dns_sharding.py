@@ -0,0 +1,232 @@
+import os
+import socket
+import threading
+import time
+import logging
+import multiprocessing
+from typing import Any, Dict, List, Optional
+
+from server.dns_cache import SharedHotSet
+from server.dns_server import create_dns_server
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Latency-like values are not additive across workers; report the worst
+_MAX_KEYS = ('score', 'error_score')
+
+
+def merge_stats(per_worker: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combine get_stats() dictionaries from several workers"""
+    merged: Dict[str, Any] = {}
+    for stats in per_worker:
+        for name, value in stats.items():
+            current = merged.get(name)
+            if isinstance(value, dict):
+                merged[name] = merge_stats([current or {}, value])
+            elif isinstance(value, bool) or value is None or isinstance(value, str):
+                merged[name] = current if current is not None else value
+            elif current is None:
+                merged[name] = value
+            elif name.endswith('_ms') or name in _MAX_KEYS:
+                merged[name] = max(current, value)
+            else:
+                merged[name] = current + value
+    return merged
+
+
+def _shard_main(index: int, conn, engine: str, server_kwargs: Dict[str, Any],
+                shared_cache: Optional[SharedHotSet]) -> None:
+    """Worker process: serve on the shared port until told to stop"""
+    server = create_dns_server(engine=engine, reuse_port=True,
+                               shared_cache=shared_cache, **server_kwargs)
+    try:
+        server.start()
+    except Exception as e:
+        conn.send(('error', repr(e)))
+        return
+    conn.send(('ready', os.getpid()))
+    logger.info(f"DNS shard {index} running (pid {os.getpid()})")
+    try:
+        while True:
+            command = conn.recv()
+            if command == 'stop':
+                break
+            if command[0] == 'stats':
+                # Echo the request's sequence number so a late reply can be told apart
+                conn.send((command[1], server.get_stats()))
+    except (EOFError, KeyboardInterrupt):
+        # Parent went away
+        pass
+    finally:
+        server.stop()
+        if shared_cache is not None:
+            shared_cache.close()
+
+
+class _Shard:
+    __slots__ = ('index', 'process', 'conn', 'lock', 'sequence')
+
+    def __init__(self, index: int, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.sequence = 0  # of the last stats request sent
+
+
+class DNSShardSupervisor:
+    """Run DNS servers in N processes sharing one port via SO_REUSEPORT
+
+    Each worker has its own cache (and GIL); with hot_set_slots > 0 they
+    also share a SharedHotSet so an answer resolved by one worker serves
+    the others. Crashed workers are restarted by a monitor thread.
+    """
+
+    def __init__(self,
+                 workers: Optional[int] = None,
+                 engine: str = 'threaded',
+                 hot_set_slots: int = 0,
+                 restart_delay: float = 1.0,
+                 **server_kwargs):
+        self.workers = workers or os.cpu_count() or 1
+        self.engine = engine
+        self.hot_set_slots = hot_set_slots
+        self.restart_delay = restart_delay
+        self.server_kwargs = server_kwargs
+        self.listen_port = server_kwargs.pop('listen_port', 53)
+        self.restarts = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._shards: List[_Shard] = []
+        self._shared_cache: Optional[SharedHotSet] = None
+        self._running = False
+        self._monitor: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start the worker processes and the crash monitor"""
+        if self.listen_port == 0:
+            self.listen_port = self._pick_port()
+        if self.hot_set_slots > 0:
+            self._shared_cache = SharedHotSet(slots=self.hot_set_slots, lock=self._context.Lock())
+
+        self._running = True
+        self._shards = []
+        try:
+            for index in range(self.workers):
+                self._shards.append(self._spawn(index))
+            for shard in self._shards:
+                self._await_ready(shard)
+        except Exception:
+            # Don't leave the shards that did start bound to the port
+            self.stop()
+            raise
+        self._monitor = threading.Thread(target=self._monitor_loop)
+        self._monitor.daemon = True
+        self._monitor.start()
+        logger.info(f"DNS supervisor started {self.workers} workers on port {self.listen_port}")
+
+    @staticmethod
+    def _pick_port(attempts: int = 20) -> int:
+        """A port free for both UDP and TCP, since every shard binds both"""
+        for _ in range(attempts):
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp, \
+                    socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp:
+                udp.bind(('0.0.0.0', 0))
+                port = udp.getsockname()[1]
+                try:
+                    tcp.bind(('0.0.0.0', port))
+                except OSError:
+                    continue
+                return port
+        raise RuntimeError("No port is free for both UDP and TCP")
+
+    def _spawn(self, index: int) -> _Shard:
+        parent_conn, child_conn = self._context.Pipe()
+        kwargs = dict(self.server_kwargs, listen_port=self.listen_port)
+        process = self._context.Process(
+            target=_shard_main,
+            args=(index, child_conn, self.engine, kwargs, self._shared_cache),
+            name=f"dns-shard-{index}"
+        )
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        return _Shard(index, process, parent_conn)
+
+    def _await_ready(self, shard: _Shard, timeout: float = 30.0) -> None:
+        """Block until a worker reports that it is serving"""
+        with shard.lock:
+            if not shard.conn.poll(timeout):
+                raise RuntimeError(f"DNS shard {shard.index} did not start in time")
+            status, detail = shard.conn.recv()
+        if status != 'ready':
+            raise RuntimeError(f"DNS shard {shard.index} failed to start: {detail}")
+
+    def _monitor_loop(self) -> None:
+        """Restart workers that exit while the supervisor is running"""
+        while self._running:
+            time.sleep(self.restart_delay)
+            for position, shard in enumerate(self._shards):
+                if self._running and not shard.process.is_alive():
+                    logger.warning(f"DNS shard {shard.index} exited "
+                                   f"(code {shard.process.exitcode}), restarting")
+                    shard.conn.close()
+                    replacement = self._spawn(shard.index)
+                    self._shards[position] = replacement
+                    self.restarts += 1
+                    try:
+                        self._await_ready(replacement)
+                    except (RuntimeError, EOFError, OSError) as e:
+                        logger.error(str(e))
+
+    def get_stats(self, timeout: float = 2.0) -> Dict[str, Any]:
+        """Combined runtime counters of every live worker"""
+        per_worker = []
+        for shard in list(self._shards):
+            with shard.lock:
+                shard.sequence += 1
+                deadline = time.monotonic() + timeout
+                try:
+                    shard.conn.send(('stats', shard.sequence))
+                    while shard.conn.poll(max(deadline - time.monotonic(), 0)):
+                        sequence, stats = shard.conn.recv()
+                        # Replies to earlier requests that timed out are discarded
+                        if sequence == shard.sequence:
+                            per_worker.append(stats)
+                            break
+                except (OSError, EOFError):
+                    continue
+        stats = merge_stats(per_worker)
+        stats['workers'] = len(per_worker)
+        stats['restarts'] = self.restarts
+        return stats
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Stop every worker, terminating any that do not exit in time"""
+        self._running = False
+        if self._monitor is not None:
+            self._monitor.join(timeout=self.restart_delay + 1.0)
+        for shard in self._shards:
+            try:
+                shard.conn.send('stop')
+            except OSError:
+                pass
+        deadline = time.monotonic() + timeout
+        for shard in self._shards:
+            shard.process.join(max(deadline - time.monotonic(), 0))
+            if shard.process.is_alive():
+                shard.process.terminate()
+                shard.process.join(1.0)
+            shard.conn.close()
+        self._shards = []
+        if self._shared_cache is not None:
+            self._shared_cache.close()
+            self._shared_cache = None
+        logger.info("DNS supervisor stopped")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
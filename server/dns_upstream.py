@@ -0,0 +1,525 @@
+import asyncio
+import bisect
+import ssl
+import threading
+import time
+import logging
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import h2  # noqa: F401 - httpx needs it for HTTP/2
+except ImportError:
+    h2 = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DOH_HEADERS = {
+    'accept': 'application/dns-message',
+    'content-type': 'application/dns-message'
+}
+
+
+class UpstreamError(requests.RequestException):
+    """Raised when the HTTP/2 backend fails to reach an upstream"""
+
+
+def _opened_connections(session: requests.Session) -> int:
+    """Total connections urllib3 has opened for a session so far"""
+    total = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                total += pool.num_connections
+    return total
+
+
+class LatencyHistogram:
+    """Log-bucketed latency histogram with exponential decay of old samples"""
+
+    BOUNDS = tuple(0.001 * 1.25 ** i for i in range(42))  # 1 ms .. ~11.5 s
+
+    def __init__(self, max_samples: int = 10000):
+        self.max_samples = max_samples
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+
+    def record(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += 1
+        if self.total > self.max_samples:
+            # Halve everything so recent behaviour dominates
+            self.counts = [count // 2 for count in self.counts]
+            self.total = sum(self.counts)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Latency in seconds at quantile q, interpolated within its bucket"""
+        if not self.total:
+            return None
+        target = q * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= target:
+                lower = self.BOUNDS[index - 1] if index else 0.0
+                upper = self.BOUNDS[index] if index < len(self.BOUNDS) else self.BOUNDS[-1] * 2
+                return lower + (upper - lower) * (target - seen) / count
+            seen += count
+        return self.BOUNDS[-1]
+
+    def buckets(self) -> Dict[str, int]:
+        """Non-empty buckets keyed by their upper bound in milliseconds"""
+        labels = [f"{bound * 1000:.1f}" for bound in self.BOUNDS] + ['inf']
+        return {label: count for label, count in zip(labels, self.counts) if count}
+
+
+class UpstreamStats:
+    """EWMA latency and error score for one upstream"""
+
+    __slots__ = ('url', 'ewma_latency', 'error_score', 'histogram', 'requests', 'errors')
+
+    def __init__(self, url: str):
+        self.url = url
+        self.ewma_latency: Optional[float] = None
+        self.error_score = 0.0
+        self.histogram = LatencyHistogram()
+        self.requests = 0
+        self.errors = 0
+
+
+class UpstreamSelector:
+    """Rank DoH upstreams by EWMA latency, penalised by recent errors"""
+
+    def __init__(self,
+                 urls: List[str],
+                 alpha: float = 0.2,
+                 error_penalty: float = 10.0,
+                 hedge_percentile: float = 0.95,
+                 min_hedge_delay: float = 0.01,
+                 max_hedge_delay: float = 1.0,
+                 min_samples: int = 20):
+        if not urls:
+            raise ValueError("At least one upstream is required")
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedge_delay = max_hedge_delay
+        self.min_samples = min_samples
+        self._upstreams = [UpstreamStats(url) for url in urls]
+        self._by_url = {stats.url: stats for stats in self._upstreams}
+        self._lock = threading.Lock()
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def _unknown_latency(self) -> float:
+        """Latency assumed for an upstream that has never answered: the worst seen"""
+        observed = [stats.ewma_latency for stats in self._upstreams if stats.ewma_latency is not None]
+        return max(observed + [self.max_hedge_delay])
+
+    def _score(self, stats: UpstreamStats, unknown_latency: float) -> float:
+        """Expected latency in seconds, inflated by the recent error rate"""
+        latency = unknown_latency if stats.ewma_latency is None else stats.ewma_latency
+        return latency * (1.0 + self.error_penalty * stats.error_score)
+
+    def ranked(self) -> List[UpstreamStats]:
+        """Upstreams ordered best first; untried ones are probed as hedge backups"""
+        with self._lock:
+            unknown = self._unknown_latency()
+            return sorted(self._upstreams, key=lambda stats: self._score(stats, unknown))
+
+    def record_success(self, url: str, latency: float) -> None:
+        with self._lock:
+            stats = self._by_url[url]
+            stats.requests += 1
+            stats.histogram.record(latency)
+            if stats.ewma_latency is None:
+                stats.ewma_latency = latency
+            else:
+                stats.ewma_latency += self.alpha * (latency - stats.ewma_latency)
+            stats.error_score *= 1.0 - self.alpha
+
+    def record_failure(self, url: str) -> None:
+        with self._lock:
+            stats = self._by_url[url]
+            stats.requests += 1
+            stats.errors += 1
+            stats.error_score += self.alpha * (1.0 - stats.error_score)
+
+    def record_hedge(self, won: bool) -> None:
+        with self._lock:
+            self.hedged += 1
+            if won:
+                self.hedge_wins += 1
+
+    def hedge_delay(self, stats: UpstreamStats) -> float:
+        """How long to wait on an upstream before hedging to the next one"""
+        with self._lock:
+            if stats.histogram.total >= self.min_samples:
+                delay = stats.histogram.percentile(self.hedge_percentile)
+            elif stats.ewma_latency is not None:
+                delay = stats.ewma_latency * 3
+            else:
+                delay = self.max_hedge_delay
+        return min(max(delay, self.min_hedge_delay), self.max_hedge_delay)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Per-upstream scores and latency histograms"""
+        with self._lock:
+            unknown = self._unknown_latency()
+            upstreams = {}
+            for stats in self._upstreams:
+                histogram = stats.histogram
+                upstreams[stats.url] = {
+                    'score': self._score(stats, unknown),
+                    'ewma_ms': None if stats.ewma_latency is None else stats.ewma_latency * 1000,
+                    'error_score': stats.error_score,
+                    'requests': stats.requests,
+                    'errors': stats.errors,
+                    'p50_ms': _ms(histogram.percentile(0.5)),
+                    'p95_ms': _ms(histogram.percentile(0.95)),
+                    'p99_ms': _ms(histogram.percentile(0.99)),
+                    'histogram_ms': histogram.buckets(),
+                }
+            return {'hedged': self.hedged, 'hedge_wins': self.hedge_wins, 'upstreams': upstreams}
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else seconds * 1000
+
+
+class _PooledSession:
+    __slots__ = ('session', 'last_used', 'opened')
+
+    def __init__(self, session: requests.Session, now: float):
+        self.session = session
+        self.last_used = now
+        self.opened = 0
+
+
+class UpstreamSessionPool:
+    """Pool of persistent keep-alive sessions for DNS-over-HTTPS upstreams"""
+
+    def __init__(self,
+                 pool_size: int = 10,
+                 idle_timeout: float = 60.0,
+                 max_retries: int = 1,
+                 http2: bool = False,
+                 max_hosts: int = 4,
+                 clock: Callable[[], float] = time.monotonic):
+        if pool_size <= 0:
+            raise ValueError("Pool size must be positive")
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.max_retries = max_retries
+        self.max_hosts = max_hosts
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._idle: Deque[_PooledSession] = deque()
+        self._closed = False
+        self.requests = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.reconnects = 0
+        self.idle_closed = 0
+
+        self.http2 = http2 and httpx is not None and h2 is not None
+        if http2 and not self.http2:
+            logger.warning("HTTP/2 requested but httpx[http2] is not installed, using HTTP/1.1")
+        self._client = None
+        if self.http2:
+            # One multiplexed client shared by every worker
+            self._client = httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=pool_size,
+                                    max_keepalive_connections=pool_size,
+                                    keepalive_expiry=idle_timeout)
+            )
+
+    def _new_session(self) -> _PooledSession:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_hosts, pool_maxsize=1, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update(DOH_HEADERS)
+        return _PooledSession(session, self._clock())
+
+    def _acquire(self) -> _PooledSession:
+        now = self._clock()
+        with self._lock:
+            while self._idle:
+                # Most recently used first so warm connections stay warm
+                pooled = self._idle.pop()
+                if now - pooled.last_used <= self.idle_timeout:
+                    return pooled
+                pooled.session.close()
+                self.idle_closed += 1
+        return self._new_session()
+
+    def _release(self, pooled: _PooledSession) -> None:
+        pooled.last_used = self._clock()
+        with self._lock:
+            if not self._closed:
+                self._idle.append(pooled)
+                return
+        pooled.session.close()
+
+    def post(self, url: str, data: bytes, timeout: float) -> Any:
+        """POST a DNS message upstream over a pooled connection"""
+        if self._client is not None:
+            return self._post_http2(url, data, timeout)
+
+        with self._slots:
+            pooled = self._acquire()
+            attempt = 0
+            try:
+                while True:
+                    try:
+                        response = pooled.session.post(url, data=data, timeout=timeout)
+                        break
+                    except requests.ConnectionError:
+                        # Stale keep-alive or reset: reconnect and retry
+                        pooled.session.close()
+                        if attempt >= self.max_retries:
+                            pooled = self._new_session()
+                            raise
+                        attempt += 1
+                        with self._lock:
+                            self.reconnects += 1
+                        pooled = self._new_session()
+                self._account(pooled)
+                return response
+            finally:
+                self._release(pooled)
+
+    def _account(self, pooled: _PooledSession) -> None:
+        """Attribute one request to a new or a reused connection"""
+        opened = _opened_connections(pooled.session)
+        fresh = opened - pooled.opened
+        pooled.opened = opened
+        with self._lock:
+            self.requests += 1
+            self.connections_opened += fresh
+            if not fresh:
+                self.connections_reused += 1
+
+    def _post_http2(self, url: str, data: bytes, timeout: float) -> Any:
+        opened = []
+
+        def trace(event: str, info: Dict[str, Any]) -> None:
+            if event == 'connection.connect_tcp.complete':
+                opened.append(event)
+
+        try:
+            response = self._client.post(url, content=data, headers=DOH_HEADERS,
+                                         timeout=timeout, extensions={'trace': trace})
+        except httpx.HTTPError as e:
+            raise UpstreamError(str(e)) from e
+        with self._lock:
+            self.requests += 1
+            self.connections_opened += len(opened)
+            if not opened:
+                self.connections_reused += 1
+        return response
+
+    def close(self) -> None:
+        """Close every pooled connection"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+        for pooled in idle:
+            pooled.session.close()
+        if self._client is not None:
+            self._client.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """Connection reuse counters"""
+        with self._lock:
+            return {
+                'http2': self.http2,
+                'idle_sessions': len(self._idle),
+                'requests': self.requests,
+                'connections_opened': self.connections_opened,
+                'connections_reused': self.connections_reused,
+                'reconnects': self.reconnects,
+                'idle_closed': self.idle_closed,
+            }
+
+
+class _AsyncConnection:
+    __slots__ = ('reader', 'writer', 'last_used')
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, now: float):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = now
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class AsyncDoHClient:
+    """Non-blocking HTTP/1.1 keep-alive client for DNS-over-HTTPS upstreams"""
+
+    def __init__(self,
+                 pool_size: int = 100,
+                 idle_timeout: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic):
+        if pool_size <= 0:
+            raise ValueError("Pool size must be positive")
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self._ssl_context = ssl.create_default_context()
+        self._idle: Dict[Tuple[str, str, int], List[_AsyncConnection]] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.requests = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.reconnects = 0
+        self.idle_closed = 0
+
+    async def post(self, url: str, data: bytes, timeout: float) -> Tuple[int, bytes]:
+        """POST a DNS message upstream, returning (status, body)"""
+        if self._slots is None:
+            # Created lazily so it binds to the loop that uses it
+            self._slots = asyncio.Semaphore(self.pool_size)
+        async with self._slots:
+            return await asyncio.wait_for(self._post(url, data), timeout)
+
+    async def _post(self, url: str, data: bytes) -> Tuple[int, bytes]:
+        parsed = urlsplit(url)
+        scheme = parsed.scheme
+        host = parsed.hostname
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        path = parsed.path + (f"?{parsed.query}" if parsed.query else '')
+        request = (
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: {parsed.netloc}\r\n"
+            f"Accept: {DOH_HEADERS['accept']}\r\n"
+            f"Content-Type: {DOH_HEADERS['content-type']}\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode('ascii') + data
+
+        key = (scheme, host, port)
+        attempt = 0
+        while True:
+            conn = self._checkout(key)
+            reused = conn is not None
+            if conn is None:
+                conn = await self._open(scheme, host, port)
+            try:
+                conn.writer.write(request)
+                await conn.writer.drain()
+                status, body, keep_alive = await self._read_response(conn.reader)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                conn.close()
+                # A pooled connection may have been closed by the peer
+                if reused and attempt == 0:
+                    attempt += 1
+                    self.reconnects += 1
+                    continue
+                raise UpstreamError(f"Upstream connection failed: {e}") from e
+            except BaseException:
+                # Timed out or cancelled mid-response; the stream is unusable
+                conn.close()
+                raise
+
+            self.requests += 1
+            if reused:
+                self.connections_reused += 1
+            if keep_alive:
+                conn.last_used = self._clock()
+                self._idle.setdefault(key, []).append(conn)
+            else:
+                conn.close()
+            return status, body
+
+    def _checkout(self, key: Tuple[str, str, int]) -> Optional[_AsyncConnection]:
+        idle = self._idle.get(key)
+        now = self._clock()
+        while idle:
+            conn = idle.pop()
+            if now - conn.last_used <= self.idle_timeout and not conn.reader.at_eof():
+                return conn
+            conn.close()
+            self.idle_closed += 1
+        return None
+
+    async def _open(self, scheme: str, host: str, port: int) -> _AsyncConnection:
+        ssl_context = self._ssl_context if scheme == 'https' else None
+        try:
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=ssl_context,
+                server_hostname=host if ssl_context else None)
+        except OSError as e:
+            raise UpstreamError(f"Cannot connect to {host}:{port}: {e}") from e
+        self.connections_opened += 1
+        return _AsyncConnection(reader, writer, self._clock())
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader) -> Tuple[int, bytes, bool]:
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed before response")
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith(b'HTTP/'):
+            raise UpstreamError(f"Malformed status line: {status_line!r}")
+        version, status = parts[0], int(parts[1])
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == b'HTTP/1.1' and headers.get(b'connection', b'').lower() != b'close'
+        if headers.get(b'transfer-encoding', b'').lower() == b'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif b'content-length' in headers:
+            body = await reader.readexactly(int(headers[b'content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return status, body, keep_alive
+
+    def close(self) -> None:
+        """Close every idle connection"""
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """Connection reuse counters"""
+        return {
+            'idle_connections': sum(len(conns) for conns in self._idle.values()),
+            'requests': self.requests,
+            'connections_opened': self.connections_opened,
+            'connections_reused': self.connections_reused,
+            'reconnects': self.reconnects,
+            'idle_closed': self.idle_closed,
+        }
@@ -0,0 +1,165 @@
+import struct
+from typing import List, NamedTuple, Optional, Tuple
+
+HEADER = struct.Struct('>HHHHHH')
+RR_FIXED = struct.Struct('>HHIH')
+
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_AAAA = 28
+TYPE_OPT = 41
+
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+FLAG_TC = 0x0200
+
+DEFAULT_UDP_PAYLOAD = 512
+
+QuestionKey = Tuple[bytes, int, int]
+
+
+class ResponseInfo(NamedTuple):
+    """Summary of a DNS response needed for caching decisions"""
+    rcode: int
+    truncated: bool
+    answer_count: int
+    ttl_fields: List[Tuple[int, int]]  # (offset of TTL field, original TTL)
+    min_ttl: Optional[int]
+    negative_ttl: Optional[int]
+
+
+def skip_name(data: bytes, offset: int) -> int:
+    """Return the offset just past the (possibly compressed) name at offset"""
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+
+
+def question_key(data: bytes) -> Optional[QuestionKey]:
+    """Extract a case-insensitive (qname, qtype, qclass) key from a query"""
+    if len(data) < HEADER.size:
+        return None
+    if HEADER.unpack_from(data)[2] != 1:
+        return None
+
+    try:
+        end = skip_name(data, HEADER.size)
+        qtype, qclass = struct.unpack_from('>HH', data, end)
+    except (IndexError, struct.error):
+        return None
+    return bytes(data[HEADER.size:end]).lower(), qtype, qclass
+
+
+def transaction_id(data: bytes) -> int:
+    """Read the transaction ID of a DNS message"""
+    return struct.unpack_from('>H', data)[0]
+
+
+def with_transaction_id(data: bytes, txid: int) -> bytes:
+    """Return a copy of a DNS message carrying a different transaction ID"""
+    return struct.pack('>H', txid) + data[2:]
+
+
+def with_question_of(response: bytes, query: bytes) -> bytes:
+    """Copy of a response to an equivalent query, carrying that query's ID and qname
+
+    Equivalent queries differ at most in the case of the name, which
+    resolvers using DNS 0x20 expect to see echoed back exactly.
+    """
+    end = skip_name(query, HEADER.size)
+    return query[:2] + response[2:HEADER.size] + query[HEADER.size:end] + response[end:]
+
+
+def edns_payload_size(query: bytes) -> int:
+    """UDP payload size advertised in a query's EDNS0 OPT record"""
+    try:
+        _, _, qdcount, ancount, nscount, arcount = HEADER.unpack_from(query)
+        offset = HEADER.size
+        for _ in range(qdcount):
+            offset = skip_name(query, offset) + 4
+        for _ in range(ancount + nscount + arcount):
+            offset = skip_name(query, offset)
+            rtype, rclass, _, rdlength = RR_FIXED.unpack_from(query, offset)
+            if rtype == TYPE_OPT:
+                # The OPT class field carries the requestor's payload size
+                return max(rclass, DEFAULT_UDP_PAYLOAD)
+            offset += RR_FIXED.size + rdlength
+    except (IndexError, struct.error):
+        pass
+    return DEFAULT_UDP_PAYLOAD
+
+
+def truncate_response(response: bytes, limit: int) -> bytes:
+    """Fit a response into limit bytes, keeping only the question and TC set"""
+    if len(response) <= limit:
+        return response
+    txid, flags, qdcount = struct.unpack_from('>HHH', response)
+    end = HEADER.size
+    for _ in range(qdcount):
+        end = skip_name(response, end) + 4
+    return HEADER.pack(txid, flags | FLAG_TC, qdcount, 0, 0, 0) + response[HEADER.size:end]
+
+
+def build_query(key: QuestionKey, txid: int = 0) -> bytes:
+    """Build a recursive query for a (qname, qtype, qclass) key"""
+    qname, qtype, qclass = key
+    return HEADER.pack(txid, 0x0100, 1, 0, 0, 0) + qname + struct.pack('>HH', qtype, qclass)
+
+
+def scan_response(data: bytes) -> ResponseInfo:
+    """Walk a response once, recording rcode and the location of every TTL"""
+    _, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(data)
+    offset = HEADER.size
+    for _ in range(qdcount):
+        offset = skip_name(data, offset) + 4
+
+    ttl_fields = []
+    negative_ttl = None
+    for index in range(ancount + nscount + arcount):
+        offset = skip_name(data, offset)
+        rtype, _, ttl, rdlength = RR_FIXED.unpack_from(data, offset)
+        # OPT pseudo-records reuse the TTL field for extended flags
+        if rtype != TYPE_OPT:
+            ttl_fields.append((offset + 4, ttl))
+        offset += RR_FIXED.size
+        if rtype == TYPE_SOA and ancount <= index < ancount + nscount:
+            # RFC 2308: negative TTL is min(SOA TTL, SOA MINIMUM)
+            minimum = struct.unpack_from('>I', data, offset + rdlength - 4)[0]
+            negative_ttl = min(ttl, minimum)
+        offset += rdlength
+
+    if offset > len(data):
+        raise ValueError("DNS response truncated")
+
+    return ResponseInfo(
+        rcode=flags & 0x000F,
+        truncated=bool(flags & FLAG_TC),
+        answer_count=ancount,
+        ttl_fields=ttl_fields,
+        min_ttl=min((ttl for _, ttl in ttl_fields), default=None),
+        negative_ttl=negative_ttl,
+    )
+
+
+def question_end(data: bytes) -> int:
+    """Offset just past the first question of a message"""
+    return skip_name(data, HEADER.size) + 4
+
+
+def build_response(query: bytes, rcode: int = RCODE_NOERROR, rtype: int = 0,
+                   rdatas: List[bytes] = (), ttl: int = 0) -> bytes:
+    """Answer a single-question query locally with rdatas of type rtype"""
+    txid, flags = struct.unpack_from('>HH', query)
+    # QR and RA set; opcode and RD copied from the query
+    flags = 0x8080 | (flags & 0x7900) | rcode
+    answers = b''.join(
+        # 0xC00C points back at the question name
+        struct.pack('>HHHIH', 0xC00C, rtype, 1, ttl, len(rdata)) + rdata for rdata in rdatas)
+    return (HEADER.pack(txid, flags, 1, len(rdatas), 0, 0)
+            + query[HEADER.size:question_end(query)] + answers)
@@ -1,16 +1,232 @@
+import base64
+import binascii
+import ssl
+import struct
+import threading
 import logging
-from dnslib import DNSRecord
-import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from server.dns_server import DNSOverHTTPS
+from server.dns_wire import HEADER, scan_response
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DNS_PATH = '/dns-query'
+DNS_MESSAGE = 'application/dns-message'
+MAX_MESSAGE_SIZE = 65535
+
+
+class _DoHRequestHandler(BaseHTTPRequestHandler):
+    """RFC 8484 GET/POST handler; one thread per keep-alive connection"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'DoH'
+    # Small responses on a persistent connection: do not wait for ACKs
+    disable_nagle_algorithm = True
+
+    def setup(self) -> None:
+        # Idle keep-alive connections are closed after this many seconds
+        self.timeout = self.server.doh.idle_timeout
+        super().setup()
+        self.server.doh._connection_opened()
+
+    def finish(self) -> None:
+        try:
+            super().finish()
+        finally:
+            self.server.doh._connection_closed()
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != DNS_PATH:
+            self._reject(404)
+            return
+        encoded = parse_qs(url.query).get('dns')
+        if not encoded:
+            self._reject(400)
+            return
+        try:
+            # base64url without padding (RFC 8484 section 4.1)
+            query = base64.urlsafe_b64decode(encoded[0] + '=' * (-len(encoded[0]) % 4))
+        except (binascii.Error, ValueError):
+            self._reject(400)
+            return
+        self._answer(query)
+
+    def do_POST(self) -> None:
+        if urlsplit(self.path).path != DNS_PATH:
+            self._reject(404)
+            return
+        if self.headers.get('Content-Type', '').split(';')[0].strip() != DNS_MESSAGE:
+            self._reject(415)
+            return
+        length = self.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            self._reject(411)
+            return
+        if int(length) > MAX_MESSAGE_SIZE:
+            self._reject(413)
+            return
+        self._answer(self.rfile.read(int(length)))
+
+    def _answer(self, query: bytes) -> None:
+        if not HEADER.size <= len(query) <= MAX_MESSAGE_SIZE:
+            self._reject(400)
+            return
+        response = self.server.doh.resolver.resolve(query)
+        if not response:
+            self._reject(502)
+            return
+        self.server.doh._count('requests')
+        self.send_response(200)
+        self.send_header('Content-Type', DNS_MESSAGE)
+        self.send_header('Content-Length', str(len(response)))
+        max_age = _max_age(response)
+        if max_age is not None:
+            self.send_header('Cache-Control', f'max-age={max_age}')
+        self.end_headers()
+        self.wfile.write(response)
+
+    def _reject(self, status: int) -> None:
+        self.server.doh._count('rejected')
+        # An unread request body would desync the connection, so drop it
+        self.close_connection = True
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def log_message(self, format: str, *args) -> None:
+        # Per-request access logging is too costly on the hot path
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def _max_age(response: bytes) -> Optional[int]:
+    """HTTP freshness lifetime for a DNS answer (RFC 8484 section 5.1)"""
+    try:
+        info = scan_response(response)
+    except (ValueError, IndexError, struct.error):
+        return None
+    if info.answer_count:
+        return info.min_ttl
+    return info.negative_ttl
+
+
+class _DoHHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, doh: 'DOHServer'):
+        self.doh = doh
+        super().__init__(address, _DoHRequestHandler)
+
 
 class DOHServer:
-    def __init__(self, port=53, upstream='https://1.1.1.1/dns-query'):
+    """DNS-over-HTTPS endpoint serving /dns-query for VPN clients
+
+    Queries go through a DNSOverHTTPS resolver, so they share its cache,
+    in-flight coalescing and upstream selection. Pass resolver to reuse
+    one that is already serving plain DNS (of either engine from
+    create_dns_server); otherwise one is created from
+    upstream and resolver_kwargs. Without certfile/keyfile the endpoint
+    speaks plain HTTP, for use behind a TLS-terminating proxy.
+    """
+
+    def __init__(self,
+                 port: int = 443,
+                 upstream: str = 'https://1.1.1.1/dns-query',
+                 host: str = '0.0.0.0',
+                 certfile: Optional[str] = None,
+                 keyfile: Optional[str] = None,
+                 idle_timeout: float = 30.0,
+                 resolver: Optional[DNSOverHTTPS] = None,
+                 **resolver_kwargs):
         self.port = port
         self.upstream = upstream
-        
-    def start(self):
-        logging.info(f"DNS-over-HTTPS server started on port {self.port}")
-        # Add your server implementation here
+        self.host = host
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.idle_timeout = idle_timeout
+        self._owns_resolver = resolver is None
+        self.resolver = resolver or DNSOverHTTPS(upstream_dns=upstream, tcp=False, **resolver_kwargs)
+        self._httpd: Optional[_DoHHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'rejected': 0, 'connections': 0, 'open_connections': 0}
+
+    def start(self) -> None:
+        """Start serving HTTP requests on a background thread"""
+        self._httpd = _DoHHTTPServer((self.host, self.port), self)
+        self.port = self._httpd.server_address[1]
+        if self.certfile:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(self.certfile, self.keyfile)
+            context.set_alpn_protocols(['http/1.1'])
+            # Handshake in the connection thread, not the accept loop
+            self._httpd.socket = context.wrap_socket(
+                self._httpd.socket, server_side=True, do_handshake_on_connect=False)
+        else:
+            logger.warning("DoH endpoint has no certificate; serving plain HTTP")
+
+        self._thread = threading.Thread(target=self._httpd.serve_forever, kwargs={'poll_interval': 0.2})
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info(f"DNS-over-HTTPS server started on port {self.port}")
+
+    def stop(self) -> None:
+        """Stop accepting requests and release the resolver if we own it"""
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+        if self._owns_resolver:
+            self.resolver.stop()
+        logger.info("DNS-over-HTTPS server stopped")
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def _connection_opened(self) -> None:
+        with self._lock:
+            self._stats['connections'] += 1
+            self._stats['open_connections'] += 1
+
+    def _connection_closed(self) -> None:
+        with self._lock:
+            self._stats['open_connections'] -= 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """HTTP counters plus those of the backing resolver"""
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+        stats['resolver'] = self.resolver.get_stats()
+        return stats
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
 
 if __name__ == "__main__":
-    server = DOHServer()
-    server.start()
\ No newline at end of file
+    import os
+    import time
+
+    server = DOHServer(
+        port=int(os.environ.get('DOH_PORT', 443)),
+        upstream=os.environ.get('DOH_UPSTREAM', 'https://1.1.1.1/dns-query'),
+        certfile=os.environ.get('DOH_CERT'),
+        keyfile=os.environ.get('DOH_KEY')
+    )
+    with server:
+        while True:
+            time.sleep(60)
@@ -10,8 +10,13 @@ declare -A services=(
     ["shadowsocks"]=$ENABLE_SHADOWSOCKS
     ["socks5"]=$ENABLE_SOCKS5
     ["doh"]=$ENABLE_DOH
+    ["dns"]=$ENABLE_DNS
 )
 
+# DNS forwarder engine: threaded or asyncio
+export DNS_ENGINE=${DNS_ENGINE:-threaded}
+export DNS_WORKERS=${DNS_WORKERS:-1}
+
 cd /app || exit 1
 
 for service in "${!services[@]}"; do
@@ -1,31 +1,89 @@
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet, InvalidToken
 import socket
 import struct
 import logging
-from typing import Optional, Union
+from typing import List, Optional, Union
+from utils.encryption import AEAD_ALGORITHMS, AEADCipher, derive_aead_key
+from utils.dns_framing import MAX_PACKET, DNSReassembler, fragment_capacity, segment_payload
+from utils import transforms
+from utils.tls_framing import MAX_RECORD_PAYLOAD, TLSRecordDeframer, frame_records
+from utils.transforms import DEFAULT_XOR_KEY
+from utils.xor_engine import xor_bytes, xor_into
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class Obfuscator:
-    def __init__(self, key: Optional[bytes] = None):
-        """Initialize with optional key (otherwise generates new)"""
+    def __init__(self, key: Optional[bytes] = None, tls_record_size: int = MAX_RECORD_PAYLOAD,
+                 encryption: str = 'fernet', dns_packet_size: int = MAX_PACKET):
+        """Initialize with optional key (otherwise generates new)
+
+        tls_record_size caps the payload of each TLS record; larger data is
+        split across records (e.g. MSS - 5 keeps one record per segment).
+        encryption is 'fernet' or a raw binary AEAD from AEAD_ALGORITHMS
+        ('aes-256-gcm', 'chacha20-poly1305'), keyed from the same key.
+        dns_packet_size caps each DNS-mimic packet; larger data is segmented.
+        """
+        if not 0 < tls_record_size <= MAX_RECORD_PAYLOAD:
+            raise ValueError(f"TLS record size must be between 1 and {MAX_RECORD_PAYLOAD}")
+        if encryption != 'fernet' and encryption not in AEAD_ALGORITHMS:
+            raise ValueError(f"Unknown encryption: {encryption}")
         self.key = key or Fernet.generate_key()
         self.cipher = Fernet(self.key)
+        self.encryption = encryption
+        self.aead = AEADCipher(derive_aead_key(self.key), encryption) if encryption != 'fernet' else None
+        fragment_capacity(dns_packet_size)  # rejects sizes with no room for data
+        self.tls_record_size = tls_record_size
+        self.dns_packet_size = dns_packet_size
+        self._dns_message_id = 0
 
-    def xor_obfuscate(self, data: bytes, key: bytes = b'\xAA\x55\xAA\x55') -> bytes:
+    def xor_obfuscate(self, data: bytes, key: bytes = DEFAULT_XOR_KEY) -> bytes:
         """Lightweight XOR obfuscation (not for security, only obfuscation)"""
         if not data:
             raise ValueError("No data to obfuscate")
         logger.debug(f"Obfuscating {len(data)} bytes of data with XOR")
-        return bytes(x ^ key[i % len(key)] for i, x in enumerate(data))
+        return xor_bytes(data, key)
+
+    def xor_obfuscate_into(self, buffer: Union[bytearray, memoryview],
+                           key: bytes = DEFAULT_XOR_KEY) -> None:
+        """In-place variant of xor_obfuscate for a writable buffer"""
+        if not len(buffer):
+            raise ValueError("No data to obfuscate")
+        xor_into(buffer, key)
 
     def tls_wrap(self, data: bytes) -> bytes:
         """Wrap data with fake TLS header"""
-        if len(data) > 65535:
-            raise ValueError("Data too large for TLS wrapping")
+        return b''.join(self.tls_wrap_iov(data))
+
+    def tls_wrap_iov(self, data: Union[bytes, bytearray, memoryview]) -> List[Union[bytes, memoryview]]:
+        """TLS-wrapped data as a buffer list for socket.sendmsg (no copy)"""
         logger.debug(f"Wrapping data with fake TLS header: {len(data)} bytes")
-        return b'\x17\x03\x03' + struct.pack('>H', len(data)) + data
+        return frame_records(data, self.tls_record_size)
+
+    def tls_deframer(self) -> TLSRecordDeframer:
+        """Stream parser for one connection's TLS-wrapped traffic"""
+        # Clients may pad after each record
+        return TLSRecordDeframer(allow_padding=True)
+
+    def compile_chain(self, spec) -> transforms.TransformChain:
+        """Transform chain (e.g. 'encrypt>xor>tls') for one connection
+
+        Compile once per session and reuse it: stream stages keep their
+        reassembly buffers inside the chain.
+        """
+        return transforms.compile_chain(spec, self)
+
+    def next_message(self) -> None:
+        """Per-message hook for chains; the server keeps no sequence state"""
+
+    def xor_key(self) -> bytes:
+        """XOR key for the next message (the xor stage)"""
+        return DEFAULT_XOR_KEY
+
+    def tls_padding(self) -> bytes:
+        """Padding to append after a message's records (the tls stage); none here"""
+        return b''
 
     def protocol_mimicry(self, data: bytes, protocol: str = 'https') -> bytes:
         """Make traffic look like specified protocol"""
@@ -38,14 +96,23 @@ class Obfuscator:
 
     def _make_like_dns(self, data: bytes) -> bytes:
         """Make data look like DNS traffic"""
-        dns_header = b'\x00\x00\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00'
-        max_payload = 512 - len(dns_header) - 5
-        payload = data[:max_payload]
-        return dns_header + payload
+        return b''.join(self.dns_packets(data))
+
+    def dns_packets(self, data: Union[bytes, bytearray, memoryview]) -> List[bytes]:
+        """Data split over as many DNS query packets as it needs, for datagram sends"""
+        packets = segment_payload(data, self._dns_message_id, self.dns_packet_size)
+        self._dns_message_id = (self._dns_message_id + 1) % 65536
+        return packets
+
+    def dns_reassembler(self) -> DNSReassembler:
+        """Reassembly buffer for one peer's DNS-mimic fragments"""
+        return DNSReassembler()
 
     def encrypt(self, data: bytes) -> bytes:
-        """Encrypt data with Fernet (AES-128-CBC)"""
+        """Encrypt data with Fernet (AES-128-CBC) or the configured AEAD"""
         try:
+            if self.aead is not None:
+                return self.aead.encrypt(data)
             logger.debug("Encrypting data using Fernet encryption")
             return self.cipher.encrypt(data)
         except Exception as e:
@@ -53,11 +120,13 @@ class Obfuscator:
             raise
 
     def decrypt(self, data: bytes) -> bytes:
-        """Decrypt Fernet-encrypted data"""
+        """Decrypt data produced by encrypt()"""
         try:
+            if self.aead is not None:
+                return self.aead.decrypt(data)
             logger.debug("Decrypting data using Fernet decryption")
             return self.cipher.decrypt(data)
-        except InvalidToken as e:
+        except (InvalidToken, InvalidTag) as e:
             logger.error(f"Decryption failed - invalid token: {e}")
             raise
         except Exception as e:
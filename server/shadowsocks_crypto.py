@@ -0,0 +1,216 @@
+import os
+import struct
+import hashlib
+import logging
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Type, Union
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+SUBKEY_INFO = b'ss-subkey'
+CHUNK_LENGTH = struct.Struct('>H')
+# Payload limit per chunk; the top two bits of the length are reserved
+MAX_CHUNK = 0x3FFF
+# Every UDP packet has its own salt, so its single nonce is always zero
+UDP_NONCE = bytes(NONCE_SIZE)
+
+
+class Method(NamedTuple):
+    cipher: Type
+    key_size: int  # also the salt size
+
+    @property
+    def salt_size(self) -> int:
+        return self.key_size
+
+
+# Shadowsocks AEAD methods (SIP004)
+METHODS: Dict[str, Method] = {
+    'aes-128-gcm': Method(AESGCM, 16),
+    'aes-256-gcm': Method(AESGCM, 32),
+    'chacha20-ietf-poly1305': Method(ChaCha20Poly1305, 32),
+}
+
+
+def get_method(name: str) -> Method:
+    """Look up a method by name, rejecting anything unsupported"""
+    try:
+        return METHODS[name]
+    except KeyError:
+        raise ValueError(f"Unsupported Shadowsocks method: {name} "
+                         f"(expected one of {sorted(METHODS)})") from None
+
+
+def master_key(password: str, key_size: int) -> bytes:
+    """Master key from the password (EVP_BytesToKey with MD5, as Shadowsocks does)
+
+    Cheap and deterministic, so both ends get the same key; derive it once
+    per server, not per packet.
+    """
+    secret = password.encode()
+    key, block = b'', b''
+    while len(key) < key_size:
+        block = hashlib.md5(block + secret).digest()
+        key += block
+    return key[:key_size]
+
+
+def session_subkey(master: bytes, salt: bytes) -> bytes:
+    """Per-connection subkey: HKDF-SHA1 over the master key with the peer's salt"""
+    return HKDF(
+        algorithm=hashes.SHA1(),
+        length=len(master),
+        salt=salt,
+        info=SUBKEY_INFO,
+        backend=default_backend()
+    ).derive(master)
+
+
+def seal_packet(method: Method, master: bytes, payload: Buffer) -> bytes:
+    """Encrypt one UDP packet: a fresh salt, then the payload sealed under its subkey"""
+    salt = os.urandom(method.salt_size)
+    return salt + method.cipher(session_subkey(master, salt)).encrypt(UDP_NONCE, payload, None)
+
+
+def open_packet(method: Method, master: bytes, packet: Buffer) -> bytes:
+    """Decrypt one UDP packet sealed by the peer; a bad tag raises InvalidTag"""
+    salt_size = method.salt_size
+    if len(packet) < salt_size + TAG_SIZE:
+        raise ValueError("Packet too short")
+    view = memoryview(packet)
+    subkey = session_subkey(master, bytes(view[:salt_size]))
+    return method.cipher(subkey).decrypt(UDP_NONCE, view[salt_size:], None)
+
+
+class AEADSession:
+    """One direction of a connection: the cipher for one salt and its nonce counter
+
+    The cipher object is built once when the salt is known; every
+    encrypt or decrypt then uses the next little-endian counter nonce,
+    so both ends stay in step without sending nonces.
+    """
+
+    __slots__ = ('salt', '_aead', '_counter')
+
+    def __init__(self, method: Method, master: bytes, salt: bytes):
+        if len(salt) != method.salt_size:
+            raise ValueError(f"Salt must be {method.salt_size} bytes")
+        self.salt = salt
+        self._aead = method.cipher(session_subkey(master, salt))
+        self._counter = 0
+
+    def _next_nonce(self) -> bytes:
+        nonce = self._counter.to_bytes(NONCE_SIZE, 'little')
+        self._counter += 1
+        return nonce
+
+    def encrypt(self, data: Buffer) -> bytes:
+        """Seal data (ciphertext + 16-byte tag)"""
+        return self._aead.encrypt(self._next_nonce(), data, None)
+
+    def decrypt(self, data: Buffer) -> bytes:
+        """Open data sealed by the peer's matching session"""
+        return self._aead.decrypt(self._next_nonce(), data, None)
+
+
+class AEADStreamEncoder:
+    """Outgoing half of a connection: salt, then [sealed length][sealed payload] chunks"""
+
+    def __init__(self, method: Method, master: bytes, salt: Optional[bytes] = None):
+        self.session = AEADSession(method, master, salt or os.urandom(method.salt_size))
+        self._salt_sent = False
+
+    def encode(self, data: Buffer) -> bytes:
+        """Seal data as chunks of at most MAX_CHUNK bytes, after the salt the first time"""
+        session = self.session
+        parts = []
+        if not self._salt_sent:
+            parts.append(session.salt)
+            self._salt_sent = True
+        view = memoryview(data).cast('B')
+        for start in range(0, len(view), MAX_CHUNK):
+            chunk = view[start:start + MAX_CHUNK]
+            parts.append(session.encrypt(CHUNK_LENGTH.pack(len(chunk))))
+            parts.append(session.encrypt(chunk))
+        return b''.join(parts)
+
+
+class AEADStreamDecoder:
+    """Incoming half of a connection: reassembles chunks from reads of any size
+
+    The salt is taken from the first bytes received. A chunk is decrypted
+    as soon as all of it has arrived, however TCP split or merged it;
+    anything after stays buffered for the next feed(). A bad length or
+    tag raises, after which the connection must be dropped.
+
+    Without a master key, identify(salt, first sealed length header) picks
+    the key instead, returning the session past that header and the length.
+    """
+
+    def __init__(self, method: Method, master: Optional[bytes] = None,
+                 identify: Optional[Callable[[bytes, memoryview], Tuple[AEADSession, int]]] = None):
+        if (master is None) == (identify is None):
+            raise ValueError("Pass either a master key or an identify callback")
+        self._method = method
+        self._master = master
+        self._identify = identify
+        self.session: Optional[AEADSession] = None
+        self._buffer = bytearray()
+        self._length: Optional[int] = None  # payload length once its header is opened
+
+    @property
+    def pending(self) -> int:
+        """Bytes received but not yet decrypted"""
+        return len(self._buffer)
+
+    def feed(self, data: Buffer) -> List[bytes]:
+        """Add received bytes and return the payloads of every completed chunk"""
+        buffer = self._buffer
+        buffer += data
+        chunks: List[bytes] = []
+        view = memoryview(buffer)
+        consumed = self._parse(view, chunks)
+        view.release()
+        del buffer[:consumed]
+        return chunks
+
+    def _parse(self, view: memoryview, chunks: List[bytes]) -> int:
+        """Decrypt every complete chunk in view; return the bytes consumed"""
+        offset, available = 0, len(view)
+        if self.session is None:
+            salt_size = self._method.salt_size
+            if self._identify is None:
+                if available < salt_size:
+                    return 0
+                self.session = AEADSession(self._method, self._master, bytes(view[:salt_size]))
+                offset = salt_size
+            else:
+                end = salt_size + CHUNK_LENGTH.size + TAG_SIZE
+                if available < end:
+                    return 0
+                self.session, self._length = self._identify(bytes(view[:salt_size]), view[salt_size:end])
+                offset = end
+        session = self.session
+        while True:
+            if self._length is None:
+                end = offset + CHUNK_LENGTH.size + TAG_SIZE
+                if available < end:
+                    return offset
+                self._length = CHUNK_LENGTH.unpack(session.decrypt(view[offset:end]))[0]
+                offset = end
+            if self._length > MAX_CHUNK:
+                raise ValueError(f"Invalid chunk length {self._length}")
+            end = offset + self._length + TAG_SIZE
+            if available < end:
+                return offset
+            chunks.append(session.decrypt(view[offset:end]))
+            self._length, offset = None, end
@@ -1,92 +1,480 @@
+import math
+import time
 import logging
 import socket
+import selectors
 import threading
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
-from utils.encryption import generate_strong_key
+from server.shadowsocks_crypto import (AEADSession, AEADStreamDecoder, AEADStreamEncoder, Method,
+                                       get_method, seal_packet)
+from server.shadowsocks_users import UserTable
+from server.tcp_engine import (DEFAULT_BACKLOG, ConnectionProtocol, EventLoopTCPServer,
+                               ThreadedTCPServer, validate_engine)
+from utils.socks_address import pack_address, parse_address
+from utils.resolver import BackgroundResolver, Name, Resolved
+from utils.timer_wheel import TimerWheel
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class _ShadowsocksSession:
+    """Cipher state and owning user of one client connection, whichever engine drives it"""
+
+    def __init__(self, server: 'ShadowsocksServer', address: tuple):
+        self.server = server
+        self.users = server.users
+        self.ip = address[0] if address else ''
+        self.user: Optional[int] = None
+        self._master: Optional[bytes] = None
+        self._received = 0  # bytes read before the user was known
+        self.decoder = AEADStreamDecoder(server._method, identify=self._identify)
+        self.encoder: Optional[AEADStreamEncoder] = None
+
+    def _identify(self, salt: bytes, header: memoryview) -> Tuple[AEADSession, int]:
+        user, session, length = self.users.identify_stream(salt, header, self.ip)
+        # Replies keep using this key even if the user is removed meanwhile
+        self._master = self.users.master(user)
+        self.user = user
+        self.users.opened(user)
+        return session, length
+
+    def receive(self, data: bytes) -> bytes:
+        """Consume received bytes; return the encrypted reply to send (may be empty)"""
+        self._received += len(data)
+        chunks = self.decoder.feed(data)
+        reply = b''
+        if chunks:
+            if self.encoder is None:
+                self.encoder = AEADStreamEncoder(self.server._method, self._master)
+            reply = b''.join(self.encoder.encode(b"ACK: " + chunk) for chunk in chunks)
+        if self.user is not None:
+            self.users.record(self.user, self._received, len(reply))
+            self._received = 0
+        return reply
+
+    def close(self) -> None:
+        if self.user is not None:
+            self.users.closed(self.user)
+            self.user = None
+
+class _ShadowsocksProtocol(ConnectionProtocol):
+    """Event-loop connection: the session object replaces the handler thread"""
+
+    def __init__(self, engine: EventLoopTCPServer, server: 'ShadowsocksServer'):
+        super().__init__(engine)
+        self.server = server
+        self.session: Optional[_ShadowsocksSession] = None
+
+    def connection_made(self, transport) -> None:
+        super().connection_made(transport)
+        self.session = _ShadowsocksSession(self.server, self.address)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        super().connection_lost(exc)
+        if self.session is not None:
+            self.session.close()
+
+    def data_received(self, data: bytes) -> None:
+        try:
+            reply = self.session.receive(data)
+        except Exception as e:
+            logger.error(f"Client handling error: {e}")
+            self.transport.abort()
+            return
+        if reply:
+            self.transport.write(reply)
+
+class _UDPAssociation:
+    """NAT entry: one client's flow to one target, through its own upstream socket"""
+
+    __slots__ = ('key', 'client', 'upstream', 'header', 'user', 'master', 'last_active')
+
+    def __init__(self, key: tuple, client: tuple, upstream: socket.socket, header: bytes,
+                 user: int, master: bytes, now: float):
+        self.key = key
+        self.client = client
+        self.upstream = upstream
+        self.header = header  # packed target address prepended to every reply
+        self.user = user
+        self.master = master  # replies are sealed with the owning user's key
+        self.last_active = now
+
+class ShadowsocksUDPRelay:
+    """Shadowsocks UDP relay with a NAT table of (client, target) associations
+
+    Each association has a connected upstream socket, so the kernel only
+    delivers replies from its target. A single selector thread serves the
+    listening socket and every upstream socket, draining up to batch
+    datagrams per wakeup. Packets only stamp last_active; idle entries are
+    found through a timer wheel, so expiry never scans the whole table.
+    Domain targets are resolved on background threads; a new flow's first
+    packets wait (up to max_waiting per name) until the lookup completes,
+    so a slow name server never stalls the other flows. Every packet is
+    matched to a user in the shared UserTable.
+    """
+
+    def __init__(self, users: UserTable, host: str = '0.0.0.0', port: int = 0,
+                 idle_timeout: float = 60.0, max_associations: int = 100000, tick: float = 1.0,
+                 recv_size: int = 65536, batch: int = 64, max_waiting: int = 32):
+        if idle_timeout <= 0 or max_associations <= 0:
+            raise ValueError("idle_timeout and max_associations must be positive")
+        self._method: Method = users.method
+        self._users = users
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.max_associations = max_associations
+        self.recv_size = recv_size
+        self.batch = batch
+        self.max_waiting = max_waiting
+        self._associations: Dict[Tuple[tuple, str, int], _UDPAssociation] = {}
+        self._wheel: TimerWheel[_UDPAssociation] = TimerWheel(
+            tick, slots=math.ceil(idle_timeout / tick) + 1)
+        self._running = False
+        self._socket: Optional[socket.socket] = None
+        self._selector: Optional[selectors.BaseSelector] = None
+        self._waker: Optional[Tuple[socket.socket, socket.socket]] = None
+        self._resolver: Optional[BackgroundResolver] = None
+        # Packets of flows whose target name is being resolved
+        self._waiting: Dict[Name, List[Tuple[tuple, tuple, int, bytes]]] = {}
+        self._thread: Optional[threading.Thread] = None
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self.invalid = 0
+        self.expired = 0
+
+    def start(self) -> int:
+        """Bind, start the relay thread and return the UDP port"""
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((self.host, self.port))
+        self._socket.setblocking(False)
+        self.port = self._socket.getsockname()[1]
+        self._waker = socket.socketpair()
+        for sock in self._waker:
+            sock.setblocking(False)
+        self._resolver = BackgroundResolver(self._wake)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._socket, selectors.EVENT_READ, None)
+        self._selector.register(self._waker[0], selectors.EVENT_READ, self._waker)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='shadowsocks-udp')
+        self._thread.daemon = True
+        self._thread.start()
+        return self.port
+
+    def _run(self) -> None:
+        selector = self._selector
+        while self._running:
+            for key, _ in selector.select(timeout=self._wheel.tick):
+                if key.data is None:
+                    self._drain_clients()
+                elif isinstance(key.data, _UDPAssociation):
+                    self._drain_upstream(key.data)
+                else:
+                    self._drain_waker()
+            self._expire(time.monotonic())
+
+    def _wake(self) -> None:
+        try:
+            self._waker[1].send(b'\0')
+        except OSError:
+            pass  # already pending, or stopped
+
+    def _drain_waker(self) -> None:
+        try:
+            while self._waker[0].recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        for name, target in self._resolver.completed():
+            for key, client, user, payload in self._waiting.pop(name, ()):
+                if target is None:
+                    self.dropped += 1
+                else:
+                    self._forward(key, client, target, user, payload, time.monotonic())
+
+    def _drain_clients(self) -> None:
+        for _ in range(self.batch):
+            try:
+                packet, client = self._socket.recvfrom(self.recv_size)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error(f"UDP receive error: {e}")
+                return
+            self.received += 1
+            try:
+                self._from_client(packet, client)
+            except (ValueError, InvalidTag, UnicodeError):
+                self.invalid += 1
+
+    def _from_client(self, packet: bytes, client: tuple) -> None:
+        user, payload = self._users.identify_packet(packet, client[0])
+        self._users.record(user, received=len(packet))
+        address = parse_address(payload)
+        if address is None:
+            raise ValueError("Truncated target address")
+        host, port, end = address
+        key = (client, host, port)
+        association = self._associations.get(key)
+        if association is not None:
+            association.last_active = time.monotonic()
+            self._send(association, memoryview(payload)[end:])
+            return
+        target = self._resolver.cached(host, port)
+        if target is not None:
+            self._forward(key, client, target, user, payload[end:], time.monotonic())
+            return
+        # A new flow to a name: look it up off this thread, holding a few packets meanwhile
+        name = (host, port, socket.AF_UNSPEC)
+        waiting = self._waiting.setdefault(name, [])
+        if self._resolver.failed(host, port) or len(waiting) >= self.max_waiting:
+            self.dropped += 1
+            if not waiting:
+                del self._waiting[name]
+            return
+        waiting.append((key, client, user, payload[end:]))
+        self._resolver.resolve(host, port)
+
+    def _forward(self, key: tuple, client: tuple, target: Resolved, user: int,
+                 payload: bytes, now: float) -> None:
+        """Send a client payload on its flow's association, opening it if need be"""
+        association = self._associations.get(key)
+        if association is None:
+            association = self._associate(key, client, target, user, now)
+            if association is None:
+                return
+        association.last_active = now
+        self._send(association, payload)
+
+    def _send(self, association: _UDPAssociation, payload) -> None:
+        try:
+            association.upstream.send(payload)
+        except OSError:
+            self.dropped += 1
+
+    def _associate(self, key: tuple, client: tuple, resolved: Resolved, user: int,
+                   now: float) -> Optional[_UDPAssociation]:
+        """Open the upstream socket for a new flow, unless the table is full"""
+        if len(self._associations) >= self.max_associations:
+            self.dropped += 1
+            return None
+        try:
+            master = self._users.master(user)
+        except ValueError:
+            self.dropped += 1  # removed while its packet waited on the resolver
+            return None
+        family, target = resolved
+        upstream = None
+        try:
+            upstream = socket.socket(family, socket.SOCK_DGRAM)
+            upstream.setblocking(False)
+            upstream.connect(target)
+        except OSError as e:
+            logger.debug(f"UDP association to {target[0]}:{target[1]} failed: {e}")
+            if upstream is not None:
+                upstream.close()
+            self.dropped += 1
+            return None
+        association = _UDPAssociation(key, client, upstream, pack_address(target[0], target[1]),
+                                      user, master, now)
+        self._associations[key] = association
+        self._selector.register(upstream, selectors.EVENT_READ, association)
+        self._wheel.schedule(association, now + self.idle_timeout)
+        return association
+
+    def _drain_upstream(self, association: _UDPAssociation) -> None:
+        for _ in range(self.batch):
+            try:
+                data = association.upstream.recv(self.recv_size)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return  # e.g. ICMP port unreachable reported on the connected socket
+            association.last_active = time.monotonic()
+            packet = seal_packet(self._method, association.master, association.header + data)
+            try:
+                self._socket.sendto(packet, association.client)
+            except OSError:
+                self.dropped += 1
+                continue
+            self.sent += 1
+            self._users.record(association.user, sent=len(packet))
+
+    def _expire(self, now: float) -> None:
+        for association in self._wheel.advance(now):
+            if association.upstream is None:
+                continue
+            deadline = association.last_active + self.idle_timeout
+            if deadline > now:
+                self._wheel.schedule(association, deadline)
+            else:
+                self._close(association)
+                self.expired += 1
+
+    def _close(self, association: _UDPAssociation) -> None:
+        del self._associations[association.key]
+        self._selector.unregister(association.upstream)
+        association.upstream.close()
+        association.upstream = None
+
+    def get_stats(self):
+        """NAT table size and packet counters"""
+        return {
+            'associations': len(self._associations),
+            'received': self.received,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'invalid': self.invalid,
+            'expired': self.expired,
+        }
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Stop the relay thread and close every association"""
+        if not self._running:
+            return
+        self._running = False
+        self._wake()
+        self._thread.join(timeout=timeout)
+        self._resolver.close()
+        self._waiting.clear()
+        for association in list(self._associations.values()):
+            self._close(association)
+        self._selector.close()
+        self._socket.close()
+        for sock in self._waker:
+            sock.close()
+
 class ShadowsocksServer:
-    def __init__(self, password: Optional[str] = None, port: int = 8388, method: str = 'aes-256-gcm'):
+    def __init__(self, password: Optional[str] = None, port: int = 8388, method: str = 'aes-256-gcm',
+                 host: str = '0.0.0.0', recv_size: int = 65536, engine: str = 'threaded',
+                 backlog: int = DEFAULT_BACKLOG, max_connections: int = 1024,
+                 queue_size: int = 128, overflow: str = 'reject', udp: bool = False,
+                 udp_timeout: float = 60.0, max_udp_associations: int = 100000,
+                 users: Optional[Dict[str, str]] = None):
+        """
+        Args:
+            password: Key of the 'default' user; generated if neither it nor users is given
+            users: Further users as name -> password, all served on the same port
+            engine: 'threaded' (a pool of handler threads) or 'asyncio' (one event loop)
+            backlog: Listen queue length for connections not yet accepted
+            max_connections: Connections handled at once (handler threads, or open
+                connections on the event loop)
+            queue_size: Accepted connections waiting for a handler thread
+            overflow: 'reject' closes connections that find the queue full;
+                'wait' stops accepting until a handler frees up
+            udp: Also relay UDP on the same port
+            udp_timeout: Seconds before an idle UDP association is dropped
+            max_udp_associations: NAT table limit; new flows beyond it are dropped
+        """
         self.port = port
+        self.host = host
+        self.engine = validate_engine(engine)
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.udp = udp
+        self.udp_timeout = udp_timeout
+        self.max_udp_associations = max_udp_associations
         self.method = method
-        self.password = password or Fernet.generate_key().decode()
+        self._method = get_method(method)
+        self.password = password or (None if users else Fernet.generate_key().decode())
+        # Master keys are derived once per user; connections only run a cheap
+        # HKDF over the matching one with their salt
+        self.users = UserTable(self._method)
+        if self.password:
+            self.users.add('default', self.password)
+        for name, user_password in (users or {}).items():
+            self.users.add(name, user_password)
+        # One read can carry several full 16 KB chunks
+        self.recv_size = recv_size
         self._running = False
-        self._socket = None
-        self._thread_pool = []
-
-    def _encrypt_data(self, data: bytes) -> bytes:
-        """Encrypt data using the chosen method"""
-        if self.method.startswith('aes-256'):
-            cipher = Fernet(generate_strong_key(self.password))
-            return cipher.encrypt(data)
-        return data
-
-    def _decrypt_data(self, data: bytes) -> bytes:
-        """Decrypt data using the chosen method"""
-        if self.method.startswith('aes-256'):
-            cipher = Fernet(generate_strong_key(self.password))
-            return cipher.decrypt(data)
-        return data
+        self._listener = None
+        self._udp_relay: Optional[ShadowsocksUDPRelay] = None
+
+    def add_user(self, name: str, password: str) -> None:
+        """Accept a new user's key from the next connection on"""
+        self.users.add(name, password)
+        logger.info(f"Shadowsocks user added: {name}")
+
+    def remove_user(self, name: str) -> None:
+        """Refuse a user's key for new connections; open ones are left to finish"""
+        self.users.remove(name)
+        logger.info(f"Shadowsocks user removed: {name}")
+
+    def user_stats(self):
+        """Bytes and connections per user"""
+        return self.users.stats()
 
     def _handle_client(self, client_socket: socket.socket, address: tuple):
-        """Handle a client connection"""
+        """Handle a client connection
+
+        Each direction is a salt followed by length-prefixed AEAD chunks;
+        reads may end anywhere, so chunks are reassembled across them.
+        """
+        session = _ShadowsocksSession(self, address)
         try:
             while self._running:
-                data = client_socket.recv(4096)
+                data = client_socket.recv(self.recv_size)
                 if not data:
                     break
-                    
-                decrypted = self._decrypt_data(data)
-                response = b"ACK: " + decrypted
-                encrypted_response = self._encrypt_data(response)
-                client_socket.send(encrypted_response)
+
+                reply = session.receive(data)
+                if reply:
+                    client_socket.sendall(reply)
         except Exception as e:
             logger.error(f"Client handling error: {e}")
         finally:
+            session.close()
             client_socket.close()
 
     def start(self):
         """Start the Shadowsocks server"""
         self._running = True
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._socket.bind(('0.0.0.0', self.port))
-        self._socket.listen(5)
+        if self.engine == 'asyncio':
+            self._listener = EventLoopTCPServer(
+                lambda engine: _ShadowsocksProtocol(engine, self),
+                self.host, self.port, self.backlog, name='shadowsocks',
+                max_connections=self.max_connections)
+            self.port = self._listener.start()
+            logger.info(f"Shadowsocks server started on port {self.port} "
+                        f"(method: {self.method}, engine: asyncio)")
+        else:
+            self._listener = ThreadedTCPServer(
+                self._handle_client, self.host, self.port, self.backlog, name='shadowsocks',
+                max_connections=self.max_connections, queue_size=self.queue_size,
+                overflow=self.overflow)
+            self.port = self._listener.start()
 
-        logger.info(f"Shadowsocks server started on port {self.port} (method: {self.method})")
+            logger.info(f"Shadowsocks server started on port {self.port} (method: {self.method})")
 
-        # Start acceptor thread
-        acceptor = threading.Thread(target=self._accept_connections)
-        acceptor.daemon = True
-        acceptor.start()
-        self._thread_pool.append(acceptor)
+        if self.udp:
+            self._udp_relay = ShadowsocksUDPRelay(
+                self.users, self.host, self.port,
+                idle_timeout=self.udp_timeout, max_associations=self.max_udp_associations)
+            self._udp_relay.start()
+            logger.info(f"Shadowsocks UDP relay started on port {self.port}")
 
-    def _accept_connections(self):
-        """Accept incoming connections"""
-        while self._running:
-            try:
-                client_socket, address = self._socket.accept()
-                handler = threading.Thread(
-                    target=self._handle_client,
-                    args=(client_socket, address)
-                )
-                handler.daemon = True
-                handler.start()
-                self._thread_pool.append(handler)
-            except socket.error:
-                if self._running:
-                    logger.error("Socket accept error")
-
-    def stop(self):
-        """Stop the server"""
+    def get_stats(self):
+        """Connection counters of the active engine, plus the UDP relay's if enabled"""
+        stats = self._listener.get_stats() if self._listener is not None else {}
+        if self._udp_relay is not None:
+            stats['udp'] = self._udp_relay.get_stats()
+        return stats
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the server, waiting at most timeout for open connections to close"""
         self._running = False
-        if self._socket:
-            self._socket.close()
-        for thread in self._thread_pool:
-            thread.join(timeout=1.0)
+        if self._listener is not None:
+            self._listener.stop(timeout)
+            self._listener = None
+        if self._udp_relay is not None:
+            self._udp_relay.stop(timeout)
+            self._udp_relay = None
         logger.info("Shadowsocks server stopped")
 
     def __enter__(self):
@@ -0,0 +1,227 @@
+import time
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from cryptography.exceptions import InvalidTag
+from server.shadowsocks_crypto import CHUNK_LENGTH, AEADSession, Buffer, Method, master_key, open_packet
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class UserTable:
+    """Shadowsocks users sharing one listener, with per-user counters
+
+    Nothing on the wire names the user, so the first length header of a
+    connection (or a whole UDP packet) is trial-decrypted. Keys are tried
+    first from a short list of users recently seen at the client's IP,
+    then from the users recently seen anywhere. Only a miss there falls
+    back to the whole table, and each IP may start such a scan scan_rate
+    times a second (scan_burst at once), so junk from one source costs a
+    few keys per packet once its budget is spent while its real users
+    still get through on the next token. Counters are parallel arrays
+    indexed by user slot. Slots are never reused, so connections still open for a
+    removed user cannot be counted against a later one.
+    """
+
+    def __init__(self, method: Method, hints_per_ip: int = 4, max_hinted_ips: int = 65536,
+                 recent_users: int = 16, scan_rate: float = 1.0, scan_burst: int = 4,
+                 clock: Callable[[], float] = time.monotonic):
+        self.method = method
+        self.hints_per_ip = hints_per_ip
+        self.max_hinted_ips = max_hinted_ips
+        self.recent_users = recent_users
+        self.scan_rate = scan_rate
+        self.scan_burst = scan_burst
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._names: List[Optional[str]] = []
+        self._masters: List[Optional[bytes]] = []
+        self._slots: Dict[str, int] = {}
+        self._hints: 'OrderedDict[str, List[int]]' = OrderedDict()
+        self._recent: 'OrderedDict[int, None]' = OrderedDict()  # most recently identified last
+        self._scan_tokens: 'OrderedDict[str, List[float]]' = OrderedDict()  # IP -> [tokens, updated]
+        self.bytes_in = array('Q')
+        self.bytes_out = array('Q')
+        self.connections = array('Q')
+        self.active = array('q')
+        self.hint_hits = 0
+        self.recent_hits = 0
+        self.scans = 0
+        self.scans_skipped = 0
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._slots
+
+    def add(self, name: str, password: str) -> int:
+        """Register a user and return its slot"""
+        key = master_key(password, self.method.key_size)
+        with self._lock:
+            if name in self._slots:
+                raise ValueError(f"User already exists: {name}")
+            slot = len(self._masters)
+            self._names.append(name)
+            self._masters.append(key)
+            for counters in (self.bytes_in, self.bytes_out, self.connections, self.active):
+                counters.append(0)
+            self._slots[name] = slot
+        return slot
+
+    def remove(self, name: str) -> None:
+        """Stop accepting the user's key; its open connections run to completion"""
+        with self._lock:
+            try:
+                slot = self._slots.pop(name)
+            except KeyError:
+                raise ValueError(f"Unknown user: {name}") from None
+            self._masters[slot] = None
+            self._names[slot] = None
+
+    def master(self, slot: int) -> bytes:
+        """Master key of a live user"""
+        key = self._masters[slot]
+        if key is None:
+            raise ValueError("User was removed")
+        return key
+
+    def identify_stream(self, salt: bytes, header: Buffer, ip: str) -> Tuple[int, AEADSession, int]:
+        """Find the user whose key opens a connection's first length header
+
+        Returns the slot, the session (already past that header) and the
+        length of the first chunk. Raises ValueError if no user matches.
+        """
+        method = self.method
+
+        def attempt(key: bytes) -> Optional[Tuple[AEADSession, int]]:
+            session = AEADSession(method, key, salt)
+            try:
+                return session, CHUNK_LENGTH.unpack(session.decrypt(header))[0]
+            except InvalidTag:
+                return None
+
+        slot, (session, length) = self._identify(ip, attempt)
+        return slot, session, length
+
+    def identify_packet(self, packet: Buffer, ip: str) -> Tuple[int, bytes]:
+        """Find the user whose key opens a UDP packet; return the slot and payload"""
+        method = self.method
+
+        def attempt(key: bytes) -> Optional[bytes]:
+            try:
+                return open_packet(method, key, packet)
+            except InvalidTag:
+                return None
+
+        return self._identify(ip, attempt)
+
+    def _identify(self, ip: str, attempt: Callable[[bytes], Optional[T]]) -> Tuple[int, T]:
+        masters = self._masters
+        with self._lock:
+            hinted = tuple(self._hints.get(ip, ()))
+            recent = tuple(slot for slot in reversed(self._recent) if slot not in hinted)
+        for slot in hinted:
+            key = masters[slot]
+            if key is not None:
+                result = attempt(key)
+                if result is not None:
+                    self._remember(ip, slot, hinted=True)
+                    return slot, result
+        for slot in recent:
+            key = masters[slot]
+            if key is not None:
+                result = attempt(key)
+                if result is not None:
+                    self._remember(ip, slot, recent=True)
+                    return slot, result
+        if not self._take_scan(ip):
+            raise ValueError("No user key matches")
+        tried = set(hinted).union(recent)
+        for slot, key in enumerate(masters):
+            if key is None or slot in tried:
+                continue
+            result = attempt(key)
+            if result is not None:
+                self._remember(ip, slot)
+                return slot, result
+        raise ValueError("No user key matches")
+
+    def _take_scan(self, ip: str) -> bool:
+        """Spend one of ip's full-table scans; False if its budget is used up"""
+        now = self._clock()
+        with self._lock:
+            bucket = self._scan_tokens.get(ip)
+            if bucket is None:
+                bucket = self._scan_tokens[ip] = [float(self.scan_burst), now]
+                if len(self._scan_tokens) > self.max_hinted_ips:
+                    self._scan_tokens.popitem(last=False)
+            else:
+                self._scan_tokens.move_to_end(ip)
+                bucket[0] = min(self.scan_burst, bucket[0] + (now - bucket[1]) * self.scan_rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                self.scans_skipped += 1
+                return False
+            bucket[0] -= 1
+            self.scans += 1
+            return True
+
+    def _remember(self, ip: str, slot: int, hinted: bool = False, recent: bool = False) -> None:
+        """Put slot first in the IP's hint list and among the recent users"""
+        with self._lock:
+            if hinted:
+                self.hint_hits += 1
+            elif recent:
+                self.recent_hits += 1
+            self._recent[slot] = None
+            self._recent.move_to_end(slot)
+            if len(self._recent) > self.recent_users:
+                self._recent.popitem(last=False)
+            hints = self._hints.get(ip)
+            if hints is None:
+                hints = self._hints[ip] = []
+                if len(self._hints) > self.max_hinted_ips:
+                    self._hints.popitem(last=False)
+            else:
+                self._hints.move_to_end(ip)
+            if hints and hints[0] == slot:
+                return
+            if slot in hints:
+                hints.remove(slot)
+            hints.insert(0, slot)
+            del hints[self.hints_per_ip:]
+
+    def opened(self, slot: int) -> None:
+        with self._lock:
+            self.connections[slot] += 1
+            self.active[slot] += 1
+
+    def closed(self, slot: int) -> None:
+        with self._lock:
+            self.active[slot] -= 1
+
+    def record(self, slot: int, received: int = 0, sent: int = 0) -> None:
+        """Add wire bytes to a user's counters"""
+        with self._lock:
+            self.bytes_in[slot] += received
+            self.bytes_out[slot] += sent
+
+    def stats(self):
+        """Counters of every live user, by name"""
+        with self._lock:
+            return {
+                name: {
+                    'bytes_in': self.bytes_in[slot],
+                    'bytes_out': self.bytes_out[slot],
+                    'connections': self.connections[slot],
+                    'active': self.active[slot],
+                }
+                for name, slot in self._slots.items()
+            }
@@ -0,0 +1,152 @@
+import logging
+from typing import Callable, Dict, Optional, Tuple, Union
+
+from utils.socks_address import pack_address, parse_address
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+SOCKS_VERSION = 0x05
+AUTH_VERSION = 0x01
+METHOD_NO_AUTH = 0x00
+METHOD_USERNAME_PASSWORD = 0x02
+METHOD_NOT_ACCEPTABLE = 0xFF
+CMD_CONNECT = 0x01
+CMD_UDP_ASSOCIATE = 0x03
+
+# Reply codes (RFC 1928 section 6)
+REP_SUCCEEDED = 0x00
+REP_GENERAL_FAILURE = 0x01
+REP_NETWORK_UNREACHABLE = 0x03
+REP_HOST_UNREACHABLE = 0x04
+REP_CONNECTION_REFUSED = 0x05
+REP_TTL_EXPIRED = 0x06
+REP_COMMAND_NOT_SUPPORTED = 0x07
+REP_ADDRESS_NOT_SUPPORTED = 0x08
+
+AUTH_SUCCESS = bytes((AUTH_VERSION, 0x00))
+AUTH_FAILURE = bytes((AUTH_VERSION, 0x01))
+
+
+def reply(code: int, bound: Tuple[str, int] = ('0.0.0.0', 0)) -> bytes:
+    """Reply to a request: version, code, reserved, then the bound address"""
+    return bytes((SOCKS_VERSION, code, 0x00)) + pack_address(bound[0], bound[1])
+
+
+class SOCKS5Handshake:
+    """Server side of the SOCKS5 negotiation as a state machine over buffered input
+
+    feed() takes whatever bytes have arrived - a field split across
+    reads, or greeting, auth and request pipelined in one segment - and
+    parses as far as they go, returning the replies to send. It never
+    reads a socket itself, so the same object serves a blocking handler
+    thread and an event-loop protocol. The state ends as 'complete' (the
+    request is in command and target, and the caller sends the final
+    reply) or 'rejected' (the returned bytes already refuse the client).
+    Malformed input raises ValueError.
+    """
+
+    def __init__(self, auth: Optional[Tuple[str, str]] = None,
+                 commands: Tuple[int, ...] = (CMD_CONNECT,)):
+        self.auth = auth
+        self.commands = commands
+        self.state = 'greeting'
+        self.command: Optional[int] = None
+        self.target: Optional[Tuple[str, int]] = None
+        self._buffer = bytearray()
+        self._steps: Dict[str, Callable[[bytearray, int, bytearray], Optional[int]]] = {
+            'greeting': self._read_greeting,
+            'auth': self._read_auth,
+            'request': self._read_request,
+        }
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ('complete', 'rejected')
+
+    @property
+    def remaining(self) -> bytes:
+        """Bytes received after the request (data sent before the reply arrived)"""
+        return bytes(self._buffer)
+
+    def feed(self, data: Buffer) -> bytes:
+        """Consume received bytes; return the replies they call for (may be empty)"""
+        buffer = self._buffer
+        buffer += data
+        if self.finished:
+            return b''
+        output = bytearray()
+        offset = 0
+        while not self.finished:
+            end = self._steps[self.state](buffer, offset, output)
+            if end is None:
+                break
+            offset = end
+        del buffer[:offset]
+        return bytes(output)
+
+    def _read_greeting(self, buffer: bytearray, offset: int, output: bytearray) -> Optional[int]:
+        available = len(buffer) - offset
+        if available and buffer[offset] != SOCKS_VERSION:
+            raise ValueError("Invalid SOCKS version")
+        if available < 2:
+            return None
+        end = offset + 2 + buffer[offset + 1]
+        if len(buffer) < end:
+            return None
+        wanted = METHOD_USERNAME_PASSWORD if self.auth else METHOD_NO_AUTH
+        method = wanted if wanted in buffer[offset + 2:end] else METHOD_NOT_ACCEPTABLE
+        output += bytes((SOCKS_VERSION, method))
+        if method == METHOD_NOT_ACCEPTABLE:
+            self.state = 'rejected'
+        else:
+            self.state = 'auth' if self.auth else 'request'
+        return end
+
+    def _read_auth(self, buffer: bytearray, offset: int, output: bytearray) -> Optional[int]:
+        available = len(buffer) - offset
+        if available and buffer[offset] != AUTH_VERSION:
+            raise ValueError("Invalid auth version")
+        if available < 2:
+            return None
+        username_end = offset + 2 + buffer[offset + 1]
+        if len(buffer) < username_end + 1:
+            return None
+        end = username_end + 1 + buffer[username_end]
+        if len(buffer) < end:
+            return None
+        username = buffer[offset + 2:username_end].decode()
+        password = buffer[username_end + 1:end].decode()
+        if (username, password) != self.auth:
+            output += AUTH_FAILURE
+            self.state = 'rejected'
+        else:
+            output += AUTH_SUCCESS
+            self.state = 'request'
+        return end
+
+    def _read_request(self, buffer: bytearray, offset: int, output: bytearray) -> Optional[int]:
+        available = len(buffer) - offset
+        if available and buffer[offset] != SOCKS_VERSION:
+            raise ValueError("Invalid SOCKS version")
+        if available < 4:
+            return None
+        try:
+            address = parse_address(buffer, offset + 3)
+        except ValueError:
+            output += reply(REP_ADDRESS_NOT_SUPPORTED)
+            self.state = 'rejected'
+            return len(buffer)
+        if address is None:
+            return None
+        host, port, end = address
+        self.command = buffer[offset + 1]
+        if self.command not in self.commands:
+            output += reply(REP_COMMAND_NOT_SUPPORTED)
+            self.state = 'rejected'
+        else:
+            self.target = (host, port)
+            self.state = 'complete'
+        return end
@@ -1,90 +1,347 @@
-import logging
+import errno
 import socket
-import threading
+import asyncio
+import logging
 from typing import Optional, Tuple
+from server.socks5_handshake import (CMD_CONNECT, CMD_UDP_ASSOCIATE, REP_CONNECTION_REFUSED,
+                                     REP_GENERAL_FAILURE, REP_HOST_UNREACHABLE,
+                                     REP_NETWORK_UNREACHABLE, REP_SUCCEEDED, REP_TTL_EXPIRED,
+                                     SOCKS5Handshake, reply)
+from server.socks5_udp import SOCKS5UDPRelay
+from server.tcp_engine import (DEFAULT_BACKLOG, ConnectionProtocol, EventLoopTCPServer,
+                               ThreadedTCPServer, validate_engine)
+from server.tcp_relay import DEFAULT_BUFFER_SIZE, SPLICE_AVAILABLE, relay
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_ERRNO_REPLIES = {
+    errno.ECONNREFUSED: REP_CONNECTION_REFUSED,
+    errno.ENETUNREACH: REP_NETWORK_UNREACHABLE,
+    errno.EHOSTUNREACH: REP_HOST_UNREACHABLE,
+    errno.ETIMEDOUT: REP_TTL_EXPIRED,
+}
+
+
+def _failure_code(error: Exception) -> int:
+    """Reply code for an error raised while connecting to the target"""
+    if isinstance(error, socket.gaierror):
+        return REP_HOST_UNREACHABLE
+    if isinstance(error, (socket.timeout, asyncio.TimeoutError)):
+        return REP_TTL_EXPIRED
+    return _ERRNO_REPLIES.get(getattr(error, 'errno', None), REP_GENERAL_FAILURE)
+
+
+class _UpstreamProtocol(asyncio.Protocol):
+    """Target side of an event-loop CONNECT; writes go straight to the client"""
+
+    def __init__(self, client: '_SOCKS5Protocol'):
+        self.client = client
+        self.transport: Optional[asyncio.Transport] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport
+        # Before any data or EOF from the target can be delivered
+        self.client.upstream_connected(self)
+
+    def data_received(self, data: bytes) -> None:
+        self.client.transport.write(data)
+
+    def eof_received(self) -> bool:
+        self.client.upstream_eof()
+        return True  # keep the connection open for the client's remaining data
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.client.close()
+
+    def pause_writing(self) -> None:
+        self.client.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        self.client.transport.resume_reading()
+
+
+class _SOCKS5Protocol(ConnectionProtocol):
+    """Event-loop connection: feeds the handshake state machine, then relays"""
+
+    def __init__(self, engine: EventLoopTCPServer, server: 'SOCKS5Server'):
+        super().__init__(engine)
+        self.server = server
+        self.handshake = SOCKS5Handshake(server.auth, server.commands)
+        self._state = 'handshake'
+        self._pending = bytearray()  # client data received while connecting
+        self._upstream: Optional[_UpstreamProtocol] = None
+        self._association = None
+        self._client_eof = False
+        self._eofs = 0
+
+    def data_received(self, data: bytes) -> None:
+        if self._state == 'relay':
+            self._upstream.transport.write(data)
+            return
+        if self._state == 'connecting':
+            self._pending += data
+            return
+        if self._state != 'handshake':
+            return
+        try:
+            output = self.handshake.feed(data)
+        except ValueError as e:
+            logger.error(f"SOCKS5 handling error: {e}")
+            self.transport.abort()
+            return
+        if output:
+            self.transport.write(output)
+        if self.handshake.state == 'rejected':
+            self._finish()
+        elif self.handshake.command == CMD_UDP_ASSOCIATE:
+            self._associate()
+        elif self.handshake.state == 'complete':
+            self._state = 'connecting'
+            self._pending += self.handshake.remaining
+            asyncio.ensure_future(self._connect(*self.handshake.target))
+
+    def _associate(self) -> None:
+        """Open a UDP relay socket that lives as long as this connection"""
+        local = self.transport.get_extra_info('sockname')
+        peer = self.transport.get_extra_info('peername')
+        try:
+            self._association = self.server._udp_relay.open(local[0], peer[0], self.handshake.target[1])
+        except OSError as e:
+            logger.debug(f"SOCKS5 UDP associate failed: {e}")
+        if self._association is None:
+            self.transport.write(reply(REP_GENERAL_FAILURE))
+            self._finish()
+            return
+        self._state = 'associated'  # anything further from the client is ignored
+        self.transport.write(reply(REP_SUCCEEDED, self._association.address))
+
+    async def _connect(self, host: str, port: int) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(
+                loop.create_connection(lambda: _UpstreamProtocol(self), host, port),
+                self.server.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.debug(f"SOCKS5 connect to {host}:{port} failed: {e}")
+            if not self.transport.is_closing():
+                self.transport.write(reply(_failure_code(e)))
+                self._finish()
+
+    def upstream_connected(self, upstream: _UpstreamProtocol) -> None:
+        """Send the success reply and start relaying"""
+        if self.transport.is_closing():
+            upstream.transport.close()
+            return
+        self._upstream = upstream
+        self.transport.write(reply(REP_SUCCEEDED, upstream.transport.get_extra_info('sockname')[:2]))
+        self._state = 'relay'
+        if self._pending:
+            # Sent before the reply arrived (optimistic clients)
+            upstream.transport.write(bytes(self._pending))
+            self._pending.clear()
+        if self._client_eof:
+            upstream.transport.write_eof()
+            self._count_eof()
+
+    def eof_received(self) -> bool:
+        if self._state == 'connecting':
+            self._client_eof = True  # passed on once the target is connected
+            return True
+        if self._state != 'relay':
+            return False
+        self._upstream.transport.write_eof()
+        self._count_eof()
+        return True
+
+    def upstream_eof(self) -> None:
+        if self.transport.can_write_eof():
+            self.transport.write_eof()
+        self._count_eof()
+
+    def _count_eof(self) -> None:
+        """Close once both sides have half-closed"""
+        self._eofs += 1
+        if self._eofs == 2:
+            self.close()
+
+    def close(self) -> None:
+        super().close()
+        if self._upstream is not None and not self._upstream.transport.is_closing():
+            self._upstream.transport.close()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        super().connection_lost(exc)
+        if self._upstream is not None:
+            self._upstream.transport.close()
+        if self._association is not None:
+            self.server._udp_relay.close(self._association)
+
+    def pause_writing(self) -> None:
+        if self._upstream is not None:
+            self._upstream.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        if self._upstream is not None:
+            self._upstream.transport.resume_reading()
+
+    def _finish(self) -> None:
+        self._state = 'done'
+        self._pending.clear()
+        self.close()
+
 class SOCKS5Server:
-    def __init__(self, port: int = 1080, auth: Optional[Tuple[str, str]] = None):
+    def __init__(self, port: int = 1080, auth: Optional[Tuple[str, str]] = None,
+                 host: str = '0.0.0.0', engine: str = 'threaded', backlog: int = DEFAULT_BACKLOG,
+                 max_connections: int = 1024, queue_size: int = 128, overflow: str = 'reject',
+                 connect_timeout: float = 10.0, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                 splice: bool = False, handshake_buffer: int = 2048, udp: bool = True,
+                 max_udp_associations: int = 10000):
+        """
+        Args:
+            engine: 'threaded' (a pool of handler threads) or 'asyncio' (one event loop)
+            backlog: Listen queue length for connections not yet accepted
+            max_connections: Connections handled at once (handler threads, or open
+                connections on the event loop)
+            queue_size: Accepted connections waiting for a handler thread
+            overflow: 'reject' closes connections that find the queue full;
+                'wait' stops accepting until a handler frees up
+            connect_timeout: Seconds to wait for a CONNECT target
+            buffer_size: Relay buffer per direction (threaded engine)
+            splice: Relay with os.splice, without copying through user space
+                (threaded engine, Linux only)
+            handshake_buffer: Read size while negotiating (threaded engine); a
+                pipelined greeting, auth and request is at most 1032 bytes
+            udp: Accept UDP ASSOCIATE; each association gets its own relay
+                socket and ends when its TCP connection closes
+            max_udp_associations: UDP associations open at once
+        """
+        if splice and not SPLICE_AVAILABLE:
+            raise ValueError("splice needs os.splice (Linux, Python 3.10+)")
         self.port = port
+        self.host = host
         self.auth = auth
+        self.engine = validate_engine(engine)
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.connect_timeout = connect_timeout
+        self.buffer_size = buffer_size
+        self.splice = splice
+        self.handshake_buffer = handshake_buffer
+        self.udp = udp
+        self.max_udp_associations = max_udp_associations
+        self.commands = (CMD_CONNECT, CMD_UDP_ASSOCIATE) if udp else (CMD_CONNECT,)
         self._running = False
-        self._socket = None
-        self._thread_pool = []
+        self._listener = None
+        self._udp_relay: Optional[SOCKS5UDPRelay] = None
+
+    def _handshake(self, client_socket: socket.socket) -> Optional[SOCKS5Handshake]:
+        """Run the negotiation on a blocking socket; return the handshake if it completed
+
+        Each recv takes whatever has arrived, so a client that pipelines
+        greeting, auth and request costs one read.
+        """
+        handshake = SOCKS5Handshake(self.auth, self.commands)
+        buffer = bytearray(self.handshake_buffer)
+        while not handshake.finished:
+            count = client_socket.recv_into(buffer)
+            if not count:
+                raise ConnectionError("Client closed during handshake")
+            output = handshake.feed(memoryview(buffer)[:count])
+            if output:
+                client_socket.sendall(output)
+        return handshake if handshake.state == 'complete' else None
+
+    def _associate(self, client_socket: socket.socket, address: tuple,
+                   handshake: SOCKS5Handshake) -> None:
+        """UDP ASSOCIATE: relay datagrams until the client closes this connection"""
+        try:
+            association = self._udp_relay.open(client_socket.getsockname()[0], address[0],
+                                               handshake.target[1])
+        except OSError as e:
+            logger.debug(f"SOCKS5 UDP associate failed: {e}")
+            association = None
+        if association is None:
+            client_socket.sendall(reply(REP_GENERAL_FAILURE))
+            return
+        try:
+            client_socket.sendall(reply(REP_SUCCEEDED, association.address))
+            # The association lives as long as the connection; stop() shuts it down
+            while client_socket.recv(4096):
+                pass
+        finally:
+            self._udp_relay.close(association)
 
     def _handle_connection(self, client_socket: socket.socket, address: tuple):
-        """Handle SOCKS5 client connection"""
+        """Handle SOCKS5 client connection: handshake, CONNECT, then relay until both sides close"""
+        upstream = None
         try:
-            version = client_socket.recv(1)
-            if version != b'\x05':
-                raise ValueError("Invalid SOCKS version")
-
-            if self.auth:
-                client_socket.sendall(b'\x05\x02')  # Auth required
-                auth_version = client_socket.recv(1)
-                if auth_version != b'\x01':
-                    raise ValueError("Invalid auth version")
-
-                username_len = ord(client_socket.recv(1))
-                username = client_socket.recv(username_len).decode()
-                password_len = ord(client_socket.recv(1))
-                password = client_socket.recv(password_len).decode()
-
-                if (username, password) != self.auth:
-                    client_socket.sendall(b'\x01\x01')  # Auth failed
-                    return
-
-                client_socket.sendall(b'\x01\x00')  # Auth success
-            else:
-                client_socket.sendall(b'\x05\x00')  # No auth required
-
-            # Fake success (simplified)
-            client_socket.sendall(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
+            handshake = self._handshake(client_socket)
+            if handshake is None:
+                return
+            if handshake.command == CMD_UDP_ASSOCIATE:
+                self._associate(client_socket, address, handshake)
+                return
+            target = handshake.target
+            try:
+                upstream = socket.create_connection(target, timeout=self.connect_timeout)
+            except OSError as e:
+                logger.debug(f"SOCKS5 connect to {target[0]}:{target[1]} failed: {e}")
+                client_socket.sendall(reply(_failure_code(e)))
+                return
+            upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client_socket.sendall(reply(REP_SUCCEEDED, upstream.getsockname()[:2]))
+            if handshake.remaining:
+                upstream.sendall(handshake.remaining)
+            relay(client_socket, upstream, self.buffer_size, self.splice, lambda: self._running)
         except Exception as e:
             logger.error(f"SOCKS5 handling error: {e}")
         finally:
+            if upstream is not None:
+                upstream.close()
             client_socket.close()
 
     def start(self):
         """Start the SOCKS5 server"""
         self._running = True
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._socket.bind(('0.0.0.0', self.port))
-        self._socket.listen(5)
+        if self.udp:
+            self._udp_relay = SOCKS5UDPRelay(self.max_udp_associations)
+            self._udp_relay.start()
+        if self.engine == 'asyncio':
+            self._listener = EventLoopTCPServer(
+                lambda engine: _SOCKS5Protocol(engine, self),
+                self.host, self.port, self.backlog, name='socks5',
+                max_connections=self.max_connections)
+            self.port = self._listener.start()
+            logger.info(f"SOCKS5 server started on port {self.port} (engine: asyncio)")
+            return
+
+        self._listener = ThreadedTCPServer(
+            self._handle_connection, self.host, self.port, self.backlog, name='socks5',
+            max_connections=self.max_connections, queue_size=self.queue_size,
+            overflow=self.overflow)
+        self.port = self._listener.start()
 
         logger.info(f"SOCKS5 server started on port {self.port}")
 
-        acceptor = threading.Thread(target=self._accept_connections)
-        acceptor.daemon = True
-        acceptor.start()
-        self._thread_pool.append(acceptor)
+    def get_stats(self):
+        """Connection counters of the active engine, plus the UDP relay's if enabled"""
+        stats = self._listener.get_stats() if self._listener is not None else {}
+        if self._udp_relay is not None:
+            stats['udp'] = self._udp_relay.get_stats()
+        return stats
 
-    def _accept_connections(self):
-        """Accept incoming connections"""
-        while self._running:
-            try:
-                client_socket, address = self._socket.accept()
-                handler = threading.Thread(
-                    target=self._handle_connection,
-                    args=(client_socket, address)
-                )
-                handler.daemon = True
-                handler.start()
-                self._thread_pool.append(handler)
-            except socket.error:
-                if self._running:
-                    logger.error("Socket accept error")
-
-    def stop(self):
-        """Stop the server"""
+    def stop(self, timeout: float = 5.0):
+        """Stop the server, waiting at most timeout for open connections to close"""
         self._running = False
-        if self._socket:
-            self._socket.close()
-        for thread in self._thread_pool:
-            thread.join(timeout=1.0)
+        if self._listener is not None:
+            self._listener.stop(timeout)
+            self._listener = None
+        if self._udp_relay is not None:
+            self._udp_relay.stop(timeout)
+            self._udp_relay = None
         logger.info("SOCKS5 server stopped")
 
     def __enter__(self):
@@ -0,0 +1,274 @@
+import socket
+import logging
+import selectors
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from utils.resolver import BackgroundResolver, Name
+from utils.socks_address import pack_address, parse_address
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# RSV(2) FRAG(1) in front of the address of every UDP datagram (RFC 1928 section 7)
+UDP_HEADER = b'\x00\x00\x00'
+# Resolved targets and packed reply headers kept per association (least recently used go first)
+_CACHE_SIZE = 256
+
+
+def _remember(cache: 'OrderedDict', key, value) -> None:
+    cache[key] = value
+    if len(cache) > _CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+class _SOCKS5Association:
+    """One UDP ASSOCIATE: a relay socket shared by the client and every target it talks to"""
+
+    __slots__ = ('socket', 'client_host', 'client', 'targets', 'headers')
+
+    def __init__(self, sock: socket.socket, client_host: str, client_port: int):
+        self.socket = sock
+        self.client_host = client_host
+        # Learned from the first datagram unless the request named the port
+        self.client: Optional[tuple] = (client_host, client_port) if client_port else None
+        self.targets: 'OrderedDict[Tuple[str, int], tuple]' = OrderedDict()  # requested -> resolved
+        self.headers: 'OrderedDict[tuple, bytes]' = OrderedDict()  # reply source -> UDP_HEADER + address
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.socket.getsockname()[:2]
+
+
+class SOCKS5UDPRelay:
+    """Relays SOCKS5 UDP ASSOCIATE datagrams for every association of a server
+
+    Each association gets its own UDP socket: datagrams from the client's
+    address are unwrapped and sent to the target they name, anything else
+    arriving on the socket is a reply and goes back to the client behind
+    a header naming its source. A single selector thread serves all the
+    sockets and drains up to batch datagrams from a socket per wakeup.
+    Associations are opened and closed from connection handlers; the
+    relay thread applies the change, so sockets are never closed under it.
+    Target names are looked up on background threads, holding up to
+    max_waiting datagrams per name meanwhile, so one client's slow name
+    server never stalls the other associations.
+    """
+
+    def __init__(self, max_associations: int = 10000, recv_size: int = 65536, batch: int = 64,
+                 max_waiting: int = 32):
+        if max_associations <= 0 or batch <= 0:
+            raise ValueError("max_associations and batch must be positive")
+        self.max_associations = max_associations
+        self.recv_size = recv_size
+        self.batch = batch
+        self.max_waiting = max_waiting
+        self._associations: Set[_SOCKS5Association] = set()
+        self._changes: Deque[Tuple[bool, _SOCKS5Association]] = deque()
+        self._lock = threading.Lock()
+        self._running = False
+        self._selector: Optional[selectors.BaseSelector] = None
+        self._waker: Optional[Tuple[socket.socket, socket.socket]] = None
+        self._resolver: Optional[BackgroundResolver] = None
+        self._waiting: Dict[Name, List[Tuple[_SOCKS5Association, bytes]]] = {}
+        self._thread: Optional[threading.Thread] = None
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self.invalid = 0
+
+    def start(self) -> None:
+        """Start the relay thread"""
+        self._waker = socket.socketpair()
+        for sock in self._waker:
+            sock.setblocking(False)
+        self._resolver = BackgroundResolver(self._wake)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._waker[0], selectors.EVENT_READ, None)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='socks5-udp')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def open(self, local_host: str, client_host: str,
+             client_port: int = 0) -> Optional[_SOCKS5Association]:
+        """Bind a relay socket on local_host for a client; None if the table is full
+
+        Only datagrams from client_host are relayed out; client_port, if
+        the request gave one, pins the client's port as well.
+        """
+        with self._lock:
+            if len(self._associations) >= self.max_associations:
+                self.dropped += 1
+                return None
+            family = socket.AF_INET6 if ':' in local_host else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            try:
+                sock.bind((local_host, 0))
+                sock.setblocking(False)
+            except OSError:
+                sock.close()
+                raise
+            association = _SOCKS5Association(sock, client_host, client_port)
+            self._associations.add(association)
+            self._changes.append((True, association))
+        self._wake()
+        return association
+
+    def close(self, association: _SOCKS5Association) -> None:
+        """Tear an association down (its controlling TCP connection has closed)"""
+        with self._lock:
+            if association not in self._associations:
+                return
+            self._associations.discard(association)
+            self._changes.append((False, association))
+        self._wake()
+
+    def _wake(self) -> None:
+        try:
+            self._waker[1].send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # already pending, or stopped
+
+    def _drain_waker(self) -> None:
+        try:
+            while self._waker[0].recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        with self._lock:
+            changes, self._changes = self._changes, deque()
+        for opened, association in changes:
+            if opened:
+                self._selector.register(association.socket, selectors.EVENT_READ, association)
+            else:
+                self._selector.unregister(association.socket)  # always queued after its open
+                association.socket.close()
+        for name, resolved in self._resolver.completed():
+            host, port, _ = name
+            for association, payload in self._waiting.pop(name, ()):
+                if resolved is None or association.socket.fileno() == -1:
+                    self.dropped += 1
+                    continue
+                _remember(association.targets, (host, port), resolved[1])
+                self._send(association, payload, resolved[1], host, port)
+
+    def _run(self) -> None:
+        selector = self._selector
+        while self._running:
+            for key, _ in selector.select(timeout=1.0):
+                if key.data is None:
+                    self._drain_waker()
+                elif key.data.socket.fileno() != -1:
+                    self._drain(key.data)
+
+    def _drain(self, association: _SOCKS5Association) -> None:
+        sock = association.socket
+        for _ in range(self.batch):
+            try:
+                data, source = sock.recvfrom(self.recv_size)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # e.g. ICMP port unreachable from an earlier send
+            self.received += 1
+            source = source[:2]
+            client = association.client
+            if client is None and source[0] == association.client_host:
+                client = association.client = source
+            if source == client:
+                self._from_client(association, data)
+            elif client is not None:
+                self._to_client(association, data, source)
+            else:
+                self.dropped += 1  # a reply before the client has sent anything
+
+    def _from_client(self, association: _SOCKS5Association, data: bytes) -> None:
+        if len(data) < 4 or data[:2] != UDP_HEADER[:2]:
+            self.invalid += 1
+            return
+        if data[2]:
+            self.dropped += 1  # fragmentation is optional and not supported
+            return
+        try:
+            address = parse_address(data, 3)
+        except (ValueError, UnicodeError):
+            address = None
+        if address is None:
+            self.invalid += 1
+            return
+        host, port, end = address
+        target = association.targets.get((host, port))
+        if target is not None:
+            association.targets.move_to_end((host, port))
+            self._send(association, memoryview(data)[end:], target, host, port)
+            return
+        family = association.socket.family
+        resolved = self._resolver.cached(host, port, family)
+        if resolved is not None:
+            _remember(association.targets, (host, port), resolved[1])
+            self._send(association, memoryview(data)[end:], resolved[1], host, port)
+            return
+        # Look the name up off this thread, holding a few datagrams meanwhile
+        name = (host, port, family)
+        waiting = self._waiting.setdefault(name, [])
+        if self._resolver.failed(host, port, family) or len(waiting) >= self.max_waiting:
+            self.dropped += 1
+            if not waiting:
+                del self._waiting[name]
+            return
+        waiting.append((association, data[end:]))
+        self._resolver.resolve(host, port, family)
+
+    def _send(self, association: _SOCKS5Association, payload, target: tuple,
+              host: str, port: int) -> None:
+        try:
+            association.socket.sendto(payload, target)
+        except OSError as e:
+            logger.debug(f"SOCKS5 UDP send to {host}:{port} failed: {e}")
+            self.dropped += 1
+
+    def _to_client(self, association: _SOCKS5Association, data: bytes, source: tuple) -> None:
+        header = association.headers.get(source)
+        if header is None:
+            header = UDP_HEADER + pack_address(source[0], source[1])
+            _remember(association.headers, source, header)
+        else:
+            association.headers.move_to_end(source)
+        try:
+            association.socket.sendto(header + data, association.client)
+        except OSError:
+            self.dropped += 1
+            return
+        self.sent += 1
+
+    def get_stats(self):
+        """Open associations and datagram counters"""
+        return {
+            'associations': len(self._associations),
+            'received': self.received,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'invalid': self.invalid,
+        }
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Stop the relay thread and close every association"""
+        if not self._running:
+            return
+        self._running = False
+        self._wake()
+        self._thread.join(timeout=timeout)
+        self._resolver.close()
+        self._waiting.clear()
+        with self._lock:
+            associations = set(self._associations)
+            associations.update(association for _, association in self._changes)
+            self._associations.clear()
+            self._changes.clear()
+        for association in associations:
+            association.socket.close()
+        self._selector.close()
+        for sock in self._waker:
+            sock.close()
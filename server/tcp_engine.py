@@ -0,0 +1,300 @@
+import time
+import queue
+import socket
+import asyncio
+import threading
+import logging
+from typing import Callable, List, Optional, Set, Tuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TCP_ENGINES = ('threaded', 'asyncio')
+DEFAULT_BACKLOG = socket.SOMAXCONN
+# What the threaded engine does with a connection when every worker is busy
+# and the queue is full: close it at once, or stop accepting until there is room
+OVERFLOW_POLICIES = ('reject', 'wait')
+
+
+def validate_engine(engine: str) -> str:
+    """Reject engine names other than TCP_ENGINES"""
+    if engine not in TCP_ENGINES:
+        raise ValueError(f"Invalid engine. Must be one of {list(TCP_ENGINES)}")
+    return engine
+
+
+class ConnectionProtocol(asyncio.Protocol):
+    """Per-connection state on the event loop; subclasses implement data_received"""
+
+    def __init__(self, engine: 'EventLoopTCPServer'):
+        self.engine = engine
+        self.transport: Optional[asyncio.Transport] = None
+        self.address = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        self.engine._admit(self)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.engine.connections.discard(self)
+
+    def close(self) -> None:
+        """Close once pending writes are flushed"""
+        if self.transport is not None:
+            self.transport.close()
+
+
+class EventLoopTCPServer:
+    """TCP listener whose connections are protocol objects on one event loop
+
+    The loop runs on a single background thread, so idle connections cost
+    a protocol object and a socket rather than an OS thread each. Beyond
+    max_connections open at once, new connections are closed on arrival.
+    """
+
+    def __init__(self, protocol_factory: Callable[['EventLoopTCPServer'], ConnectionProtocol],
+                 host: str = '0.0.0.0', port: int = 0, backlog: int = DEFAULT_BACKLOG,
+                 name: str = 'tcp', max_connections: int = 10000):
+        if max_connections <= 0:
+            raise ValueError("max_connections must be positive")
+        self.protocol_factory = protocol_factory
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.name = name
+        self.max_connections = max_connections
+        self.connections: Set[ConnectionProtocol] = set()
+        self.accepted = 0
+        self.rejected = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def start(self) -> int:
+        """Bind, start the loop thread and return the listening port"""
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name=f'{self.name}-loop')
+        self._thread.daemon = True
+        self._thread.start()
+        future = asyncio.run_coroutine_threadsafe(self._loop.create_server(
+            lambda: self.protocol_factory(self), self.host, self.port,
+            backlog=self.backlog, reuse_address=True), self._loop)
+        try:
+            self._server = future.result(timeout=10)
+        except Exception:
+            self._shutdown_loop()
+            raise
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    def _admit(self, protocol: ConnectionProtocol) -> None:
+        """Track a new connection, or drop it if the server is full"""
+        self.accepted += 1
+        if len(self.connections) >= self.max_connections:
+            self.rejected += 1
+            protocol.transport.abort()
+            return
+        self.connections.add(protocol)
+
+    def get_stats(self):
+        """Connection counters"""
+        return {
+            'engine': 'asyncio',
+            'active': len(self.connections),
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+        }
+
+    async def _close(self) -> None:
+        self._server.close()
+        for protocol in list(self.connections):
+            if protocol.transport is not None:
+                protocol.transport.abort()
+        await self._server.wait_closed()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Stop accepting, drop open connections and end the loop thread"""
+        if self._loop is None:
+            return
+        if self._server is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(self._close(), self._loop).result(timeout=timeout)
+            except Exception as e:
+                logger.error(f"Error closing {self.name} listener: {e}")
+            self._server = None
+        self._shutdown_loop(timeout)
+
+    def _shutdown_loop(self, timeout: float = 5.0) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=timeout)
+        if not self._thread.is_alive():
+            self._loop.close()
+        self._loop = None
+        self._thread = None
+
+
+class ThreadedTCPServer:
+    """TCP listener handing accepted sockets to a bounded pool of handler threads
+
+    At most max_connections sockets are handled at once, by worker threads
+    that are started on demand and reused. Up to queue_size more wait for
+    a free worker; past that, overflow decides between closing the new
+    connection ('reject') and not accepting until a slot frees up, leaving
+    clients in the kernel backlog ('wait'). stop() unblocks every handler
+    at once and returns within its timeout however many connections the
+    server has seen.
+    """
+
+    def __init__(self, handler: Callable[[socket.socket, tuple], None],
+                 host: str = '0.0.0.0', port: int = 0, backlog: int = DEFAULT_BACKLOG,
+                 name: str = 'tcp', max_connections: int = 1024, queue_size: int = 128,
+                 overflow: str = 'reject'):
+        if max_connections <= 0 or queue_size <= 0:
+            raise ValueError("max_connections and queue_size must be positive")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy. Must be one of {list(OVERFLOW_POLICIES)}")
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.name = name
+        self.max_connections = max_connections
+        self.overflow = overflow
+        self._queue: 'queue.Queue[Tuple[socket.socket, tuple]]' = queue.Queue(queue_size)
+        # With 'wait', a connection is only accepted once it has a handler or queue slot
+        self._room = threading.Semaphore(max_connections + queue_size) if overflow == 'wait' else None
+        self._lock = threading.Lock()
+        self._active: Set[socket.socket] = set()
+        self._workers: List[threading.Thread] = []
+        self._idle = 0
+        self._running = False
+        self._socket: Optional[socket.socket] = None
+        self._acceptor: Optional[threading.Thread] = None
+        self.accepted = 0
+        self.rejected = 0
+        self.completed = 0
+
+    def start(self) -> int:
+        """Bind, start accepting and return the listening port"""
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.listen(self.backlog)
+        self.port = self._socket.getsockname()[1]
+        self._running = True
+        self._acceptor = threading.Thread(target=self._accept_loop, name=f'{self.name}-accept')
+        self._acceptor.daemon = True
+        self._acceptor.start()
+        return self.port
+
+    def _accept_loop(self) -> None:
+        while self._running:
+            if self._room is not None and not self._room.acquire(timeout=0.5):
+                continue  # full: leave new clients in the kernel backlog
+            try:
+                client_socket, address = self._socket.accept()
+            except OSError:
+                if self._room is not None:
+                    self._room.release()
+                if self._running:
+                    logger.error("Socket accept error")
+                    continue
+                return
+            self.accepted += 1
+            self._ensure_worker()
+            if self._room is not None:
+                # Never blocks for long: the slot is held, workers are just picking up
+                while self._running:
+                    try:
+                        self._queue.put((client_socket, address), timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                else:
+                    client_socket.close()
+                continue
+            try:
+                self._queue.put_nowait((client_socket, address))
+            except queue.Full:
+                self.rejected += 1
+                client_socket.close()
+                logger.debug(f"{self.name} saturated, rejected connection from {address}")
+
+    def _ensure_worker(self) -> None:
+        """Start another worker if none is idle and the pool has room"""
+        with self._lock:
+            if self._idle > self._queue.qsize() or len(self._workers) >= self.max_connections:
+                return
+            self._idle += 1
+            worker = threading.Thread(target=self._work, name=f'{self.name}-worker-{len(self._workers)}')
+            worker.daemon = True
+            self._workers.append(worker)
+        worker.start()
+
+    def _work(self) -> None:
+        while self._running:
+            try:
+                client_socket, address = self._queue.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            with self._lock:
+                self._idle -= 1
+                self._active.add(client_socket)
+            try:
+                self.handler(client_socket, address)
+            except Exception as e:
+                logger.error(f"{self.name} handler error: {e}")
+            finally:
+                client_socket.close()
+                with self._lock:
+                    self._active.discard(client_socket)
+                    self._idle += 1
+                    self.completed += 1
+                if self._room is not None:
+                    self._room.release()
+
+    def get_stats(self):
+        """Connection and pool counters"""
+        with self._lock:
+            return {
+                'engine': 'threaded',
+                'active': len(self._active),
+                'queued': self._queue.qsize(),
+                'workers': len(self._workers),
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+            }
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Stop accepting, unblock all handlers at once and wait up to timeout"""
+        if not self._running:
+            return
+        deadline = time.monotonic() + timeout
+        self._running = False
+        if self._socket is not None:
+            try:
+                # Wakes a thread blocked in accept(), which close() alone does not
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
+        while True:
+            try:
+                client_socket, _ = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            client_socket.close()
+        with self._lock:
+            active = list(self._active)
+        for client_socket in active:
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for thread in [self._acceptor] + self._workers:
+            thread.join(timeout=max(0.0, deadline - time.monotonic()))
+        alive = sum(thread.is_alive() for thread in self._workers)
+        if alive:
+            logger.warning(f"{self.name}: {alive} handler threads still running after stop")
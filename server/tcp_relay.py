@@ -0,0 +1,175 @@
+import os
+import socket
+import logging
+import selectors
+from typing import Callable, List, Optional, Tuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 65536
+# os.splice is Linux-only (Python 3.10+)
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+
+
+class _Direction:
+    """One way of a relay: reads src into a preallocated buffer, writes it to dst
+
+    Only one buffer's worth is in flight at a time; while it is being
+    written, src is not read, so a slow reader pushes back on the sender.
+    """
+
+    def __init__(self, src: socket.socket, dst: socket.socket, buffer_size: int):
+        self.src = src
+        self.dst = dst
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self.eof = False  # src has finished sending
+        self.done = False  # ... and everything it sent has been passed on
+        self.transferred = 0
+
+    @property
+    def pending(self) -> bool:
+        return self._start < self._end
+
+    @property
+    def wants_read(self) -> bool:
+        return not self.eof and not self.pending
+
+    def read(self) -> None:
+        try:
+            count = self.src.recv_into(self._buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not count:
+            self.eof = True
+            self._finish()
+            return
+        self._start, self._end = 0, count
+        self.write()
+
+    def write(self) -> None:
+        view = self._view
+        while self._start < self._end:
+            try:
+                sent = self.dst.send(view[self._start:self._end])
+            except (BlockingIOError, InterruptedError):
+                return
+            self._start += sent
+            self.transferred += sent
+
+    def _finish(self) -> None:
+        """Pass the half-close on: dst sees EOF but can still send to us"""
+        self.done = True
+        try:
+            self.dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        self._view.release()
+
+
+class _SpliceDirection(_Direction):
+    """Like _Direction, but bytes move socket -> pipe -> socket inside the kernel"""
+
+    def __init__(self, src: socket.socket, dst: socket.socket, buffer_size: int):
+        self.src = src
+        self.dst = dst
+        self._size = buffer_size
+        self._pipe_r, self._pipe_w = os.pipe()
+        for fd in (self._pipe_r, self._pipe_w):
+            os.set_blocking(fd, False)
+        self._in_pipe = 0
+        self.eof = False
+        self.done = False
+        self.transferred = 0
+
+    @property
+    def pending(self) -> bool:
+        return self._in_pipe > 0
+
+    def read(self) -> None:
+        try:
+            count = os.splice(self.src.fileno(), self._pipe_w, self._size,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not count:
+            self.eof = True
+            self._finish()
+            return
+        self._in_pipe = count
+        self.write()
+
+    def write(self) -> None:
+        while self._in_pipe:
+            try:
+                sent = os.splice(self._pipe_r, self.dst.fileno(), self._in_pipe,
+                                 flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except (BlockingIOError, InterruptedError):
+                return
+            self._in_pipe -= sent
+            self.transferred += sent
+
+    def close(self) -> None:
+        os.close(self._pipe_r)
+        os.close(self._pipe_w)
+
+
+def relay(client: socket.socket, upstream: socket.socket, buffer_size: int = DEFAULT_BUFFER_SIZE,
+          splice: bool = False, running: Optional[Callable[[], bool]] = None,
+          poll_interval: float = 1.0) -> Tuple[int, int]:
+    """Copy bytes both ways between two connected sockets until both sides are done
+
+    Runs on the calling thread with both sockets non-blocking, so neither
+    direction can stall the other. EOF from one side is passed on as a
+    half-close and the other direction keeps flowing until it ends too.
+    With splice, data never enters user space (Linux only). running is
+    checked every poll_interval seconds; returning False ends the relay.
+    Returns the bytes sent upstream and downstream.
+    """
+    if splice and not SPLICE_AVAILABLE:
+        raise ValueError("os.splice is not available on this platform")
+    direction_class = _SpliceDirection if splice else _Direction
+    client.setblocking(False)
+    upstream.setblocking(False)
+    directions: List[_Direction] = [direction_class(client, upstream, buffer_size),
+                                    direction_class(upstream, client, buffer_size)]
+    masks = {client: 0, upstream: 0}
+    selector = selectors.DefaultSelector()
+    try:
+        while not all(direction.done for direction in directions):
+            for sock in masks:
+                mask = 0
+                for direction in directions:
+                    if direction.src is sock and direction.wants_read:
+                        mask |= selectors.EVENT_READ
+                    if direction.dst is sock and direction.pending:
+                        mask |= selectors.EVENT_WRITE
+                if mask != masks[sock]:
+                    if not masks[sock]:
+                        selector.register(sock, mask)
+                    elif not mask:
+                        selector.unregister(sock)
+                    else:
+                        selector.modify(sock, mask)
+                    masks[sock] = mask
+            events = selector.select(poll_interval)
+            if running is not None and not running():
+                break
+            for key, mask in events:
+                for direction in directions:
+                    if mask & selectors.EVENT_WRITE and direction.dst is key.fileobj and direction.pending:
+                        direction.write()
+                    if mask & selectors.EVENT_READ and direction.src is key.fileobj and direction.wants_read:
+                        direction.read()
+    except OSError as e:
+        logger.debug(f"Relay ended by socket error: {e}")
+    finally:
+        selector.close()
+        for direction in directions:
+            direction.close()
+    return directions[0].transferred, directions[1].transferred
@@ -12,6 +12,10 @@ setup(
         'psutil>=5.8',
         'backoff>=1.10',
     ],
+    extras_require={
+        'http2': ['httpx[http2]>=0.23'],
+        'numpy': ['numpy>=1.17'],
+    },
     entry_points={
         'console_scripts': [
             'vpn-tunnel-server=server.cli:main',
@@ -2,12 +2,46 @@ import unittest
 from unittest.mock import patch, MagicMock
 import tempfile
 import os
+from cryptography.exceptions import InvalidTag
 from server.wireguard_server import WireGuardServer
 from server.obfuscation import Obfuscator
+from client.obfuscation import ClientObfuscator
+from utils import xor_engine
+from utils.tls_framing import send_buffers
+from utils.dns_framing import DNSReassembler, segment_payload
+from utils import transforms
+from utils.transforms import TransformStage, register_transform
+from utils.socks_address import pack_address, parse_address
+from utils.timer_wheel import TimerWheel
+from server.dns_server import DNSOverHTTPS, DNS_ENGINES, create_dns_server
+from server.dns_blocklist import Blocklist, wire_name
+from server.dns_cache import DNSCache, SharedHotSet
+from server.dns_sharding import DNSShardSupervisor, _Shard, merge_stats
+from server.doh_server import DOHServer
+from server import shadowsocks_crypto
+from server.shadowsocks_server import ShadowsocksServer, ShadowsocksUDPRelay
+from server.shadowsocks_users import UserTable
+from server.socks5_server import SOCKS5Server
+from server.socks5_handshake import SOCKS5Handshake
+from server.socks5_udp import SOCKS5UDPRelay
+from server.tcp_engine import TCP_ENGINES
+from server.dns_singleflight import AsyncSingleFlight
+from server.dns_upstream import UpstreamSessionPool
+from server.dns_wire import question_key, edns_payload_size, truncate_response
+from dnslib import DNSRecord, RR, A, SOA, QTYPE, RCODE, EDNS0
+import struct
+import base64
+import multiprocessing
+import http.client
 from client.protocol_switcher import ProtocolSwitcher, Protocol
 from client.kill_switch import KillSwitch
 import socket
+import threading
+import time
+import asyncio
 import iptc
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 class TestWireGuardServer(unittest.TestCase):
     @patch('subprocess.run')
@@ -36,6 +70,1326 @@ class TestObfuscator(unittest.TestCase):
         obfuscated = o.xor_obfuscate(data)
         self.assertEqual(o.xor_obfuscate(obfuscated), data)
 
+    def test_xor_matches_per_byte_reference(self):
+        key = b'\xAA\x55\xAA\x55'
+        for size in (1, 7, 1500, 70000):
+            data = os.urandom(size)
+            expected = bytes(x ^ key[i % len(key)] for i, x in enumerate(data))
+            self.assertEqual(Obfuscator().xor_obfuscate(data), expected)
+            buffer = bytearray(data)
+            Obfuscator().xor_obfuscate_into(memoryview(buffer))
+            self.assertEqual(buffer, expected)
+        # Pieces processed with a running offset equal one pass over the whole
+        data = os.urandom(103)
+        self.assertEqual(xor_engine.xor_bytes(data[:50], key) + xor_engine.xor_bytes(data[50:], key, offset=50),
+                         xor_engine.xor_bytes(data, key))
+
+    def test_client_xor_keeps_sequence_counter(self):
+        client = ClientObfuscator(obfuscation_mode='xor')
+        client.sequence_counter = 65535
+        for seq in (65535, 0):
+            data = os.urandom(3000)
+            key = b'\xAA\x55\xAA\x55' + seq.to_bytes(4, 'big')
+            expected = bytes(x ^ key[i % len(key)] for i, x in enumerate(data))
+            self.assertEqual(client.obfuscate(data), expected)
+        self.assertEqual(client.sequence_counter, 1)
+
+    def test_aead_encryption_modes(self):
+        key = Obfuscator().get_key()
+        for mode in ('aes-256-gcm', 'chacha20-poly1305'):
+            server = Obfuscator(key, encryption=mode)
+            client = ClientObfuscator(key, encryption=mode)
+            data = os.urandom(1400)
+            token = client.encrypt(data)
+            # 12-byte nonce and 16-byte tag, no encoding
+            self.assertEqual(len(token), len(data) + 28)
+            self.assertNotEqual(client.encrypt(data)[:12], token[:12])
+            self.assertEqual(server.decrypt(token), data)
+            self.assertEqual(client.decrypt(server.encrypt(b'')), b'')
+
+            tampered = bytearray(token)
+            tampered[-1] ^= 1
+            with self.assertRaises(InvalidTag):
+                server.decrypt(bytes(tampered))
+
+            client.rotate_key()
+            self.assertEqual(client.decrypt(client.encrypt(data)), data)
+            with self.assertRaises(InvalidTag):
+                client.decrypt(token)
+        with self.assertRaises(ValueError):
+            Obfuscator(encryption='aes-128-cbc')
+
+class TestTLSFraming(unittest.TestCase):
+    def test_client_records_survive_arbitrary_chunking(self):
+        sender, receiver = ClientObfuscator(), ClientObfuscator()
+        payloads = [os.urandom(size) for size in (0, 1, 23, 1400, 65535)] * 7
+        # Covers every padding length the sender appends, including 0x17
+        stream = b''.join(sender.obfuscate(payload) for payload in payloads)
+
+        received, offset, step = b'', 0, 1
+        while offset < len(stream):
+            received += receiver.deobfuscate(stream[offset:offset + step])
+            offset += step
+            step = step * 3 % 9001 + 1
+        self.assertEqual(received, b''.join(payloads))
+
+        with self.assertRaises(ValueError):
+            ClientObfuscator().deobfuscate(b'GET / HTTP/1.1\r\n')
+
+    def test_large_payloads_span_several_records(self):
+        payload = os.urandom(300000)
+        wrapped = Obfuscator().tls_wrap(payload)
+        lengths, offset = [], 0
+        while offset < len(wrapped):
+            lengths.append(struct.unpack_from('>H', wrapped, offset + 3)[0])
+            offset += 5 + lengths[-1]
+        self.assertEqual(lengths, [65535] * 4 + [300000 - 4 * 65535])
+
+        sender = ClientObfuscator(tls_record_size=1395)
+        sender.sequence_counter = 5
+        wrapped = sender.obfuscate(payload)
+        # 215 full-size records, a short last one, then 5 bytes of padding
+        self.assertEqual(len(wrapped), 300000 + 5 * 216 + 5)
+        self.assertEqual(ClientObfuscator().deobfuscate(wrapped), payload)
+        with self.assertRaises(ValueError):
+            ClientObfuscator(tls_record_size=70000)
+
+    def test_sendmsg_to_recv_into_without_copies(self):
+        left, right = socket.socketpair()
+        payloads = [os.urandom(65535) for _ in range(8)] + [os.urandom(2 * 1024 * 1024)]
+        # Small records put more buffers in one sendmsg list than IOV_MAX
+        obfuscator = Obfuscator(tls_record_size=1000)
+
+        def send():
+            for payload in payloads:
+                send_buffers(left, obfuscator.tls_wrap_iov(payload))
+            left.close()
+
+        thread = threading.Thread(target=send)
+        thread.start()
+        deframer, received = obfuscator.tls_deframer(), []
+        while True:
+            count = right.recv_into(deframer.writable())
+            if not count:
+                break
+            for view in deframer.commit(count):
+                self.assertIsInstance(view, memoryview)
+                received.append(bytes(view))
+        thread.join()
+        right.close()
+        self.assertEqual(b''.join(received), b''.join(payloads))
+
+class TestDNSFraming(unittest.TestCase):
+    def test_large_payload_survives_reordering(self):
+        sender, receiver = ClientObfuscator(obfuscation_mode='dns'), ClientObfuscator(obfuscation_mode='dns')
+        payload = os.urandom(20000)
+        packets = sender._dns_packets(payload)
+        self.assertGreater(len(packets), 40)
+        self.assertTrue(all(len(packet) <= 512 for packet in packets))
+        self.assertEqual(DNSRecord.parse(packets[0]).q.qname, 'example.com.')
+
+        shuffled = packets[::-1]
+        # Duplicates of fragments still being reassembled are ignored
+        received = b''.join(receiver.deobfuscate(packet) for packet in shuffled[:3] + shuffled)
+        self.assertEqual(received, payload)
+        self.assertEqual(receiver._chain('dns').stages[0].reassembler.stats()['duplicates'], 3)
+        # Concatenated packets (stream transports) decode the same way
+        self.assertEqual(Obfuscator().dns_reassembler().feed(sender.obfuscate(b'x' * 1000)), [b'x' * 1000])
+        self.assertEqual(receiver.deobfuscate(sender.obfuscate(b'')), b'')
+
+    def test_reassembly_buffer_is_bounded(self):
+        reassembler = DNSReassembler(max_messages=2, timeout=0.05)
+        messages = [segment_payload(os.urandom(2000), message_id) for message_id in range(4)]
+        for packets in messages:
+            self.assertEqual(reassembler.feed(packets[0]), [])
+        self.assertEqual(reassembler.pending, 2)
+        self.assertEqual(reassembler.stats()['evicted'], 2)
+        # Stale fragments are dropped once the timeout passes
+        time.sleep(0.1)
+        self.assertEqual(reassembler.feed(messages[3][1]), [])
+        self.assertEqual(reassembler.pending, 1)
+        with self.assertRaises(ValueError):
+            reassembler.feed(b'\x00' * 12)
+
+class TestTransformChains(unittest.TestCase):
+    def test_client_chain_round_trip(self):
+        key = Obfuscator().get_key()
+        sender = ClientObfuscator(key, encryption='aes-256-gcm', tls_record_size=1000)
+        receiver = ClientObfuscator(key, encryption='aes-256-gcm', tls_record_size=1000)
+        sender.set_mode('encrypt>xor>tls')
+        receiver.set_mode('encrypt>xor>tls')
+        payloads = [os.urandom(size) for size in (1, 500, 900, 300)]
+        stream = b''.join(sender.obfuscate(payload) for payload in payloads)
+        # Records split across reads and several messages in one read
+        received = receiver.deobfuscate(stream[:700]) + receiver.deobfuscate(stream[700:])
+        self.assertEqual(received, b''.join(payloads))
+        self.assertEqual(receiver.sequence_counter, sender.sequence_counter)
+        self.assertIs(sender._chain('encrypt>xor>tls'), sender._chain('encrypt>xor>tls'))
+        with self.assertRaises(ValueError):
+            sender.set_mode('encrypt>rot13')
+
+    def test_single_stage_modes_keep_wire_format(self):
+        # Bytes pinned from the per-mode implementation that peers already run
+        client = ClientObfuscator(obfuscation_mode='xor')
+        sent = [(mode, client.obfuscate(data, mode)) for mode, data in
+                (('dns', b'hi'), ('none', b'plain'), ('tls', b'abc'), ('xor', b'secret'), ('tls', b'xyz'))]
+        self.assertEqual([data.hex() for _, data in sent], [
+            '000001000001000000000000076578616d706c6503636f6d00000100010000000100026869',
+            '706c61696e',
+            '1703030003616263',
+            'd930c9276574',
+            '170303000378797a0202',
+        ])
+        self.assertEqual(client.sequence_counter, 3)  # only xor and tls encodes count
+        self.assertEqual(client.deobfuscate(sent[3][1], 'xor'), b'secret')
+        self.assertEqual(client.deobfuscate(sent[2][1], 'tls'), b'abc')
+        self.assertEqual(client.deobfuscate(sent[0][1], 'dns'), b'hi')
+        self.assertEqual(client.sequence_counter, 4)
+        self.assertEqual(client.obfuscate(b'again', 'xor').hex(), 'cb32cb3c6e')
+
+    def test_server_chain_and_registry(self):
+        key = Obfuscator().get_key()
+        server, peer = Obfuscator(key), Obfuscator(key)
+        chain = server.compile_chain('encrypt>dns')
+        packets = chain.encode_iov(b'z' * 2000)
+        self.assertGreater(len(packets), 1)
+        decoder = peer.compile_chain(['encrypt', 'dns'])
+        self.assertEqual(b''.join(decoder.decode(packet) for packet in reversed(packets)), b'z' * 2000)
+
+        class ReverseStage(TransformStage):
+            def encode(self, data):
+                return bytes(data)[::-1]
+            decode = encode
+
+        register_transform('reverse', lambda session: ReverseStage())
+        try:
+            chain = server.compile_chain('reverse>xor')
+            self.assertEqual(chain.encode(b'abc'), server.xor_obfuscate(b'cba'))
+            self.assertEqual(chain.decode(chain.encode(b'abc')), b'abc')
+        finally:
+            del transforms.TRANSFORMS['reverse']
+
+class TestShadowsocks(unittest.TestCase):
+    def test_sessions_share_keys_per_salt(self):
+        method = shadowsocks_crypto.get_method('chacha20-ietf-poly1305')
+        master = shadowsocks_crypto.master_key('secret', method.key_size)
+        self.assertEqual(master, shadowsocks_crypto.master_key('secret', method.key_size))
+        salt = os.urandom(method.salt_size)
+        sender = shadowsocks_crypto.AEADSession(method, master, salt)
+        receiver = shadowsocks_crypto.AEADSession(method, master, salt)
+        for message in (b'one', b'two', b''):
+            self.assertEqual(receiver.decrypt(sender.encrypt(message)), message)
+        with self.assertRaises(ValueError):
+            shadowsocks_crypto.get_method('rc4-md5')
+
+    def test_chunk_stream_survives_any_split(self):
+        method = shadowsocks_crypto.get_method('aes-128-gcm')
+        master = shadowsocks_crypto.master_key('secret', method.key_size)
+        encoder = shadowsocks_crypto.AEADStreamEncoder(method, master)
+        payloads = [os.urandom(size) for size in (1, 100, 16383, 16384, 50000)]
+        stream = b''.join(encoder.encode(payload) for payload in payloads)
+        # salt + one (2 + 16) + (n + 16) pair per chunk of at most 16383 bytes
+        chunks = sum(-(-len(payload) // 16383) for payload in payloads)
+        self.assertEqual(len(stream), 16 + chunks * 34 + sum(map(len, payloads)))
+
+        decoder = shadowsocks_crypto.AEADStreamDecoder(method, master)
+        received, offset, step = [], 0, 1
+        while offset < len(stream):
+            received += decoder.feed(stream[offset:offset + step])
+            offset += step
+            step = step * 7 % 20011 + 1
+        self.assertEqual(b''.join(received), b''.join(payloads))
+        self.assertEqual(decoder.pending, 0)
+
+        tampered = bytearray(encoder.encode(b'x'))
+        tampered[0] ^= 1
+        with self.assertRaises(InvalidTag):
+            decoder.feed(bytes(tampered))
+
+    def test_server_round_trip(self):
+        for engine in TCP_ENGINES:
+            with ShadowsocksServer(password='secret', port=0, host='127.0.0.1', engine=engine) as server:
+                method = shadowsocks_crypto.get_method(server.method)
+                master = shadowsocks_crypto.master_key('secret', method.key_size)
+                encoder = shadowsocks_crypto.AEADStreamEncoder(method, master)
+                decoder = shadowsocks_crypto.AEADStreamDecoder(method, master)
+                with socket.create_connection(('127.0.0.1', server.port), timeout=5) as conn:
+                    request = encoder.encode(b'hello') + encoder.encode(b'again')
+                    # Split mid-chunk: the server must wait for the rest
+                    conn.sendall(request[:40])
+                    time.sleep(0.05)
+                    conn.sendall(request[40:])
+                    received = []
+                    while len(received) < 2:
+                        received += decoder.feed(conn.recv(4096))
+                    self.assertEqual(received, [b'ACK: hello', b'ACK: again'])
+        with self.assertRaises(ValueError):
+            ShadowsocksServer(engine='forking')
+
+    def _exchange(self, port, password, message):
+        method = shadowsocks_crypto.get_method('aes-256-gcm')
+        master = shadowsocks_crypto.master_key(password, method.key_size)
+        encoder = shadowsocks_crypto.AEADStreamEncoder(method, master)
+        decoder = shadowsocks_crypto.AEADStreamDecoder(method, master)
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as conn:
+            conn.sendall(encoder.encode(message))
+            received = []
+            while not received:
+                data = conn.recv(4096)
+                if not data:
+                    return None
+                received += decoder.feed(data)
+            return received[0]
+
+    def test_multiple_users_share_one_listener(self):
+        users = {f'user{i}': f'password{i}' for i in range(50)}
+        with ShadowsocksServer(port=0, host='127.0.0.1', users=users) as server:
+            self.assertEqual(self._exchange(server.port, 'password42', b'hi'), b'ACK: hi')
+            self.assertEqual(server.users.scans, 1)
+            self.assertEqual(self._exchange(server.port, 'password42', b'again'), b'ACK: again')
+            self.assertEqual(server.users.hint_hits, 1)  # second time straight from the IP's hints
+
+            server.add_user('carol', 'new')
+            self.assertEqual(self._exchange(server.port, 'new', b'x'), b'ACK: x')
+            server.remove_user('user42')
+            self.assertIsNone(self._exchange(server.port, 'password42', b'gone'))
+
+            stats = server.user_stats()
+            self.assertNotIn('user42', stats)
+            self.assertEqual(stats['carol']['connections'], 1)
+            self.assertEqual(stats['user0']['bytes_in'], 0)
+            # salt 32 + length 18 + payload 1 + tag 16 in; salt + 18 + 6 + 16 out
+            self.assertEqual((stats['carol']['bytes_in'], stats['carol']['bytes_out']), (67, 72))
+            deadline = time.time() + 5
+            while server.user_stats()['carol']['active'] and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(server.user_stats()['carol']['active'], 0)
+            with self.assertRaises(ValueError):
+                server.add_user('carol', 'again')
+
+    def test_junk_from_an_ip_costs_bounded_scans_without_locking_it_out(self):
+        method = shadowsocks_crypto.get_method('aes-256-gcm')
+        now = [0.0]
+        users = UserTable(method, recent_users=2, scan_rate=1.0, scan_burst=2, clock=lambda: now[0])
+        for i in range(50):
+            users.add(f'user{i}', f'password{i}')
+        seen = shadowsocks_crypto.master_key('password7', method.key_size)
+        self.assertEqual(users.identify_packet(
+            shadowsocks_crypto.seal_packet(method, seen, b'hi'), '10.0.0.1'), (7, b'hi'))
+
+        real_open = shadowsocks_crypto.open_packet
+        attempts = []
+
+        def counting_open(method, key, packet):
+            attempts.append(key)
+            return real_open(method, key, packet)
+
+        junk = os.urandom(64)
+        with patch('server.shadowsocks_users.open_packet', counting_open):
+            for expected in (50, 50, 1, 1):  # the burst of scans, then only the recent user
+                attempts.clear()
+                with self.assertRaises(ValueError):
+                    users.identify_packet(junk, '192.0.2.9')
+                self.assertEqual(len(attempts), expected)
+        # A user behind the same address, neither hinted nor recent, gets the next scan
+        other = shadowsocks_crypto.master_key('password30', method.key_size)
+        packet = shadowsocks_crypto.seal_packet(method, other, b'ok')
+        with self.assertRaises(ValueError):
+            users.identify_packet(packet, '192.0.2.9')
+        now[0] = 1.0
+        self.assertEqual(users.identify_packet(packet, '192.0.2.9'), (30, b'ok'))
+        self.assertEqual(users.identify_packet(packet, '192.0.2.9'), (30, b'ok'))
+        self.assertEqual((users.scans, users.scans_skipped, users.hint_hits), (4, 3, 1))
+
+    def test_udp_relay_round_trip_and_expiry(self):
+        echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        echo.bind(('127.0.0.1', 0))
+        threading.Thread(target=lambda: echo.sendto(*echo.recvfrom(2048)), daemon=True).start()
+        target = echo.getsockname()
+
+        method = shadowsocks_crypto.get_method('aes-256-gcm')
+        master = shadowsocks_crypto.master_key('secret', method.key_size)
+        users = UserTable(method)
+        users.add('alice', 'secret')
+        relay = ShadowsocksUDPRelay(users, '127.0.0.1', idle_timeout=0.3, tick=0.05)
+        relay.start()
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(5)
+        try:
+            client.sendto(b'garbage', ('127.0.0.1', relay.port))
+            client.sendto(shadowsocks_crypto.seal_packet(method, master, pack_address(*target) + b'ping'),
+                          ('127.0.0.1', relay.port))
+            reply = shadowsocks_crypto.open_packet(method, master, client.recv(2048))
+            host, port, end = parse_address(reply)
+            self.assertEqual(((host, port), reply[end:]), (target, b'ping'))
+            self.assertEqual(relay.get_stats()['associations'], 1)
+
+            deadline = time.time() + 5
+            while relay.get_stats()['associations'] and time.time() < deadline:
+                time.sleep(0.05)
+            stats = relay.get_stats()
+            self.assertEqual((stats['associations'], stats['expired'], stats['invalid']), (0, 1, 1))
+        finally:
+            relay.stop()
+            client.close()
+            echo.close()
+
+    def test_udp_relay_resolves_names_off_the_relay_thread(self):
+        echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        echo.bind(('127.0.0.1', 0))
+
+        def serve():
+            while True:
+                try:
+                    echo.sendto(*echo.recvfrom(2048))
+                except OSError:
+                    return
+
+        threading.Thread(target=serve, daemon=True).start()
+        port = echo.getsockname()[1]
+        method = shadowsocks_crypto.get_method('aes-256-gcm')
+        master = shadowsocks_crypto.master_key('secret', method.key_size)
+        users = UserTable(method)
+        users.add('alice', 'secret')
+        released = threading.Event()
+        real_getaddrinfo = socket.getaddrinfo
+
+        def slow_getaddrinfo(host, *args):
+            released.wait(5)  # a name server that takes its time
+            return real_getaddrinfo('127.0.0.1', *args)
+
+        relay = ShadowsocksUDPRelay(users, '127.0.0.1')
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(5)
+        with patch('utils.resolver.socket.getaddrinfo', slow_getaddrinfo):
+            relay.start()
+            try:
+                for target, data in (('slow.example', b'named'), ('127.0.0.1', b'literal')):
+                    client.sendto(shadowsocks_crypto.seal_packet(
+                        method, master, pack_address(target, port) + data), ('127.0.0.1', relay.port))
+                # The literal flow is answered while the lookup is still blocked
+                reply = shadowsocks_crypto.open_packet(method, master, client.recv(2048))
+                self.assertTrue(reply.endswith(b'literal'))
+                released.set()
+                reply = shadowsocks_crypto.open_packet(method, master, client.recv(2048))
+                self.assertTrue(reply.endswith(b'named'))
+            finally:
+                released.set()
+                relay.stop()
+                client.close()
+                echo.close()
+
+    def test_udp_relay_survives_a_user_removed_during_lookup(self):
+        echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        echo.bind(('127.0.0.1', 0))
+        threading.Thread(target=lambda: echo.sendto(*echo.recvfrom(2048)), daemon=True).start()
+        port = echo.getsockname()[1]
+        method = shadowsocks_crypto.get_method('aes-256-gcm')
+        users = UserTable(method)
+        users.add('alice', 'secret')
+        users.add('bob', 'other')
+        alice = shadowsocks_crypto.master_key('secret', method.key_size)
+        bob = shadowsocks_crypto.master_key('other', method.key_size)
+        released = threading.Event()
+        real_getaddrinfo = socket.getaddrinfo
+
+        def slow_getaddrinfo(host, *args):
+            released.wait(5)
+            return real_getaddrinfo('127.0.0.1', *args)
+
+        relay = ShadowsocksUDPRelay(users, '127.0.0.1')
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(5)
+        with patch('utils.resolver.socket.getaddrinfo', slow_getaddrinfo):
+            relay.start()
+            try:
+                client.sendto(shadowsocks_crypto.seal_packet(
+                    method, alice, pack_address('slow.example', port) + b'named'), ('127.0.0.1', relay.port))
+                deadline = time.time() + 5
+                while relay.get_stats()['received'] < 1 and time.time() < deadline:
+                    time.sleep(0.01)
+                users.remove('alice')  # while the lookup is still pending
+                released.set()
+                deadline = time.time() + 5
+                while relay.get_stats()['dropped'] < 1 and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(relay.get_stats()['dropped'], 1)
+                # The relay thread is still serving everyone else
+                client.sendto(shadowsocks_crypto.seal_packet(
+                    method, bob, pack_address('127.0.0.1', port) + b'still'), ('127.0.0.1', relay.port))
+                reply = shadowsocks_crypto.open_packet(method, bob, client.recv(2048))
+                self.assertTrue(reply.endswith(b'still'))
+                self.assertEqual(relay.get_stats()['associations'], 1)
+            finally:
+                released.set()
+                relay.stop()
+                client.close()
+                echo.close()
+
+    def test_timer_wheel_returns_due_items(self):
+        now = [100.0]
+        wheel = TimerWheel(tick=1.0, slots=8, clock=lambda: now[0])
+        wheel.schedule('soon', 102.5)
+        wheel.schedule('late', 120.0)  # more than a turn ahead: comes back early
+        now[0] = 102.0
+        self.assertEqual(wheel.advance(), [])
+        now[0] = 103.0
+        self.assertEqual(wheel.advance(), ['soon'])
+        now[0] = 150.0
+        self.assertEqual(wheel.advance(), ['late'])
+        self.assertEqual(len(wheel), 0)
+        self.assertEqual(parse_address(pack_address('example.com', 53) + b'x'), ('example.com', 53, 15))
+        self.assertEqual(parse_address(pack_address('::1', 80))[:2], ('::1', 80))
+        self.assertIsNone(parse_address(b'\x01\x7f\x00'))
+
+class TestSOCKS5Server(unittest.TestCase):
+    def _recv_exactly(self, conn, size):
+        data = b''
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_asyncio_engine_handshake(self):
+        with SOCKS5Server(port=0, host='127.0.0.1', auth=('user', 'pass'), engine='asyncio') as server:
+            with socket.create_connection(('127.0.0.1', server.port), timeout=5) as conn:
+                conn.sendall(b'\x05\x01')  # greeting split across writes
+                time.sleep(0.05)
+                conn.sendall(b'\x02')
+                self.assertEqual(self._recv_exactly(conn, 2), b'\x05\x02')
+                conn.sendall(b'\x01\x04user\x04pass')
+                self.assertEqual(self._recv_exactly(conn, 2), b'\x01\x00')
+                conn.sendall(b'\x05\x02\x00\x01\x7f\x00\x00\x01\x00\x50')  # BIND is not supported
+                self.assertEqual(self._recv_exactly(conn, 10), b'\x05\x07\x00\x01' + bytes(6))
+                self.assertEqual(conn.recv(1), b'')
+            with socket.create_connection(('127.0.0.1', server.port), timeout=5) as conn:
+                conn.sendall(b'\x05\x01\x02\x01\x04user\x05wrong')
+                self.assertEqual(self._recv_exactly(conn, 4), b'\x05\x02\x01\x01')
+
+    def _start_target(self, family=socket.AF_INET, host='127.0.0.1'):
+        """Target that reads until EOF, then answers with what it got and closes"""
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        listener.bind((host, 0))
+        listener.listen(8)
+
+        def serve():
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except OSError:
+                    return
+                with conn:
+                    received = b''
+                    while True:
+                        data = conn.recv(65536)
+                        if not data:
+                            break
+                        received += data
+                    conn.sendall(b'got ' + str(len(received)).encode() + b' ' + received[-4:])
+
+        threading.Thread(target=serve, daemon=True).start()
+        return listener
+
+    def _connect_through(self, port, request_address, payload):
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as conn:
+            conn.sendall(b'\x05\x01\x00')
+            self.assertEqual(self._recv_exactly(conn, 2), b'\x05\x00')
+            conn.sendall(b'\x05\x01\x00' + request_address)
+            reply = self._recv_exactly(conn, 4)
+            if reply[1] != 0:
+                return reply[1], b''
+            self._recv_exactly(conn, {1: 6, 4: 18}[reply[3]])
+            conn.sendall(payload)
+            conn.shutdown(socket.SHUT_WR)  # half-close: the answer must still come back
+            answer = b''
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return 0, answer
+                answer += data
+
+    def test_connect_relays_both_ways_with_half_close(self):
+        target = self._start_target()
+        targets = [pack_address('127.0.0.1', target.getsockname()[1]),
+                   pack_address('localhost', target.getsockname()[1])]
+        if socket.has_ipv6:
+            try:
+                target6 = self._start_target(socket.AF_INET6, '::1')
+                targets.append(pack_address('::1', target6.getsockname()[1]))
+            except OSError:
+                pass
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        refused = pack_address('127.0.0.1', closed.getsockname()[1])
+        closed.close()
+
+        payload = os.urandom(3 * 1024 * 1024) + b'last'
+        settings = [{'engine': engine} for engine in TCP_ENGINES]
+        if hasattr(os, 'splice'):
+            settings.append({'splice': True, 'buffer_size': 16384})
+        for options in settings:
+            with SOCKS5Server(port=0, host='127.0.0.1', **options) as server:
+                for address in targets:
+                    code, answer = self._connect_through(server.port, address, payload)
+                    self.assertEqual((code, answer), (0, b'got 3145732 last'), (options, address))
+                self.assertEqual(self._connect_through(server.port, refused, b'x')[0], 5)
+        target.close()
+
+    def test_handshake_state_machine_accepts_any_split(self):
+        request = b'\x05\x02\x00\x02' + b'\x01\x04user\x04pass' + b'\x05\x01\x00' + pack_address('example.com', 443)
+        for split in range(len(request) + 1):
+            handshake = SOCKS5Handshake(('user', 'pass'))
+            output = handshake.feed(request[:split]) + handshake.feed(request[split:] + b'early')
+            self.assertEqual(output, b'\x05\x02\x01\x00')
+            self.assertEqual((handshake.state, handshake.target), ('complete', ('example.com', 443)))
+            self.assertEqual(handshake.remaining, b'early')
+
+        handshake = SOCKS5Handshake()
+        self.assertEqual(handshake.feed(b'\x05\x01\x02'), b'\x05\xff')  # no acceptable method
+        self.assertEqual(handshake.state, 'rejected')
+        handshake = SOCKS5Handshake(('user', 'pass'))
+        self.assertEqual(handshake.feed(b'\x05\x01\x02\x01\x01u\x01p\x05\x01\x00\x01'), b'\x05\x02\x01\x01')
+        handshake = SOCKS5Handshake()
+        self.assertEqual(handshake.feed(b'\x05\x01\x00\x05\x01\x00\x09'), b'\x05\x00\x05\x08\x00\x01' + bytes(6))
+        with self.assertRaises(ValueError):
+            SOCKS5Handshake().feed(b'\x04\x01')
+
+    def test_pipelined_handshake_on_both_engines(self):
+        target = self._start_target()
+        request = (b'\x05\x01\x02' + b'\x01\x04user\x04pass' + b'\x05\x01\x00'
+                   + pack_address('127.0.0.1', target.getsockname()[1]) + b'payload')
+        for engine in TCP_ENGINES:
+            with SOCKS5Server(port=0, host='127.0.0.1', auth=('user', 'pass'), engine=engine) as server:
+                with socket.create_connection(('127.0.0.1', server.port), timeout=5) as conn:
+                    conn.sendall(request)  # one segment, data included
+                    conn.shutdown(socket.SHUT_WR)
+                    self.assertEqual(self._recv_exactly(conn, 14)[:5], b'\x05\x02\x01\x00\x05')
+                    self.assertEqual(self._recv_exactly(conn, 18), b'got 7 load')
+        target.close()
+
+    def test_udp_associate_relays_until_connection_closes(self):
+        echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        echo.bind(('127.0.0.1', 0))
+
+        def serve():
+            while True:
+                try:
+                    data, source = echo.recvfrom(65536)
+                    echo.sendto(b'echo ' + data, source)
+                except OSError:
+                    return
+
+        threading.Thread(target=serve, daemon=True).start()
+        header = b'\x00\x00\x00' + pack_address('127.0.0.1', echo.getsockname()[1])
+        for engine in TCP_ENGINES:
+            with SOCKS5Server(port=0, host='127.0.0.1', engine=engine) as server:
+                conn = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+                conn.sendall(b'\x05\x01\x00' + b'\x05\x03\x00' + pack_address('0.0.0.0', 0))
+                self.assertEqual(self._recv_exactly(conn, 2), b'\x05\x00')
+                answer = self._recv_exactly(conn, 10)
+                self.assertEqual(answer[:4], b'\x05\x00\x00\x01')
+                relay_address = (socket.inet_ntoa(answer[4:8]), struct.unpack('>H', answer[8:])[0])
+
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+                    client.settimeout(5)
+                    client.sendto(b'\x00\x00\x01' + header[3:] + b'fragment', relay_address)  # dropped
+                    for i in range(100):
+                        client.sendto(header + b'%d' % i, relay_address)
+                    replies = set()
+                    while len(replies) < 100:
+                        replies.add(client.recv(65536))
+                    self.assertEqual(replies, {header + b'echo %d' % i for i in range(100)})
+                self.assertEqual(server.get_stats()['udp']['associations'], 1)
+
+                conn.close()  # ends the association
+                deadline = time.time() + 5
+                while server.get_stats()['udp']['associations'] and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(server.get_stats()['udp']['associations'], 0)
+        echo.close()
+
+    def test_udp_relay_resolves_off_thread_and_evicts_lru(self):
+        echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        echo.bind(('127.0.0.1', 0))
+
+        def serve():
+            while True:
+                try:
+                    data, source = echo.recvfrom(65536)
+                    echo.sendto(data, source)
+                except OSError:
+                    return
+
+        threading.Thread(target=serve, daemon=True).start()
+        port = echo.getsockname()[1]
+        released = threading.Event()
+        real_getaddrinfo = socket.getaddrinfo
+
+        def slow_getaddrinfo(host, *args):
+            released.wait(5)  # a name server that takes its time
+            return real_getaddrinfo('127.0.0.1', *args)
+
+        relay = SOCKS5UDPRelay()
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.bind(('127.0.0.1', 0))
+        client.settimeout(5)
+        with patch('utils.resolver.socket.getaddrinfo', slow_getaddrinfo):
+            relay.start()
+            try:
+                association = relay.open('127.0.0.1', '127.0.0.1', client.getsockname()[1])
+                for target, data in (('slow.example', b'named'), ('127.0.0.1', b'literal')):
+                    client.sendto(b'\x00\x00\x00' + pack_address(target, port) + data, association.address)
+                # The literal target is answered while the lookup is still blocked
+                self.assertTrue(client.recv(65536).endswith(b'literal'))
+                released.set()
+                self.assertTrue(client.recv(65536).endswith(b'named'))
+
+                # A full target cache drops its least recently used entry, not everything
+                base = relay.received
+                for offset in range(300):
+                    client.sendto(b'\x00\x00\x00' + pack_address('127.0.0.1', 40000 + offset) + b'x',
+                                  association.address)
+                    deadline = time.time() + 5
+                    while relay.received <= base + offset and time.time() < deadline:
+                        time.sleep(0.001)  # keep within the relay socket's receive buffer
+                client.sendto(b'\x00\x00\x00' + pack_address('127.0.0.1', port) + b'last', association.address)
+                self.assertTrue(client.recv(65536).endswith(b'last'))
+                targets = list(association.targets)
+                self.assertEqual(len(targets), 256)
+                self.assertEqual(targets[-2:], [('127.0.0.1', 40299), ('127.0.0.1', port)])
+            finally:
+                released.set()
+                relay.stop()
+                client.close()
+                echo.close()
+
+    def test_threaded_pool_rejects_when_saturated(self):
+        server = SOCKS5Server(port=0, host='127.0.0.1', auth=('user', 'pass'),
+                              max_connections=1, queue_size=1)
+        server.start()
+        try:
+            busy = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+            busy.sendall(b'\x05\x01\x02')
+            self.assertEqual(self._recv_exactly(busy, 2), b'\x05\x02')  # handler now waits for auth
+            queued = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+            deadline = time.time() + 5
+            while server.get_stats()['queued'] < 1 and time.time() < deadline:
+                time.sleep(0.01)
+            with socket.create_connection(('127.0.0.1', server.port), timeout=5) as rejected:
+                try:
+                    self.assertEqual(rejected.recv(1), b'')
+                except ConnectionResetError:
+                    pass
+            stats = server.get_stats()
+            self.assertEqual((stats['workers'], stats['active'], stats['rejected']), (1, 1, 1))
+        finally:
+            started = time.time()
+            server.stop(timeout=2)
+        self.assertLess(time.time() - started, 2)
+        self.assertEqual(busy.recv(1), b'')  # the blocked handler was unblocked by stop()
+        busy.close()
+        queued.close()
+
+    def test_threaded_pool_wait_leaves_excess_in_the_backlog(self):
+        server = SOCKS5Server(port=0, host='127.0.0.1', auth=('user', 'pass'),
+                              max_connections=1, queue_size=1, overflow='wait')
+        server.start()
+        try:
+            clients = [socket.create_connection(('127.0.0.1', server.port), timeout=5)
+                       for _ in range(3)]
+            for client in clients:
+                client.sendall(b'\x05\x01\x02')
+            self.assertEqual(self._recv_exactly(clients[0], 2), b'\x05\x02')
+            time.sleep(0.3)
+            stats = server.get_stats()
+            # One handled, one queued; the third has not been taken off the backlog
+            self.assertEqual((stats['active'], stats['queued'], stats['accepted']), (1, 1, 2))
+
+            clients[0].close()
+            for client in clients[1:]:
+                self.assertEqual(self._recv_exactly(client, 2), b'\x05\x02')
+                client.close()
+            self.assertEqual(server.get_stats()['rejected'], 0)
+        finally:
+            server.stop(timeout=2)
+
+class _StandInUpstream(BaseHTTPRequestHandler):
+    """Local DoH upstream answering every A query with 10.0.0.1"""
+    protocol_version = 'HTTP/1.1'
+    delay = 0.0
+
+    def do_POST(self):
+        query = DNSRecord.parse(self.rfile.read(int(self.headers['content-length'])))
+        time.sleep(self.delay)
+        reply = query.reply()
+        reply.add_answer(RR(query.q.qname, QTYPE.A, rdata=A("10.0.0.1"), ttl=60))
+        body = reply.pack()
+        self.send_response(200)
+        self.send_header('content-type', 'application/dns-message')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stand_in_upstream(delay=0.0):
+    handler = type('_DelayedUpstream', (_StandInUpstream,), {'delay': delay})
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, f"http://127.0.0.1:{httpd.server_port}/dns-query"
+
+class TestDNSCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = DNSCache(max_entries=2, clock=lambda: self.now)
+
+    def _answer(self, name, ttl=60):
+        query = DNSRecord.question(name)
+        reply = query.reply()
+        reply.add_answer(RR(name, QTYPE.A, rdata=A("10.0.0.1"), ttl=ttl))
+        return query, reply.pack()
+
+    def test_hit_rewrites_id_and_ttl(self):
+        query, response = self._answer("example.com")
+        key = question_key(query.pack())
+        self.assertTrue(self.cache.put(key, response))
+
+        self.now += 20
+        cached = DNSRecord.parse(self.cache.get(key, 0x1234))
+        self.assertEqual(cached.header.id, 0x1234)
+        self.assertEqual(cached.rr[0].ttl, 40)
+
+        self.now += 40
+        self.assertIsNone(self.cache.get(key, 1))
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    @patch('server.dns_upstream.requests.Session.post')
+    def test_hit_echoes_the_askers_question_case(self, mock_post):
+        first = DNSRecord.question("WwW.Example.COM")
+        reply = first.reply()
+        reply.add_answer(RR("WwW.Example.COM", QTYPE.A, rdata=A("10.0.0.1"), ttl=60))
+        mock_post.return_value = MagicMock(status_code=200, content=bytes(reply.pack()))
+        dns = DNSOverHTTPS(listen_port=0)
+        dns._handle_query(first.pack())
+
+        # DNS 0x20: a resolver checks the answer repeats its own random casing
+        second = DNSRecord.question("www.EXAMPLE.com")
+        second.header.id = 0x4242
+        answer = DNSRecord.parse(dns._handle_query(second.pack()))
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(str(answer.q.qname), "www.EXAMPLE.com.")
+        self.assertEqual(answer.header.id, 0x4242)
+        self.assertEqual(str(answer.rr[0].rdata), "10.0.0.1")
+
+    def test_negative_answers_use_soa_minimum(self):
+        query = DNSRecord.question("missing.example.com")
+        reply = query.reply()
+        reply.header.rcode = RCODE.NXDOMAIN
+        key = question_key(query.pack())
+        self.assertFalse(self.cache.put(key, reply.pack()))
+
+        reply.add_auth(RR("example.com", QTYPE.SOA, ttl=900, rdata=SOA(
+            "ns.example.com", "admin.example.com", (1, 7200, 900, 86400, 30))))
+        self.assertTrue(self.cache.put(key, reply.pack()))
+        self.now += 31
+        self.assertIsNone(self.cache.get(key, 1))
+
+    def test_hot_entry_refreshed_once_near_expiry(self):
+        refreshed = []
+        cache = DNSCache(prefetch_threshold=3, prefetch_window=0.1,
+                         on_refresh=lambda key: refreshed.append(key) or True,
+                         clock=lambda: self.now)
+        query, response = self._answer("hot.example.com", ttl=100)
+        key = question_key(query.pack())
+        cache.put(key, response)
+
+        for _ in range(3):
+            cache.get(key, 1)
+        self.assertEqual(refreshed, [])
+
+        self.now += 95
+        cache.get(key, 1)
+        cache.get(key, 1)
+        self.assertEqual(refreshed, [key])
+
+    def test_lru_eviction(self):
+        keys = []
+        for name in ("a.com", "b.com", "c.com"):
+            query, response = self._answer(name)
+            keys.append(question_key(query.pack()))
+            self.cache.put(keys[-1], response)
+            if name == "b.com":
+                self.cache.get(keys[0], 1)
+
+        self.assertIsNotNone(self.cache.get(keys[0], 1))
+        self.assertIsNone(self.cache.get(keys[1], 1))
+        stats = self.cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['entries'], 2)
+
+class TestDNSOverHTTPS(unittest.TestCase):
+    @patch('server.dns_upstream.requests.Session.post')
+    def test_repeated_query_served_from_cache(self, mock_post):
+        query = DNSRecord.question("example.com")
+        reply = query.reply()
+        reply.add_answer(RR("example.com", QTYPE.A, rdata=A("10.0.0.1"), ttl=300))
+        mock_post.return_value = MagicMock(status_code=200, content=bytes(reply.pack()))
+
+        dns = DNSOverHTTPS(listen_port=0)
+        dns._handle_query(query.pack())
+        query.header.id = 4242
+        response = DNSRecord.parse(dns._handle_query(query.pack()))
+
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(response.header.id, 4242)
+        self.assertEqual(dns.get_stats()['cache']['hits'], 1)
+
+class TestAsyncDNSOverHTTPS(unittest.TestCase):
+    def setUp(self):
+        self.upstream, self.url = start_stand_in_upstream()
+        self.addCleanup(self.upstream.shutdown)
+
+    def test_resolves_over_udp(self):
+        with create_dns_server(engine='asyncio', listen_port=0, upstream_dns=self.url) as dns:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+                client.settimeout(5)
+                for txid in (1, 2):
+                    query = DNSRecord.question("example.com")
+                    query.header.id = txid
+                    client.sendto(query.pack(), ('127.0.0.1', dns.listen_port))
+                    response = DNSRecord.parse(client.recvfrom(4096)[0])
+                    self.assertEqual(response.header.id, txid)
+                    self.assertEqual(str(response.rr[0].rdata), "10.0.0.1")
+            stats = dns.get_stats()
+        self.assertEqual(stats['upstream_pool']['requests'], 1)
+        self.assertEqual(stats['cache']['hits'], 1)
+
+    def test_resolve_from_another_thread(self):
+        dns = create_dns_server(engine='asyncio', listen_port=0, upstream_dns=self.url)
+        query = DNSRecord.question("example.com").pack()
+        with self.assertRaises(RuntimeError):
+            dns.resolve(query)
+        with dns:
+            for _ in range(2):
+                answer = DNSRecord.parse(dns.resolve(query))
+                self.assertEqual(str(answer.rr[0].rdata), "10.0.0.1")
+            stats = dns.get_stats()
+        self.assertEqual((stats['upstream_pool']['requests'], stats['cache']['hits']), (1, 1))
+
+    def test_leaves_the_threaded_upstream_resources_unbuilt(self):
+        dns = create_dns_server(engine='asyncio', listen_port=0,
+                                upstream_dns=[self.url, self.url + '?b'])
+        self.assertIsNone(dns.upstream_pool)
+        self.assertIsNone(dns._hedge_executor)
+        self.assertIsNone(dns._prefetch_executor)
+        dns.start()
+        dns.stop()
+
+    def test_unknown_engine_rejected(self):
+        with self.assertRaises(ValueError):
+            create_dns_server(engine='fibers')
+
+    def test_plain_http_upstream_only_on_loopback(self):
+        with self.assertRaises(ValueError):
+            DNSOverHTTPS(upstream_dns="http://dns.example.com/dns-query")
+
+class TestPrefetch(unittest.TestCase):
+    @patch('server.dns_upstream.requests.Session.post')
+    def test_prefetch_respects_budget(self, mock_post):
+        query = DNSRecord.question("hot.example.com")
+        reply = query.reply()
+        reply.add_answer(RR("hot.example.com", QTYPE.A, rdata=A("10.0.0.2"), ttl=60))
+        mock_post.return_value = MagicMock(status_code=200, content=bytes(reply.pack()))
+        key = question_key(query.pack())
+
+        dns = DNSOverHTTPS(listen_port=0, prefetch_budget=1, prefetch_rate=0.001)
+        dns._running = True
+        self.assertTrue(dns._schedule_prefetch(key))
+        self.assertFalse(dns._schedule_prefetch(key))
+        dns._prefetch_executor.shutdown(wait=True)
+
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertIsNotNone(dns.cache.get(key, 7))
+        stats = dns.get_stats()['prefetch']
+        self.assertEqual((stats['issued'], stats['skipped'], stats['in_flight']), (1, 1, 0))
+
+class TestQueryCoalescing(unittest.TestCase):
+    @patch('server.dns_upstream.requests.Session.post')
+    def test_concurrent_identical_queries_share_upstream(self, mock_post):
+        def slow_post(*args, **kwargs):
+            time.sleep(0.2)
+            # Like a real upstream, echo the leader's question as asked
+            reply = DNSRecord.parse(kwargs['data']).reply()
+            reply.add_answer(RR("popular.example.com", QTYPE.A, rdata=A("10.0.0.1"), ttl=60))
+            return MagicMock(status_code=200, content=bytes(reply.pack()))
+        mock_post.side_effect = slow_post
+
+        dns = DNSOverHTTPS(listen_port=0, cache_size=0)
+        results = {}
+
+        # Each asker cases the name differently (DNS 0x20) and gets its own casing back
+        names = {txid: ''.join(c.upper() if (i + txid) % 3 == 0 else c
+                               for i, c in enumerate("popular.example.com")) for txid in range(1, 6)}
+
+        def ask(txid):
+            mine = DNSRecord.question(names[txid])
+            mine.header.id = txid
+            answer = DNSRecord.parse(dns._handle_query(mine.pack()))
+            results[txid] = (answer.header.id, str(answer.q.qname))
+
+        threads = [threading.Thread(target=ask, args=(txid,)) for txid in range(1, 6)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(results, {txid: (txid, names[txid] + '.') for txid in range(1, 6)})
+        self.assertEqual(dns.get_stats()['inflight']['coalesced'], 4)
+
+    def test_async_waiters_share_one_call(self):
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def lookup():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return b'answer'
+
+        async def run():
+            return await asyncio.gather(*(flight.do('key', lookup) for _ in range(3)))
+
+        results = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([shared for _, shared in results], [False, True, True])
+
+class TestHedgedUpstreams(unittest.TestCase):
+    def setUp(self):
+        self.slow, slow_url = start_stand_in_upstream(delay=0.5)
+        self.fast, fast_url = start_stand_in_upstream()
+        self.addCleanup(self.slow.shutdown)
+        self.addCleanup(self.fast.shutdown)
+        self.urls = [slow_url, fast_url]
+
+    def _check_hedge(self, engine):
+        dns = create_dns_server(engine=engine, listen_port=0, upstream_dns=self.urls,
+                                cache_size=0, max_hedge_delay=0.05)
+        with dns:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+                client.settimeout(5)
+                client.sendto(DNSRecord.question("example.com").pack(), ('127.0.0.1', dns.listen_port))
+                started = time.monotonic()
+                response = DNSRecord.parse(client.recvfrom(4096)[0])
+                elapsed = time.monotonic() - started
+            stats = dns.get_stats()['upstreams']
+            time.sleep(0.1)  # let the loser's cancellation run
+            loser = dns.get_stats()['upstreams']['upstreams'][self.urls[0]]
+
+        self.assertEqual(str(response.rr[0].rdata), "10.0.0.1")
+        self.assertLess(elapsed, 0.4)
+        self.assertEqual(stats['hedged'], 1)
+        self.assertEqual(stats['hedge_wins'], 1)
+        self.assertIsNotNone(stats['upstreams'][self.urls[1]]['p50_ms'])
+        if engine == 'asyncio':
+            # The cancelled loser is not credited with an answer
+            self.assertEqual(loser['requests'], 0)
+
+    def test_threaded_hedges_to_faster_upstream(self):
+        self._check_hedge('threaded')
+
+    def test_asyncio_hedges_to_faster_upstream(self):
+        self._check_hedge('asyncio')
+
+    def test_failing_upstream_is_ranked_last(self):
+        dns = DNSOverHTTPS(upstream_dns=self.urls)
+        dns.upstreams.record_success(self.urls[0], 0.010)
+        dns.upstreams.record_success(self.urls[1], 0.020)
+        self.assertEqual(dns.upstreams.ranked()[0].url, self.urls[0])
+        for _ in range(3):
+            dns.upstreams.record_failure(self.urls[0])
+        self.assertEqual(dns.upstreams.ranked()[0].url, self.urls[1])
+
+        # An upstream that has only ever failed ranks below a slow healthy one
+        dns = DNSOverHTTPS(upstream_dns=self.urls)
+        dns.upstreams.record_failure(self.urls[0])
+        dns.upstreams.record_success(self.urls[1], 0.5)
+        self.assertEqual(dns.upstreams.ranked()[0].url, self.urls[1])
+
+class TestDNSTransports(unittest.TestCase):
+    def test_truncation_honours_edns_payload_size(self):
+        query = DNSRecord.question("big.example.com")
+        reply = query.reply()
+        for i in range(60):
+            reply.add_answer(RR("big.example.com", QTYPE.A, rdata=A(f"10.0.0.{i}"), ttl=60))
+        response = reply.pack()
+
+        self.assertEqual(edns_payload_size(query.pack()), 512)
+        truncated = DNSRecord.parse(truncate_response(response, 512))
+        self.assertEqual(truncated.header.tc, 1)
+        self.assertEqual(str(truncated.q.qname), "big.example.com.")
+
+        query.add_ar(EDNS0(udp_len=4096))
+        self.assertEqual(edns_payload_size(query.pack()), 4096)
+        self.assertEqual(truncate_response(response, 4096), response)
+
+    def test_tcp_pipelined_queries(self):
+        upstream, url = start_stand_in_upstream()
+        self.addCleanup(upstream.shutdown)
+        for engine in DNS_ENGINES:
+            with create_dns_server(engine=engine, listen_port=0, upstream_dns=url) as dns:
+                with socket.create_connection(('127.0.0.1', dns.listen_port), timeout=5) as client:
+                    batch = b''
+                    for txid in (1, 2, 3):
+                        query = DNSRecord.question(f"host{txid}.example.com")
+                        query.header.id = txid
+                        packed = query.pack()
+                        batch += struct.pack('>H', len(packed)) + packed
+                    client.sendall(batch)
+                    client.shutdown(socket.SHUT_WR)
+
+                    stream = b''
+                    while True:
+                        chunk = client.recv(4096)
+                        if not chunk:
+                            break
+                        stream += chunk
+
+            ids = set()
+            while stream:
+                length = struct.unpack('>H', stream[:2])[0]
+                ids.add(DNSRecord.parse(stream[2:2 + length]).header.id)
+                stream = stream[2 + length:]
+            self.assertEqual(ids, {1, 2, 3}, engine)
+
+class TestUpstreamSessionPool(unittest.TestCase):
+    @patch('server.dns_upstream.requests.Session.post')
+    def test_reconnects_after_connection_failure(self, mock_post):
+        ok = MagicMock(status_code=200, content=b'answer')
+        mock_post.side_effect = [requests.ConnectionError("reset"), ok, ok]
+        pool = UpstreamSessionPool(pool_size=1)
+
+        self.assertIs(pool.post("https://1.1.1.1/dns-query", b'q', 1.0), ok)
+        self.assertIs(pool.post("https://1.1.1.1/dns-query", b'q', 1.0), ok)
+        stats = pool.stats()
+        self.assertEqual(stats['reconnects'], 1)
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['idle_sessions'], 1)
+
+    @patch('server.dns_upstream.requests.Session.post')
+    def test_idle_sessions_are_replaced(self, mock_post):
+        now = [0.0]
+        pool = UpstreamSessionPool(pool_size=1, idle_timeout=30, clock=lambda: now[0])
+        pool.post("https://1.1.1.1/dns-query", b'q', 1.0)
+        now[0] = 31.0
+        pool.post("https://1.1.1.1/dns-query", b'q', 1.0)
+        self.assertEqual(pool.stats()['idle_closed'], 1)
+
+class TestDNSSharding(unittest.TestCase):
+    def test_shared_hot_set_round_trip(self):
+        hot_set = SharedHotSet(slots=8)
+        try:
+            query = DNSRecord.question("shared.example.com")
+            reply = query.reply()
+            reply.add_answer(RR("shared.example.com", QTYPE.A, rdata=A("10.0.0.2"), ttl=60))
+            key = question_key(query.pack())
+
+            self.assertIsNone(hot_set.get(key, 1))
+            self.assertTrue(hot_set.put(key, reply.pack()))
+            # A second handle attaches to the same segment, as a worker process would
+            attached = SharedHotSet.__new__(SharedHotSet)
+            attached.__setstate__(hot_set.__getstate__())
+            answer = DNSRecord.parse(attached.get(key, 7))
+            attached.close()
+
+            self.assertEqual(answer.header.id, 7)
+            self.assertEqual(str(answer.rr[0].rdata), "10.0.0.2")
+
+            # A slot whose lengths do not fit it (a header caught mid-write) is a miss
+            base = hot_set._locate(hot_set._encode_key(key))[1]
+            struct.pack_into('<H', hot_set._shm.buf, base + SharedHotSet.SLOT_HEADER.size - 2, 0xFFFF)
+            self.assertIsNone(hot_set.get(key, 1))
+        finally:
+            hot_set.close()
+
+    def test_merge_stats(self):
+        merged = merge_stats([
+            {'cache': {'hits': 2}, 'upstreams': {'https://a': {'p99_ms': 5.0}}, 'http2': False},
+            {'cache': {'hits': 3}, 'upstreams': {'https://a': {'p99_ms': 9.0}}, 'http2': False},
+        ])
+        self.assertEqual(merged['cache']['hits'], 5)
+        self.assertEqual(merged['upstreams']['https://a']['p99_ms'], 9.0)
+        self.assertIs(merged['http2'], False)
+
+    def test_failed_start_stops_the_shards_already_running(self):
+        supervisor = DNSShardSupervisor(workers=3, hot_set_slots=8, listen_port=5353)
+        children = []
+
+        def spawn(index):
+            parent, child = multiprocessing.Pipe()
+            children.append(child)
+            return _Shard(index, MagicMock(**{'is_alive.return_value': False}), parent)
+
+        def await_ready(shard, timeout=30.0):
+            if shard.index == 1:
+                raise RuntimeError("DNS shard 1 failed to start: boom")
+
+        with patch.object(supervisor, '_spawn', spawn), patch.object(supervisor, '_await_ready', await_ready):
+            with self.assertRaises(RuntimeError):
+                supervisor.start()
+        self.assertEqual([child.poll(1) and child.recv() for child in children], ['stop'] * 3)
+        self.assertEqual(supervisor._shards, [])
+        self.assertIsNone(supervisor._shared_cache)
+        self.assertIsNone(supervisor._monitor)
+
+    def test_late_stats_reply_is_not_read_by_the_next_request(self):
+        supervisor = DNSShardSupervisor(workers=1)
+        parent, child = multiprocessing.Pipe()
+        supervisor._shards = [_Shard(0, None, parent)]
+
+        def slow_worker():
+            command, sequence = child.recv()
+            time.sleep(0.3)  # misses the first request's timeout
+            child.send((sequence, {'cache': {'hits': 1}}))
+            command, sequence = child.recv()
+            child.send((sequence, {'cache': {'hits': 2}}))
+
+        worker = threading.Thread(target=slow_worker)
+        worker.start()
+        self.assertEqual(supervisor.get_stats(timeout=0.1)['workers'], 0)
+        time.sleep(0.4)
+        stats = supervisor.get_stats(timeout=2)
+        worker.join()
+        parent.close()
+        child.close()
+        self.assertEqual((stats['workers'], stats['cache']['hits']), (1, 2))
+
+        port = DNSShardSupervisor._pick_port()
+        for kind in (socket.SOCK_DGRAM, socket.SOCK_STREAM):
+            with socket.socket(socket.AF_INET, kind) as probe:
+                probe.bind(('0.0.0.0', port))
+
+class TestBlocklist(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.hosts')
+        with os.fdopen(handle, 'w') as f:
+            f.write("127.0.0.1 localhost\n"
+                    "0.0.0.0 ads.example.com  # tracker\n"
+                    "10.1.2.3 printer.lan\n"
+                    "||metrics.example.net^\n")
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def _ask(self, blocklist, name, qtype='A'):
+        query = DNSRecord.question(name, qtype)
+        response = blocklist.answer(question_key(query.pack()), query.pack())
+        return response and DNSRecord.parse(response)
+
+    def test_blocks_subdomains_and_overrides_exact_names(self):
+        blocklist = Blocklist([self.path])
+        self.assertTrue(blocklist.is_blocked(wire_name("x.Ads.Example.com")))
+        self.assertFalse(blocklist.is_blocked(wire_name("example.com")))
+        self.assertIsNone(self._ask(blocklist, "localhost"))
+        self.assertEqual(self._ask(blocklist, "cdn.metrics.example.net").header.rcode, RCODE.NXDOMAIN)
+
+        override = self._ask(blocklist, "printer.lan")
+        self.assertEqual(str(override.rr[0].rdata), "10.1.2.3")
+        self.assertEqual(len(self._ask(blocklist, "printer.lan", 'AAAA').rr), 0)
+        self.assertIsNone(self._ask(blocklist, "www.printer.lan"))
+
+        sinkhole = self._ask(Blocklist([self.path], block_mode='null'), "ads.example.com")
+        self.assertEqual(str(sinkhole.rr[0].rdata), "0.0.0.0")
+
+    def test_reload_swaps_in_new_lists(self):
+        blocklist = Blocklist([self.path])
+        with open(self.path, 'w') as f:
+            f.write("new.example.org\n")
+        blocklist.reload()
+        self.assertTrue(blocklist.is_blocked(wire_name("new.example.org")))
+        self.assertFalse(blocklist.is_blocked(wire_name("ads.example.com")))
+        self.assertEqual(blocklist.stats()['domains'], 1)
+
+    @patch('server.dns_upstream.requests.Session.post')
+    def test_blocked_queries_skip_upstream(self, mock_post):
+        dns = DNSOverHTTPS(listen_port=0, blocklist_paths=[self.path])
+        query = DNSRecord.question("ads.example.com")
+        response = DNSRecord.parse(dns.resolve(query.pack()))
+        dns.stop()
+
+        self.assertEqual(response.header.id, query.header.id)
+        self.assertEqual(response.header.rcode, RCODE.NXDOMAIN)
+        mock_post.assert_not_called()
+        self.assertEqual(dns.get_stats()['blocklist']['blocked'], 1)
+
+class TestDOHServer(unittest.TestCase):
+    def setUp(self):
+        self.upstream, self.url = start_stand_in_upstream()
+        self.doh = DOHServer(port=0, host='127.0.0.1', upstream=self.url)
+        self.doh.start()
+
+    def tearDown(self):
+        self.doh.stop()
+        self.upstream.shutdown()
+
+    def test_get_and_post_share_keep_alive_connection(self):
+        query = DNSRecord.question("doh.example.com")
+        query.header.id = 0
+        encoded = base64.urlsafe_b64encode(query.pack()).rstrip(b'=').decode()
+        connection = http.client.HTTPConnection('127.0.0.1', self.doh.port, timeout=5)
+        try:
+            connection.request('GET', f'/dns-query?dns={encoded}')
+            response = connection.getresponse()
+            answer = DNSRecord.parse(response.read())
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.getheader('Content-Type'), 'application/dns-message')
+            self.assertEqual(response.getheader('Cache-Control'), 'max-age=60')
+            self.assertEqual(str(answer.rr[0].rdata), "10.0.0.1")
+
+            connection.request('POST', '/dns-query', body=query.pack(),
+                               headers={'Content-Type': 'application/dns-message'})
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(DNSRecord.parse(response.read()).q.qname, query.q.qname)
+        finally:
+            connection.close()
+
+        stats = self.doh.get_stats()
+        self.assertEqual((stats['requests'], stats['connections']), (2, 1))
+        self.assertEqual(stats['resolver']['cache']['hits'], 1)
+
+    def test_backed_by_the_asyncio_engine(self):
+        with create_dns_server(engine='asyncio', listen_port=0, upstream_dns=self.url) as dns:
+            doh = DOHServer(port=0, host='127.0.0.1', resolver=dns)
+            doh.start()
+            connection = http.client.HTTPConnection('127.0.0.1', doh.port, timeout=5)
+            try:
+                connection.request('POST', '/dns-query', body=DNSRecord.question("doh.example.com").pack(),
+                                   headers={'Content-Type': 'application/dns-message'})
+                response = connection.getresponse()
+                self.assertEqual(response.status, 200)
+                self.assertEqual(str(DNSRecord.parse(response.read()).rr[0].rdata), "10.0.0.1")
+            finally:
+                connection.close()
+                doh.stop()
+            self.assertEqual(dns.get_stats()['upstream_pool']['requests'], 1)
+
+    def test_rejects_malformed_requests(self):
+        cases = [
+            ('GET', '/dns-query', None, {}, 400),
+            ('GET', '/other?dns=AAAA', None, {}, 404),
+            ('POST', '/dns-query', b'q', {'Content-Type': 'text/plain'}, 415),
+        ]
+        for method, path, body, headers, status in cases:
+            connection = http.client.HTTPConnection('127.0.0.1', self.doh.port, timeout=5)
+            connection.request(method, path, body=body, headers=headers)
+            self.assertEqual(connection.getresponse().status, status, path)
+            connection.close()
+
 class TestProtocolSwitcher(unittest.TestCase):
     @patch('socket.socket')
     def test_protocol_test(self, mock_socket):
@@ -5,6 +5,13 @@ Available modules:
 - config_manager: Configuration file handling
 - network_utils: Network-related utilities
 - encryption: Cryptographic functions
+- xor_engine: Bulk XOR over whole buffers
+- tls_framing: Streaming TLS-record framing for tunnel sockets
+- dns_framing: Segmenting and reassembly for DNS-mimic packets
+- transforms: Compiled obfuscation transform chains and the stage registry
+- socks_address: SOCKS5/Shadowsocks address encoding
+- timer_wheel: Tick-bucketed deadlines for idle expiry
+- resolver: Name lookups on worker threads for single-threaded loops
 """
 
 from .config_manager import (
@@ -20,7 +27,14 @@ from .network_utils import (
     get_public_ip,
     is_port_open
 )
-from .encryption import generate_strong_key, AES256Cipher
+from .encryption import generate_strong_key, AES256Cipher, AEADCipher, AEAD_ALGORITHMS, derive_aead_key
+from .xor_engine import xor_bytes, xor_into
+from .dns_framing import DNSReassembler, segment_payload
+from .tls_framing import TLSRecordDeframer, frame_records, send_buffers
+from .transforms import TransformChain, TransformStage, compile_chain, register_transform
+from .socks_address import pack_address, parse_address
+from .timer_wheel import TimerWheel
+from .resolver import BackgroundResolver
 
 __all__ = [
     'generate_wireguard_config',
@@ -33,5 +47,23 @@ __all__ = [
     'get_public_ip',
     'is_port_open',
     'generate_strong_key',
-    'AES256Cipher'
+    'AES256Cipher',
+    'AEADCipher',
+    'AEAD_ALGORITHMS',
+    'derive_aead_key',
+    'xor_bytes',
+    'xor_into',
+    'TLSRecordDeframer',
+    'frame_records',
+    'send_buffers',
+    'DNSReassembler',
+    'segment_payload',
+    'TransformChain',
+    'TransformStage',
+    'compile_chain',
+    'register_transform',
+    'pack_address',
+    'parse_address',
+    'TimerWheel',
+    'BackgroundResolver'
 ]
\ No newline at end of file
@@ -0,0 +1,190 @@
+import time
+import struct
+import logging
+from collections import OrderedDict
+from typing import List, Optional, Tuple, Union
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+# Transaction ID, flags, question/answer/authority/additional counts
+DNS_HEADER = struct.Struct('>HHHHHH')
+QUERY_FLAGS = 0x0100  # standard query, recursion desired
+# Fake A/IN question for example.com
+QUESTION = b'\x07example\x03com\x00' + b'\x00\x01' + b'\x00\x01'
+SEGMENT_HEADER = struct.Struct('>HHH')  # fragment index, fragment count, payload length
+MAX_PACKET = 512  # classic DNS-over-UDP limit
+MAX_FRAGMENTS = 0xFFFF
+
+
+def fragment_capacity(max_packet: int = MAX_PACKET, question: bytes = QUESTION) -> int:
+    """Payload bytes one packet of at most max_packet bytes can carry"""
+    capacity = max_packet - DNS_HEADER.size - len(question) - SEGMENT_HEADER.size
+    if capacity <= 0:
+        raise ValueError("DNS packet size too small for the segment header")
+    return capacity
+
+
+def segment_payload(payload: Buffer, message_id: int, max_packet: int = MAX_PACKET,
+                    question: bytes = QUESTION) -> List[bytes]:
+    """Split payload over DNS-query-shaped packets sharing one transaction ID
+
+    Each packet carries a segment header (index, count, length) after the
+    question, so the receiver can put fragments back together in any order.
+    """
+    capacity = fragment_capacity(max_packet, question)
+    view = memoryview(payload).cast('B')
+    count = max(1, -(-len(view) // capacity))
+    if count > MAX_FRAGMENTS:
+        raise ValueError("Data too large for DNS segmenting")
+    prefix = DNS_HEADER.pack(message_id & 0xFFFF, QUERY_FLAGS, 1, 0, 0, 0) + question
+    packets = []
+    for index in range(count):
+        chunk = view[index * capacity:(index + 1) * capacity]
+        packets.append(b''.join((prefix, SEGMENT_HEADER.pack(index, count, len(chunk)), chunk)))
+    return packets
+
+
+def parse_packet(data: Buffer, offset: int = 0) -> Tuple[int, int, int, memoryview, int]:
+    """Decode the packet at offset into (message ID, index, count, payload, end)"""
+    view = memoryview(data).cast('B')
+    if len(view) - offset < DNS_HEADER.size:
+        raise ValueError("Invalid DNS mimic - truncated header")
+    message_id = DNS_HEADER.unpack_from(view, offset)[0]
+    # Question name ends at the first zero byte, followed by type and class
+    null_pos = bytes(view[offset + DNS_HEADER.size:offset + DNS_HEADER.size + 256]).find(b'\x00')
+    if null_pos == -1:
+        raise ValueError("Invalid DNS mimic - no null terminator")
+    position = offset + DNS_HEADER.size + null_pos + 5
+    if len(view) < position + SEGMENT_HEADER.size:
+        raise ValueError("Invalid DNS mimic - truncated")
+    index, count, length = SEGMENT_HEADER.unpack_from(view, position)
+    position += SEGMENT_HEADER.size
+    if not index < count:
+        raise ValueError("Invalid DNS mimic - bad fragment index")
+    if len(view) < position + length:
+        raise ValueError("Invalid DNS mimic - payload truncated")
+    return message_id, index, count, view[position:position + length], position + length
+
+
+class _Partial:
+    """Fragments received so far for one message"""
+
+    __slots__ = ('fragments', 'missing', 'size', 'first_seen')
+
+    def __init__(self, count: int, now: float):
+        self.fragments: List[Optional[bytes]] = [None] * count
+        self.missing = count
+        self.size = 0
+        self.first_seen = now
+
+
+class DNSReassembler:
+    """Rebuilds payloads from DNS-mimic fragments arriving in any order
+
+    Incomplete messages are held in arrival order and bounded three ways:
+    by count, by total buffered bytes, and by age. When a bound is hit the
+    oldest incomplete message is dropped, so lost fragments only cost the
+    message they belonged to. Duplicate fragments are ignored.
+    """
+
+    def __init__(self, max_messages: int = 64, max_bytes: int = 4 * 1024 * 1024,
+                 timeout: float = 10.0):
+        if max_messages <= 0 or max_bytes <= 0:
+            raise ValueError("Reassembly limits must be positive")
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._partials: 'OrderedDict[int, _Partial]' = OrderedDict()
+        self._buffered = 0
+        self.completed = 0
+        self.evicted = 0
+        self.duplicates = 0
+
+    @property
+    def pending(self) -> int:
+        """Incomplete messages currently held"""
+        return len(self._partials)
+
+    def feed(self, data: Buffer) -> List[bytes]:
+        """Add one or more whole packets; return the payloads they complete"""
+        now = time.monotonic()
+        self._expire(now)
+        messages = []
+        offset, length = 0, len(data)
+        while offset < length:
+            message_id, index, count, payload, offset = parse_packet(data, offset)
+            message = self._add(message_id, index, count, payload, now)
+            if message is not None:
+                messages.append(message)
+        return messages
+
+    def _add(self, message_id: int, index: int, count: int, payload: memoryview,
+             now: float) -> Optional[bytes]:
+        if count == 1:
+            self.completed += 1
+            return bytes(payload)
+
+        partial = self._partials.get(message_id)
+        if partial is not None and len(partial.fragments) != count:
+            # The ID wrapped around onto a message that never completed
+            self._drop(message_id)
+            partial = None
+        if partial is None:
+            partial = self._partials[message_id] = _Partial(count, now)
+        if partial.fragments[index] is not None:
+            self.duplicates += 1
+            return None
+
+        partial.fragments[index] = bytes(payload)
+        partial.missing -= 1
+        partial.size += len(payload)
+        self._buffered += len(payload)
+        if partial.missing:
+            self._enforce_limits(message_id)
+            return None
+
+        del self._partials[message_id]
+        self._buffered -= partial.size
+        self.completed += 1
+        return b''.join(partial.fragments)
+
+    def _expire(self, now: float) -> None:
+        """Drop messages whose first fragment is older than the timeout"""
+        deadline = now - self.timeout
+        while self._partials:
+            message_id, partial = next(iter(self._partials.items()))
+            if partial.first_seen > deadline:
+                break
+            self._drop(message_id)
+
+    def _enforce_limits(self, keep: int) -> None:
+        while (len(self._partials) > self.max_messages or self._buffered > self.max_bytes) \
+                and len(self._partials) > 1:
+            message_id = next(iter(self._partials))
+            if message_id == keep:
+                self._partials.move_to_end(keep)
+                message_id = next(iter(self._partials))
+            self._drop(message_id)
+        if self._buffered > self.max_bytes:
+            # A single message larger than the whole budget can never finish
+            self._drop(keep)
+
+    def _drop(self, message_id: int) -> None:
+        partial = self._partials.pop(message_id)
+        self._buffered -= partial.size
+        self.evicted += 1
+        logger.debug(f"Dropped incomplete DNS mimic message {message_id} "
+                     f"({partial.missing} of {len(partial.fragments)} fragments missing)")
+
+    def stats(self):
+        """Reassembly counters and current buffer usage"""
+        return {
+            'pending': len(self._partials),
+            'buffered_bytes': self._buffered,
+            'completed': self.completed,
+            'evicted': self.evicted,
+            'duplicates': self.duplicates,
+        }
@@ -1,9 +1,11 @@
 import os
+import threading
 import logging
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import padding
-from typing import Optional
+from typing import Optional, Union
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -71,4 +73,70 @@ class AES256Cipher:
             return unpadder.update(padded) + unpadder.finalize()
         except Exception as e:
             logger.error(f"Decryption failed: {e}")
-            raise
\ No newline at end of file
+            raise
+
+AEAD_ALGORITHMS = {
+    'aes-256-gcm': AESGCM,
+    'chacha20-poly1305': ChaCha20Poly1305,
+}
+AEAD_NONCE_SIZE = 12
+AEAD_TAG_SIZE = 16
+
+def derive_aead_key(secret: bytes, info: bytes = b'vpn-tunnel aead') -> bytes:
+    """Derive a 32-byte AEAD key from a shared secret (HKDF-SHA256)"""
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives import hashes
+
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=info,
+        backend=default_backend()
+    ).derive(secret)
+
+class AEADCipher:
+    """Raw binary AEAD: nonce (12 bytes) + ciphertext + tag (16 bytes)
+
+    The nonce is an 8-byte random prefix drawn per instance followed by a
+    4-byte message counter, so encrypting needs no fresh randomness and
+    the prefix is redrawn before the counter wraps. The underlying cipher
+    object is created once per key and reused for every message.
+    """
+
+    def __init__(self, key: bytes, algorithm: str = 'aes-256-gcm'):
+        """Initialize with a 32-byte key"""
+        if algorithm not in AEAD_ALGORITHMS:
+            raise ValueError(f"Unknown AEAD algorithm: {algorithm}")
+        if len(key) != 32:
+            raise ValueError("Key must be 32 bytes for AEAD")
+        self.algorithm = algorithm
+        self._aead = AEAD_ALGORITHMS[algorithm](key)
+        self._lock = threading.Lock()
+        self._new_prefix()
+
+    def _new_prefix(self) -> None:
+        self._prefix = os.urandom(8)
+        self._counter = 0
+
+    def _next_nonce(self) -> bytes:
+        with self._lock:
+            if self._counter > 0xFFFFFFFF:
+                self._new_prefix()
+            nonce = self._prefix + self._counter.to_bytes(4, 'big')
+            self._counter += 1
+        return nonce
+
+    def encrypt(self, data: Union[bytes, bytearray, memoryview],
+                associated_data: Optional[bytes] = None) -> bytes:
+        """Encrypt and authenticate data"""
+        nonce = self._next_nonce()
+        return nonce + self._aead.encrypt(nonce, data, associated_data)
+
+    def decrypt(self, data: Union[bytes, bytearray, memoryview],
+                associated_data: Optional[bytes] = None) -> bytes:
+        """Verify and decrypt data produced by encrypt()"""
+        if len(data) < AEAD_NONCE_SIZE + AEAD_TAG_SIZE:
+            raise ValueError("AEAD message too short")
+        view = memoryview(data)
+        return self._aead.decrypt(view[:AEAD_NONCE_SIZE], view[AEAD_NONCE_SIZE:], associated_data)
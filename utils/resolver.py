@@ -0,0 +1,106 @@
+import socket
+import time
+import logging
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, List, Optional, Set, Tuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+Name = Tuple[str, int, int]  # host, port, address family
+Resolved = Tuple[int, tuple]  # address family, socket address
+
+
+def literal_address(host: str, port: int, family: int = socket.AF_UNSPEC) -> Optional[Resolved]:
+    """The address for an IP literal host, without a lookup; None for names"""
+    for candidate in (socket.AF_INET, socket.AF_INET6):
+        if family not in (socket.AF_UNSPEC, candidate):
+            continue
+        try:
+            socket.inet_pton(candidate, host)
+        except (OSError, ValueError):
+            continue
+        return candidate, (host, port) if candidate == socket.AF_INET else (host, port, 0, 0)
+    return None
+
+
+class BackgroundResolver:
+    """getaddrinfo on worker threads for a loop that must never block on DNS
+
+    The loop calls cached() first: IP literals and recently resolved names
+    answer at once. Otherwise resolve() starts one lookup per name, and
+    when it ends the worker calls wake() so the loop can collect results
+    with completed(). cached(), resolve() and completed() belong to the
+    loop thread; only the hand-over queue is shared with the workers.
+    """
+
+    def __init__(self, wake: Callable[[], None], workers: int = 4, cache_size: int = 1024,
+                 cache_ttl: float = 60.0, negative_ttl: float = 5.0,
+                 clock: Callable[[], float] = time.monotonic):
+        if workers <= 0 or cache_size <= 0:
+            raise ValueError("workers and cache_size must be positive")
+        self._wake = wake
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._cache: 'OrderedDict[Name, Tuple[Optional[Resolved], float]]' = OrderedDict()
+        self._pending: Set[Name] = set()
+        self._done: Deque[Tuple[Name, Optional[Resolved]]] = deque()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='resolver')
+
+    def cached(self, host: str, port: int, family: int = socket.AF_UNSPEC) -> Optional[Resolved]:
+        """A literal or still-fresh resolved address; None means call resolve()"""
+        literal = literal_address(host, port, family)
+        if literal is not None:
+            return literal
+        name = (host, port, family)
+        entry = self._cache.get(name)
+        if entry is None or entry[0] is None or entry[1] <= self._clock():
+            return None
+        self._cache.move_to_end(name)
+        return entry[0]
+
+    def failed(self, host: str, port: int, family: int = socket.AF_UNSPEC) -> bool:
+        """Whether the name recently failed to resolve (so it is not retried yet)"""
+        entry = self._cache.get((host, port, family))
+        return entry is not None and entry[0] is None and entry[1] > self._clock()
+
+    def resolve(self, host: str, port: int, family: int = socket.AF_UNSPEC) -> None:
+        """Start a background lookup, unless one for the same name is running"""
+        name = (host, port, family)
+        if name in self._pending:
+            return
+        self._pending.add(name)
+        self._executor.submit(self._lookup, name)
+
+    def _lookup(self, name: Name) -> None:
+        host, port, family = name
+        try:
+            info = socket.getaddrinfo(host, port, family, socket.SOCK_DGRAM)[0]
+            result: Optional[Resolved] = (info[0], info[4])
+        except (OSError, UnicodeError) as e:
+            logger.debug(f"Resolving {host} failed: {e}")
+            result = None
+        self._done.append((name, result))
+        self._wake()
+
+    def completed(self) -> List[Tuple[Name, Optional[Resolved]]]:
+        """Lookups finished since the last call; None marks a failure"""
+        results = []
+        now = self._clock()
+        while self._done:
+            name, result = self._done.popleft()
+            self._pending.discard(name)
+            ttl = self.cache_ttl if result is not None else self.negative_ttl
+            self._cache[name] = (result, now + ttl)
+            self._cache.move_to_end(name)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            results.append((name, result))
+        return results
+
+    def close(self) -> None:
+        """Stop the workers; lookups still running are abandoned"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,59 @@
+import socket
+import struct
+import logging
+from typing import Optional, Tuple, Union
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+# Address types shared by SOCKS5 requests and Shadowsocks headers
+ATYP_IPV4 = 0x01
+ATYP_DOMAIN = 0x03
+ATYP_IPV6 = 0x04
+PORT = struct.Struct('>H')
+
+
+def pack_address(host: str, port: int) -> bytes:
+    """Encode host and port as ATYP + address + port"""
+    for atyp, family in ((ATYP_IPV4, socket.AF_INET), (ATYP_IPV6, socket.AF_INET6)):
+        try:
+            return bytes((atyp,)) + socket.inet_pton(family, host) + PORT.pack(port)
+        except OSError:
+            continue
+    name = host.encode('idna')
+    if not 0 < len(name) < 256:
+        raise ValueError(f"Invalid domain name: {host!r}")
+    return bytes((ATYP_DOMAIN, len(name))) + name + PORT.pack(port)
+
+
+def parse_address(data: Buffer, offset: int = 0) -> Optional[Tuple[str, int, int]]:
+    """Decode the address at offset into (host, port, end), or None if it is incomplete"""
+    available = len(data) - offset
+    if available < 1:
+        return None
+    atyp = data[offset]
+    if atyp == ATYP_IPV4:
+        start, length = offset + 1, 4
+    elif atyp == ATYP_IPV6:
+        start, length = offset + 1, 16
+    elif atyp == ATYP_DOMAIN:
+        if available < 2:
+            return None
+        start, length = offset + 2, data[offset + 1]
+        if not length:
+            raise ValueError("Empty domain name")
+    else:
+        raise ValueError(f"Unsupported address type {atyp}")
+    end = start + length + PORT.size
+    if len(data) < end:
+        return None
+    raw = bytes(data[start:start + length])
+    if atyp == ATYP_IPV4:
+        host = socket.inet_ntop(socket.AF_INET, raw)
+    elif atyp == ATYP_IPV6:
+        host = socket.inet_ntop(socket.AF_INET6, raw)
+    else:
+        host = raw.decode('idna')
+    return host, PORT.unpack_from(data, end - PORT.size)[0], end
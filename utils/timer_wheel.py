@@ -0,0 +1,56 @@
+import math
+import time
+import logging
+from typing import Callable, Generic, List, Optional, TypeVar
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class TimerWheel(Generic[T]):
+    """Deadlines bucketed by tick in a ring of slots
+
+    Scheduling is an append and advancing only visits the slots whose
+    tick has passed, so the cost of expiry does not depend on how many
+    items are waiting. Deadlines further out than one turn of the wheel
+    come back early; callers check the item and schedule it again, which
+    is also how an item whose deadline moved (activity since it was
+    scheduled) is handled without touching the wheel on every update.
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 64,
+                 clock: Callable[[], float] = time.monotonic):
+        if tick <= 0 or slots <= 0:
+            raise ValueError("Tick and slot count must be positive")
+        self.tick = tick
+        self.clock = clock
+        self._slots: List[List[T]] = [[] for _ in range(slots)]
+        self._current = int(clock() / tick)
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def schedule(self, item: T, deadline: float) -> None:
+        """Have item returned by the first advance() at or after deadline"""
+        # Never in the past: a slot behind the cursor would wait a full turn
+        tick = max(math.ceil(deadline / self.tick), self._current + 1)
+        self._slots[tick % len(self._slots)].append(item)
+        self._count += 1
+
+    def advance(self, now: Optional[float] = None) -> List[T]:
+        """Items whose slot has come due since the last call"""
+        target = int((self.clock() if now is None else now) / self.tick)
+        due: List[T] = []
+        slots = self._slots
+        # After a long pause every slot is due once; no need to go round again
+        for tick in range(max(self._current + 1, target - len(slots) + 1), target + 1):
+            slot = slots[tick % len(slots)]
+            if slot:
+                due.extend(slot)
+                slot.clear()
+        self._current = max(self._current, target)
+        self._count -= len(due)
+        return due
@@ -0,0 +1,159 @@
+import os
+import socket
+import struct
+import logging
+from typing import List, Union
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+RECORD_HEADER = struct.Struct('>BHH')  # content type, legacy version, length
+APPLICATION_DATA = 0x17
+LEGACY_VERSION = 0x0303
+MAX_RECORD_PAYLOAD = 65535
+# Longest run of inter-record padding ClientObfuscator appends
+MAX_PADDING = 31
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def record_header(length: int) -> bytes:
+    """Header of a TLS 1.2/1.3 application-data record carrying length bytes"""
+    if length > MAX_RECORD_PAYLOAD:
+        raise ValueError("Data too large for TLS wrapping")
+    return RECORD_HEADER.pack(APPLICATION_DATA, LEGACY_VERSION, length)
+
+
+def frame_records(payload: Buffer, record_size: int = MAX_RECORD_PAYLOAD) -> List[Buffer]:
+    """Scatter/gather list of records carrying payload, record_size bytes each
+
+    The payload is split into memoryview slices rather than copied; only
+    the 5-byte headers are new objects.
+    """
+    if not 0 < record_size <= MAX_RECORD_PAYLOAD:
+        raise ValueError(f"TLS record size must be between 1 and {MAX_RECORD_PAYLOAD}")
+    length = len(payload)
+    if length <= record_size:
+        return [record_header(length), payload]
+
+    view = memoryview(payload).cast('B')
+    full_header = record_header(record_size)
+    buffers: List[Buffer] = []
+    for start in range(0, length - record_size + 1, record_size):
+        buffers += (full_header, view[start:start + record_size])
+    tail = length % record_size
+    if tail:
+        buffers += (record_header(tail), view[length - tail:])
+    return buffers
+
+
+def send_buffers(sock: socket.socket, buffers: List[Buffer]) -> int:
+    """Send a scatter/gather list with sendmsg, resuming after partial writes"""
+    views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    total = sum(len(view) for view in views)
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(views))
+        return total
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + IOV_MAX])
+        # Skip fully sent buffers and trim the first partially sent one
+        while sent and sent >= len(views[index]):
+            sent -= len(views[index])
+            index += 1
+        if sent:
+            views[index] = views[index][sent:]
+    return total
+
+
+class TLSRecordDeframer:
+    """Incremental parser turning a byte stream back into record payloads
+
+    Chunks of any size go into one reusable buffer, either copied in with
+    feed() or received straight into it via writable()/commit(). Complete
+    payloads come back as memoryviews into that buffer, so they are only
+    valid until the next call that adds data. With allow_padding, the
+    padding ClientObfuscator puts after each record is skipped.
+    """
+
+    def __init__(self, capacity: int = 4 * (MAX_RECORD_PAYLOAD + RECORD_HEADER.size),
+                 allow_padding: bool = False):
+        if capacity < MAX_RECORD_PAYLOAD + RECORD_HEADER.size + MAX_PADDING:
+            raise ValueError("Deframer capacity must hold a full record")
+        self.allow_padding = allow_padding
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    @property
+    def pending(self) -> int:
+        """Bytes buffered that do not yet form a complete record"""
+        return self._end - self._start
+
+    def _compact(self, needed: int = 0) -> None:
+        """Move a partial record to the front, growing if needed won't fit"""
+        live = self._end - self._start
+        if live + needed > len(self._buffer):
+            # A fresh buffer leaves views handed out earlier intact
+            buffer = bytearray(max(len(self._buffer) * 2, live + needed))
+            buffer[:live] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        elif self._start:
+            self._view[:live] = self._view[self._start:self._end]
+        self._start, self._end = 0, live
+
+    def writable(self) -> memoryview:
+        """Free space to receive into, e.g. sock.recv_into(deframer.writable())"""
+        self._compact()
+        return self._view[self._end:]
+
+    def commit(self, count: int) -> List[memoryview]:
+        """Account for count bytes written into writable(); return new payloads"""
+        self._end += count
+        return self._parse()
+
+    def feed(self, data: Buffer) -> List[memoryview]:
+        """Append a received chunk and return every payload it completes"""
+        self._compact(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+        return self._parse()
+
+    def _parse(self) -> List[memoryview]:
+        payloads = []
+        view, start, end = self._view, self._start, self._end
+        while start < end:
+            first = view[start]
+            # Padding is a run of n bytes of value n; 0x17 padding is told
+            # apart from a header by the byte after it (0x17 vs 0x03)
+            if self.allow_padding and (first != APPLICATION_DATA or (
+                    end - start > 1 and view[start + 1] == APPLICATION_DATA)):
+                if not 0 < first <= MAX_PADDING:
+                    raise ValueError("Invalid TLS record header")
+                if end - start < first:
+                    break
+                start += first
+                continue
+
+            if end - start < RECORD_HEADER.size:
+                break
+            content_type, version, length = RECORD_HEADER.unpack_from(view, start)
+            if content_type != APPLICATION_DATA or version != LEGACY_VERSION:
+                raise ValueError("Invalid TLS record header")
+            if end - start - RECORD_HEADER.size < length:
+                break
+            start += RECORD_HEADER.size
+            payloads.append(view[start:start + length])
+            start += length
+
+        if start == end:
+            start = end = 0
+        self._start, self._end = start, end
+        return payloads
@@ -0,0 +1,212 @@
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from utils.dns_framing import DNSReassembler, segment_payload
+from utils.tls_framing import TLSRecordDeframer, frame_records
+from utils.xor_engine import xor_into
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+Buffer = Union[bytes, bytearray, memoryview]
+# A stage may return one buffer or several (records, packets, decoded messages)
+StageOutput = Union[Buffer, List[Buffer]]
+
+DEFAULT_XOR_KEY = b'\xAA\x55\xAA\x55'
+CHAIN_SEPARATOR = '>'
+
+
+class TransformStage:
+    """One layer of an obfuscation chain; the base class passes data through
+
+    A message encoded (or decoded) through a stage whose advances_on_encode
+    (advances_on_decode) is set moves the session's sequence counter on.
+    """
+
+    advances_on_encode = False
+    advances_on_decode = False
+
+    def encode(self, data: Buffer) -> StageOutput:
+        return data
+
+    def decode(self, data: Buffer) -> StageOutput:
+        return data
+
+
+class CipherStage(TransformStage):
+    """Encrypts with the session's cipher (Fernet or AEAD)"""
+
+    def __init__(self, encrypt: Callable[[bytes], bytes], decrypt: Callable[[bytes], bytes]):
+        self._encrypt = encrypt
+        self._decrypt = decrypt
+
+    def encode(self, data: Buffer) -> bytes:
+        return self._encrypt(data if isinstance(data, bytes) else bytes(data))
+
+    def decode(self, data: Buffer) -> bytes:
+        return self._decrypt(data if isinstance(data, bytes) else bytes(data))
+
+
+class XorStage(TransformStage):
+    """XOR with a per-message key, written into a scratch buffer reused across calls
+
+    The returned view is only valid until the stage's next call.
+    """
+
+    advances_on_encode = True
+    advances_on_decode = True
+
+    def __init__(self, key_source: Callable[[], bytes], capacity: int = 4096):
+        self._key_source = key_source
+        self._scratch = bytearray(capacity)
+
+    def encode(self, data: Buffer) -> memoryview:
+        length = len(data)
+        if not length:
+            raise ValueError("No data to obfuscate")
+        if length > len(self._scratch):
+            self._scratch = bytearray(max(length, 2 * len(self._scratch)))
+        view = memoryview(self._scratch)[:length]
+        view[:] = data
+        xor_into(view, self._key_source())
+        return view
+
+    decode = encode  # XOR is symmetric
+
+
+class TLSStage(TransformStage):
+    """Fake TLS application-data records, reassembled from a stream on decode"""
+
+    advances_on_encode = True  # the padding length follows the counter
+
+    def __init__(self, record_size: int, padding_source: Optional[Callable[[], bytes]] = None,
+                 deframer: Optional[TLSRecordDeframer] = None):
+        self.record_size = record_size
+        self._padding_source = padding_source
+        self.deframer = deframer or TLSRecordDeframer(allow_padding=True)
+
+    def encode(self, data: Buffer) -> List[Buffer]:
+        buffers = frame_records(data, self.record_size)
+        if self._padding_source is not None:
+            padding = self._padding_source()
+            if padding:
+                buffers.append(padding)
+        return buffers
+
+    def decode(self, data: Buffer) -> List[memoryview]:
+        return self.deframer.feed(data)
+
+
+class DNSStage(TransformStage):
+    """DNS-query-shaped packets, segmented on encode and reassembled on decode"""
+
+    def __init__(self, packet_size: int, reassembler: Optional[DNSReassembler] = None):
+        self.packet_size = packet_size
+        self.reassembler = reassembler or DNSReassembler()
+        self._message_id = 0
+
+    def encode(self, data: Buffer) -> List[bytes]:
+        packets = segment_payload(data, self._message_id, self.packet_size)
+        self._message_id = (self._message_id + 1) % 65536
+        return packets
+
+    def decode(self, data: Buffer) -> List[bytes]:
+        return self.reassembler.feed(data)
+
+
+# Stage factories take the session (an Obfuscator or ClientObfuscator), which
+# provides encrypt/decrypt, xor_key(), tls_padding(), tls_deframer(),
+# dns_reassembler(), tls_record_size, dns_packet_size and next_message()
+TRANSFORMS: Dict[str, Callable[[object], TransformStage]] = {
+    'encrypt': lambda session: CipherStage(session.encrypt, session.decrypt),
+    'xor': lambda session: XorStage(session.xor_key),
+    'tls': lambda session: TLSStage(session.tls_record_size, session.tls_padding,
+                                    session.tls_deframer()),
+    'dns': lambda session: DNSStage(session.dns_packet_size, session.dns_reassembler()),
+}
+
+
+def register_transform(name: str, factory: Callable[[object], TransformStage]) -> None:
+    """Make a new stage available to chains under name"""
+    if not name or CHAIN_SEPARATOR in name or name == 'none':
+        raise ValueError(f"Invalid transform name: {name!r}")
+    TRANSFORMS[name] = factory
+
+
+def parse_chain(spec: Union[str, Sequence[str]]) -> Tuple[str, ...]:
+    """Stage names from 'encrypt>xor>tls' or a sequence of names ('none' is empty)"""
+    if isinstance(spec, str):
+        spec = [] if spec == 'none' else spec.split(CHAIN_SEPARATOR)
+    names = tuple(name.strip() for name in spec)
+    for name in names:
+        if name not in TRANSFORMS:
+            raise ValueError(f"Unknown transform: {name}")
+    return names
+
+
+class TransformChain:
+    """Stages compiled for one session; encode runs them in order, decode in reverse
+
+    Each stage is built once, so per-call work is only the stages
+    themselves. A stage that yields several buffers on decode (records,
+    reassembled messages) has each one run through the rest of the chain
+    separately, so a message meant for the stages after tls must fit in
+    one record. on_message runs once per message encoded or decoded
+    through a chain with a stage that advances the sequence that way, so
+    single-stage modes keep the counter exactly where they always have.
+    """
+
+    def __init__(self, names: Tuple[str, ...], stages: List[TransformStage],
+                 on_message: Optional[Callable[[], None]] = None):
+        self.names = names
+        self.stages = stages
+        self._on_encode = on_message if any(stage.advances_on_encode for stage in stages) else None
+        self._on_decode = on_message if any(stage.advances_on_decode for stage in stages) else None
+        self._encoders = tuple(stage.encode for stage in stages)
+        self._decoders = tuple(stage.decode for stage in reversed(stages))
+
+    def encode_iov(self, data: Buffer) -> List[Buffer]:
+        """Encoded data as a buffer list for socket.sendmsg
+
+        The buffers may reference scratch space reused by the next call.
+        """
+        for encode in self._encoders:
+            if isinstance(data, list):
+                data = b''.join(data)
+            data = encode(data)
+        if self._on_encode is not None:
+            self._on_encode()
+        return data if isinstance(data, list) else [data]
+
+    def encode(self, data: Buffer) -> bytes:
+        """Run data through every stage and return the bytes to send"""
+        return b''.join(self.encode_iov(data))
+
+    def decode(self, data: Buffer) -> bytes:
+        """Undo the stages; stream stages return b'' until a message completes"""
+        output: List[bytes] = []
+        self._decode_from(0, data, output)
+        return b''.join(output)
+
+    def _decode_from(self, position: int, data: StageOutput, output: List[bytes]) -> None:
+        decoders = self._decoders
+        while position < len(decoders):
+            data = decoders[position](data)
+            position += 1
+            if isinstance(data, list):
+                # Finish each item before the next: views are only valid until then
+                for item in data:
+                    self._decode_from(position, item, output)
+                return
+        output.append(bytes(data))
+        if self._on_decode is not None:
+            self._on_decode()
+
+    def __repr__(self) -> str:
+        return f"TransformChain({CHAIN_SEPARATOR.join(self.names) or 'none'})"
+
+
+def compile_chain(spec: Union[str, Sequence[str]], session) -> TransformChain:
+    """Build the stages named by spec for session"""
+    names = parse_chain(spec)
+    return TransformChain(names, [TRANSFORMS[name](session) for name in names], session.next_message)
@@ -0,0 +1,56 @@
+import logging
+from typing import Union
+
+try:
+    import numpy
+except ImportError:  # optional, only speeds up large buffers
+    numpy = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+# Below this size the fixed cost of building NumPy arrays outweighs the gain
+NUMPY_THRESHOLD = 1024
+
+
+def keystream(key: bytes, length: int, offset: int = 0) -> bytes:
+    """The repeating key, starting at key[offset % len(key)], cut to length"""
+    if not key:
+        raise ValueError("XOR key must not be empty")
+    start = offset % len(key)
+    return (key * ((start + length) // len(key) + 1))[start:start + length]
+
+
+def xor_bytes(data: Buffer, key: bytes, offset: int = 0) -> bytes:
+    """XOR data with a repeating key, a whole buffer at a time
+
+    Byte i of data is XORed with key[(offset + i) % len(key)], so
+    offset lets a stream be processed in pieces.
+    """
+    length = len(data)
+    if not length:
+        return b''
+    stream = keystream(key, length, offset)
+    if numpy is not None and length >= NUMPY_THRESHOLD:
+        return numpy.bitwise_xor(numpy.frombuffer(data, dtype=numpy.uint8),
+                                 numpy.frombuffer(stream, dtype=numpy.uint8)).tobytes()
+    # One big-integer XOR handles every byte in C
+    return (int.from_bytes(data, 'little') ^ int.from_bytes(stream, 'little')).to_bytes(length, 'little')
+
+
+def xor_into(buffer: Union[bytearray, memoryview], key: bytes, offset: int = 0) -> None:
+    """XOR a writable buffer with a repeating key in place"""
+    view = memoryview(buffer).cast('B')
+    if view.readonly:
+        raise ValueError("xor_into needs a writable buffer")
+    length = len(view)
+    if not length:
+        return
+    stream = keystream(key, length, offset)
+    if numpy is not None and length >= NUMPY_THRESHOLD:
+        target = numpy.frombuffer(view, dtype=numpy.uint8)
+        numpy.bitwise_xor(target, numpy.frombuffer(stream, dtype=numpy.uint8), out=target)
+        return
+    view[:] = (int.from_bytes(view, 'little') ^ int.from_bytes(stream, 'little')).to_bytes(length, 'little')